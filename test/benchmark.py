@@ -0,0 +1,547 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Rob Lanphier, Wikimedia Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for each stage of the wbstatus pipeline, run against a
+synthetic board (workboard HTML plus Conduit responses) of whatever size you
+ask for.  Each stage runs in its own fresh process so that its time and peak
+memory can be measured on their own, and the results are written out as JSON
+so that runs against different versions can be compared:
+
+    python test/benchmark.py --tasks 5000 --output new.json --compare old.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import wbstatus  # noqa: E402
+
+from dateutil import tz  # noqa: E402
+
+
+START = datetime.datetime(2015, 3, 1, 0, 0, 0, tzinfo=tz.tzutc())
+ROLES = ('todo', 'indev', 'feedback', 'done', 'archive')
+
+
+class SyntheticBoard(object):
+    """A made-up workboard, with made-up history for each task on it.
+    Everything is derived from the seed, so a board can be regenerated in
+    another process (or one task at a time) and come out the same.
+    """
+
+    def __init__(self, tasks=2000, users=50, columns=8, transactions=100,
+                 days=365, seed=0):
+        self.ntasks = tasks
+        self.ntransactions = transactions
+        self.days = days
+        self.seed = seed
+        self.teamphid = 'PHID-PROJ-synthetic0000000000'
+        self.users = ['PHID-USER-%020d' % i for i in range(users)]
+        self.columns = ['PHID-PCOL-%020d' % i for i in range(columns)]
+        self.columnnames = dict(
+            (phid, (list(ROLES) + ['Column %d' % i for i in
+                                   range(len(ROLES), columns)])[i])
+            for i, phid in enumerate(self.columns))
+        self.tasknums = range(1000, 1000 + tasks)
+
+    @property
+    def config(self):
+        return {
+            'teamphid': self.teamphid,
+            'team': dict((phid, {'phid': phid,
+                                 'userName': 'user%d' % i})
+                         for i, phid in enumerate(self.users)),
+            'workboard_state_phids': dict(zip(ROLES, self.columns)),
+        }
+
+    @property
+    def end(self):
+        return START + datetime.timedelta(days=self.days)
+
+    def times(self, tasknum):
+        """Return the task's random generator and the times (in seconds
+        from START) of its transactions, which is how feed() starts.
+        """
+        rand = random.Random((self.seed, tasknum))
+        count = max(1, int(rand.gauss(self.ntransactions,
+                                      self.ntransactions / 3.0)))
+        span = self.days * 24 * 60 * 60
+        return rand, sorted(rand.randint(0, span) for i in range(count))
+
+    def modified(self, tasknum):
+        """Return the dateModified of the task, i.e. the time of its last
+        transaction.
+        """
+        base = (START - wbstatus.EPOCH).total_seconds()
+        return str(int(base + self.times(tasknum)[1][-1]))
+
+    def feed(self, tasknum):
+        """Return the gettasktransactions feed for one task, oldest first,
+        including the comment/subscriber noise a real feed has.
+        """
+        rand, times = self.times(tasknum)
+        base = (START - wbstatus.EPOCH).total_seconds()
+        column = assignee = None
+        status = 'open'
+        feed = []
+        for i, offset in enumerate(times):
+            tact = {'transactionID': '%d-%d' % (tasknum, i),
+                    'dateCreated': str(int(base + offset)),
+                    'authorPHID': rand.choice(self.users),
+                    'oldValue': None,
+                    'newValue': None}
+            kind = rand.random()
+            if kind < 0.4 or column is None:
+                newcolumn = rand.choice(self.columns)
+                tact['transactionType'] = 'projectcolumn'
+                tact['oldValue'] = {
+                    'projectPHID': self.teamphid,
+                    'columnPHIDs': {'1': column} if column else []}
+                tact['newValue'] = {'projectPHID': self.teamphid,
+                                    'columnPHIDs': [newcolumn]}
+                column = newcolumn
+            elif kind < 0.6:
+                newassignee = rand.choice(self.users)
+                tact['transactionType'] = 'reassign'
+                tact['oldValue'] = assignee
+                tact['newValue'] = newassignee
+                assignee = newassignee
+            elif kind < 0.7:
+                newstatus = rand.choice(('open', 'resolved', 'stalled'))
+                tact['transactionType'] = 'status'
+                tact['oldValue'] = status
+                tact['newValue'] = status = newstatus
+            elif kind < 0.75:
+                tact['transactionType'] = 'title'
+                tact['oldValue'] = 'Task %d' % tasknum
+                tact['newValue'] = 'Task %d' % tasknum
+            else:
+                tact['transactionType'] = rand.choice(
+                    ('core:comment', 'core:subscribers', 'priority'))
+            feed.append(tact)
+        return feed
+
+    def workboard_html(self):
+        """Return workboard HTML laid out the way Phabricator lays it out,
+        padded with the same sort of markup noise, with tasks spread over
+        the columns.
+        """
+        rand = random.Random(self.seed)
+        bycolumn = dict((phid, []) for phid in self.columns)
+        for tasknum in self.tasknums:
+            bycolumn[rand.choice(self.columns)].append(tasknum)
+        parts = ['<!DOCTYPE html><html><head><title>Board</title></head>'
+                 '<body><div class="phui-workboard-view">']
+        for phid in self.columns:
+            parts.append(
+                '<div class="phui-workpanel-view " data-sigil="workpanel">'
+                '<div class="phui-workpanel-view-inner">'
+                '<div class="phui-action-header">'
+                '<h3 class="phui-action-header-title">{}'
+                '<span class="phui-action-header-subtitle">(Default)'
+                '</span></h3></div><ul class="phui-object-item-list-view">'
+                .format(self.columnnames[phid]))
+            for tasknum in bycolumn[phid]:
+                parts.append(
+                    '<li class="phui-object-item phui-object-item-grippable">'
+                    '<div class="phui-object-item-frame">'
+                    '<div class="phui-object-item-content-box">'
+                    '<div class="phui-object-item-name" data-sigil="slippery">'
+                    '<span class="phui-object-item-objname">T{0}</span> '
+                    '<a href="https://phabricator.example.org/T{0}" '
+                    'class="phui-object-item-link">Task &lt;{0}&gt; with a '
+                    'reasonably long title</a></div></div>'
+                    '<div class="phui-object-item-attributes">'
+                    '<span class="phui-icon-view sprite-icons"></span>'
+                    '</div></div></li>'.format(tasknum))
+            parts.append('</ul></div></div>')
+        parts.append('</div></body></html>')
+        return ''.join(parts)
+
+    def write_snapshots(self, htmlcachedir):
+        """Write the board out as the start and end snapshots that
+        parse_workboard_html expects to find.
+        """
+        html = self.workboard_html()
+        for wbtime in (START, self.end - datetime.timedelta(days=1),
+                       self.end):
+            filename = 'workboard-{:%Y-%m-%dT%H%Z}.html'.format(wbtime)
+            with open(os.path.join(htmlcachedir, filename), 'w') as fh:
+                fh.write(html)
+
+    def conduit(self):
+        return SyntheticConduit(self)
+
+
+class SyntheticConduit(object):
+    """Answers the Conduit calls wbstatus makes from a SyntheticBoard, the
+    way phabricator.Phabricator would.
+    """
+
+    def __init__(self, board, method=None):
+        self.board = board
+        self.method = method
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        if self.method:
+            attr = self.method + '.' + attr
+        return SyntheticConduit(self.board, attr)
+
+    def __call__(self, **params):
+        if self.method == 'maniphest.gettasktransactions':
+            return dict((str(tasknum), self.board.feed(tasknum))
+                        for tasknum in params['ids'])
+        elif self.method == 'maniphest.query':
+            # Without ids, it's a query for a page of the whole project
+            tasknums = params.get('ids')
+            if tasknums is None:
+                offset = params.get('offset', 0)
+                tasknums = sorted(self.board.tasknums)[
+                    offset:offset + params.get('limit', 100)]
+            return dict(('PHID-TASK-%d' % tasknum,
+                         {'id': str(tasknum), 'title': 'Task %d' % tasknum,
+                          'dateModified': self.board.modified(tasknum),
+                          'isClosed': False})
+                        for tasknum in tasknums)
+        elif self.method == 'phid.query':
+            return dict((phid, {'name': phid[-8:]})
+                        for phid in params['phids'])
+        raise NotImplementedError(self.method)
+
+
+def get_histories(board, phidstore):
+    histories = {}
+    for tasknum in board.tasknums:
+        transactions = wbstatus.get_filtered_transactions_for_task(
+            board.feed(tasknum), phidstore, board.teamphid)
+        histories[str(tasknum)] = wbstatus.TaskHistory(
+            transactions, board.config, phidstore)
+    return histories
+
+
+def stage_parse(board, workdir):
+    """parse_workboard_html on a fresh snapshot (no sidecar yet)."""
+    board.write_snapshots(workdir)
+
+    def run():
+        for name in os.listdir(workdir):
+            if name.endswith('.json'):
+                os.remove(os.path.join(workdir, name))
+        return len(wbstatus.parse_workboard_html(START, workdir))
+    return run
+
+
+def stage_filter(board, workdir):
+    """get_filtered_transactions_for_task over every task's feed."""
+    feeds = [board.feed(tasknum) for tasknum in board.tasknums]
+
+    def run():
+        phidstore = wbstatus.PhidStore()
+        return sum(len(wbstatus.get_filtered_transactions_for_task(
+            feed, phidstore, board.teamphid)) for feed in feeds)
+    return run
+
+
+def stage_taskstate(board, workdir):
+    """TaskHistory plus one day's state for every task."""
+    phidstore = wbstatus.PhidStore()
+    logs = [wbstatus.get_filtered_transactions_for_task(
+        board.feed(tasknum), phidstore, board.teamphid)
+        for tasknum in board.tasknums]
+    config = board.config
+    end = board.end
+    start = end - datetime.timedelta(days=1)
+
+    def run():
+        for transactions in logs:
+            wbstatus.build_taskstate_from_transactions(
+                transactions, start, end, config, phidstore)
+        return sum(len(transactions) for transactions in logs)
+    return run
+
+
+def stage_render(board, workdir):
+    """render_actor for everyone who did anything over the last week."""
+    phidstore = wbstatus.PhidStore()
+    phidstore.seed(board.config['team'])
+    for phid, name in board.columnnames.iteritems():
+        phidstore.query[phid] = {'name': name}
+    histories = get_histories(board, phidstore)
+    end = board.end
+    start = end - datetime.timedelta(days=7)
+    taskstate = dict((task, history.state(start, end))
+                     for task, history in histories.iteritems())
+    for task, state in taskstate.iteritems():
+        for actorid in state['actorset']:
+            phidstore.get_user(actorid).tasks.append(task)
+    taskstore = wbstatus.TaskStore()
+    taskstore.bytasknum = dict((str(tasknum), {'title': 'Task %d' % tasknum})
+                               for tasknum in board.tasknums)
+
+    def run():
+        rendered = 0
+        for actor in phidstore.users.values():
+            # Same as main(), which skips users it can't render
+            try:
+                rendered += len(wbstatus.render_actor(
+                    actor, phidstore, taskstate, board.config, taskstore))
+            except KeyError:
+                pass
+        return rendered
+    return run
+
+
+def stage_backfill(board, workdir):
+    """backfill_snapshots over a day of hourly snapshots, one process per
+    CPU.
+    """
+    html = board.workboard_html()
+    for hour in range(24):
+        wbtime = START + datetime.timedelta(hours=hour)
+        filename = 'workboard-{:%Y-%m-%dT%H%Z}.html'.format(wbtime)
+        with open(os.path.join(workdir, filename), 'w') as fh:
+            fh.write(html)
+
+    def run():
+        for name in os.listdir(workdir):
+            if name.endswith('.json'):
+                os.remove(os.path.join(workdir, name))
+        return wbstatus.backfill_snapshots({'htmlcachedir': workdir})
+    return run
+
+
+def end_to_end_arguments(board, workdir, **options):
+    """Write snapshots and a config file (with any extra options) for the
+    board to workdir, and return the wbstatus arguments for the last day.
+    """
+    board.write_snapshots(workdir)
+    config = board.config
+    config['htmlcachedir'] = workdir
+    config.update(options)
+    configpath = os.path.join(workdir, 'config.json')
+    with open(configpath, 'w') as fh:
+        json.dump(config, fh)
+    return ['--config', configpath,
+            '--start', (board.end - datetime.timedelta(days=1)).isoformat(),
+            '--end', board.end.isoformat()]
+
+
+def run_main(argv):
+    """main() with argv as its arguments and the report thrown away."""
+    sys.argv = ['wbstatus.py'] + argv
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        wbstatus.main()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def stage_end_to_end(board, workdir):
+    """main() for the last day, from snapshots and a synthetic Conduit."""
+    argv = end_to_end_arguments(board, workdir)
+    wbstatus.phabricator.Phabricator = board.conduit
+
+    def run():
+        run_main(argv)
+        return board.ntasks
+    return run
+
+
+def stage_cold_start(board, workdir):
+    """wbstatus.py --offline for the last day in a fresh interpreter, with
+    everything already in the cache: startup plus rendering, the way cron
+    runs it.  (The peak memory is this process's, not the child's.)
+    """
+    argv = end_to_end_arguments(
+        board, workdir, cachedir=os.path.join(workdir, 'cache'),
+        phidregistry=os.path.join(workdir, 'phids.json'))
+    wbstatus.phabricator.Phabricator = board.conduit
+    run_main(argv)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'wbstatus.py')
+
+    def run():
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, script, '--offline'] +
+                                  argv, stdout=devnull)
+        return board.ntasks
+    return run
+
+
+STAGES = [
+    ('parse_workboard_html', stage_parse),
+    ('get_filtered_transactions_for_task', stage_filter),
+    ('build_taskstate_from_transactions', stage_taskstate),
+    ('render_actor', stage_render),
+    ('backfill_snapshots', stage_backfill),
+    ('end_to_end', stage_end_to_end),
+    ('cold_start', stage_cold_start),
+]
+
+
+def memory_kb(field):
+    """Return VmRSS or VmHWM for this process in kB, or None if /proc
+    doesn't have it (i.e. not on Linux).
+    """
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def reset_peak_memory():
+    """Reset VmHWM so the peak we see belongs to the stage being measured
+    rather than to setting it up.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except IOError:
+        pass
+
+
+def run_stage(name, board, repeat):
+    """Set up and run a single stage in this process, returning its
+    measurements.  Called in a child process by measure_stage.
+    """
+    workdir = tempfile.mkdtemp(prefix='wbstatus-bench-')
+    try:
+        run = dict(STAGES)[name](board, workdir)
+        before = memory_kb('VmRSS')
+        reset_peak_memory()
+        timings = []
+        for i in range(repeat):
+            began = time.time()
+            items = run()
+            timings.append(time.time() - began)
+        peak = memory_kb('VmHWM')
+    finally:
+        shutil.rmtree(workdir)
+    # Memory the setup freed gets reused by the stage, so the growth can
+    # understate what the stage would need on its own; the absolute peak
+    # includes the setup.  Both are worth watching.
+    return {'seconds': min(timings),
+            'timings': timings,
+            'items': items,
+            'rss_before_kb': before,
+            'peak_rss_kb': peak,
+            'peak_growth_kb': peak - before if peak and before else None}
+
+
+def measure_stage(name, args):
+    """Run one stage in a fresh interpreter, so nothing left over from
+    other stages skews its numbers.
+    """
+    command = [sys.executable, os.path.abspath(__file__),
+               '--run-stage', name]
+    for option in ('tasks', 'users', 'columns', 'transactions', 'days',
+                   'seed', 'repeat'):
+        command += ['--' + option, str(getattr(args, option))]
+    output = subprocess.check_output(command)
+    return json.loads(output)
+
+
+def compare(results, baseline):
+    """Print how each stage in results changed relative to baseline."""
+    for name, stage in sorted(results['stages'].iteritems()):
+        old = baseline['stages'].get(name)
+        if not old:
+            continue
+        line = '{:40} {:8.3f}s -> {:8.3f}s ({:+.0%})'.format(
+            name, old['seconds'], stage['seconds'],
+            stage['seconds'] / old['seconds'] - 1 if old['seconds'] else 0)
+        if old.get('peak_growth_kb') is not None and \
+                stage.get('peak_growth_kb') is not None:
+            line += '  +{:d}kB -> +{:d}kB'.format(old['peak_growth_kb'],
+                                                 stage['peak_growth_kb'])
+        print line
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time and memory-profile each stage of wbstatus ' +
+        'against a synthetic board')
+    parser.add_argument('--tasks', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--columns', type=int, default=8)
+    parser.add_argument('--transactions', type=int, default=100,
+                        help='Mean number of transactions per task')
+    parser.add_argument('--days', type=int, default=365,
+                        help='Length of the synthetic history')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per stage; the fastest one counts')
+    parser.add_argument('--stage', action='append', dest='stages',
+                        choices=[name for name, setup in STAGES],
+                        help='Only run these stages (default: all)')
+    parser.add_argument('--output', help='Write JSON results here')
+    parser.add_argument('--compare', help='JSON results from an earlier ' +
+                        'run to compare against')
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    board = SyntheticBoard(args.tasks, args.users, args.columns,
+                           args.transactions, args.days, args.seed)
+    if args.run_stage:
+        print json.dumps(run_stage(args.run_stage, board, args.repeat))
+        return
+
+    results = {'created': datetime.datetime.utcnow().isoformat(),
+               'python': sys.version.split()[0],
+               'parameters': dict((key, getattr(args, key)) for key in
+                                  ('tasks', 'users', 'columns',
+                                   'transactions', 'days', 'seed',
+                                   'repeat')),
+               'stages': {}}
+    for name, setup in STAGES:
+        if args.stages and name not in args.stages:
+            continue
+        stage = results['stages'][name] = measure_stage(name, args)
+        sys.stderr.write('{:40} {:8.3f}s {:>10} items  peak {}kB (+{}kB)\n'
+                         .format(name, stage['seconds'], stage['items'],
+                                 stage['peak_rss_kb'],
+                                 stage['peak_growth_kb']))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=4, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(results, json.load(fh))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 Rob Lanphier, Wikimedia Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local, in-process stand-in for a Phabricator Conduit server, so that the
+HTTP client and the concurrency around it can be exercised offline.  It
+speaks HTTP/1.1 with keep-alive, answers each method from a handler
+function, and keeps count of connections, requests and how many requests
+were in flight at once.
+
+Run as a script, it serves a recording made with wbstatus --record-conduit
+(see ReplayHandlers), so the real client can be load tested against it:
+
+    python test/fakeconduit.py recording.jsonl --port 8080 --latency 0.2
+"""
+
+import argparse
+import BaseHTTPServer
+import functools
+import json
+import os
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import wbstatus  # noqa: E402
+
+
+class FakeConduitHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.inflight += 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+        try:
+            length = int(self.headers.getheader('content-length'))
+            form = urlparse.parse_qs(self.rfile.read(length))
+            params = json.loads(form['params'][0])
+            token = params.pop('__conduit__', {}).get('token')
+            method = self.path.rsplit('/', 1)[-1]
+            if server.delay:
+                time.sleep(server.delay)
+            if token != server.token:
+                body = {'result': None, 'error_code': 'ERR-INVALID-AUTH',
+                        'error_info': 'Bad token'}
+            elif method not in server.handlers:
+                body = {'result': None, 'error_code': 'ERR-CONDUIT-CALL',
+                        'error_info': 'No such method ' + method}
+            else:
+                try:
+                    body = {'result': server.handlers[method](**params),
+                            'error_code': None, 'error_info': None}
+                except wbstatus.phabricator.APIError as e:
+                    body = {'result': None, 'error_code': e.code,
+                            'error_info': e.message}
+            data = json.dumps(body)
+        finally:
+            with server.lock:
+                server.inflight -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeConduitServer(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    """Serve "handlers" (a dict of Conduit method name to a function taking
+    the call's parameters as keyword arguments) on a free local port, in a
+    background thread.  "delay" slows every request down by that many
+    seconds so that overlapping requests are easy to see.
+    """
+    daemon_threads = True
+
+    def __init__(self, handlers, token='api-test', delay=0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           FakeConduitHandler)
+        self.handlers = handlers
+        self.token = token
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ReplayHandlers(dict):
+    """Handlers for FakeConduitServer that answer every method from a
+    wbstatus.ConduitReplay, including its injected latency, errors and
+    scaling.
+    """
+
+    def __init__(self, replay):
+        dict.__init__(self)
+        self.replay = replay
+
+    def __contains__(self, method):
+        return True
+
+    def __getitem__(self, method):
+        return functools.partial(self.replay.call, method)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a recording of Conduit calls over HTTP')
+    parser.add_argument('recording')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--token', default='api-test')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--errors', type=float, default=0)
+    parser.add_argument('--scale', type=int, default=1)
+    args = parser.parse_args()
+    replay = wbstatus.ConduitReplay(args.recording, args.latency,
+                                    args.errors, args.scale)
+    server = FakeConduitServer(ReplayHandlers(replay), args.token,
+                               port=args.port)
+    sys.stderr.write('Serving {} at {}\n'.format(args.recording, server.url))
+    try:
+        while server.thread.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -62,6 +62,15 @@ def get_fake_transactions():
     ]
 
 
+def get_fake_records(phidstore):
+    records = wbstatus.TransactionLog()
+    for tact in get_fake_transactions():
+        records.append(wbstatus.TRANSACTION_CODES[tact['transactionType']],
+                       tact['timestamp'], phidstore.add(tact['authorPHID']),
+                       tact['oldValue'], tact['newValue'])
+    return records
+
+
 # For each type, build the "old" and "new" state along the
 # interval defined by the start and end variables
 # For example:
@@ -74,13 +83,1059 @@ def get_fake_transactions():
 # Old should be "c" and new should be "e"
 def test_build_taskstate_from_transactions():
     config = get_fake_config()
-    transactions = get_fake_transactions()
+    phidstore = wbstatus.PhidStore()
+    transactions = get_fake_records(phidstore)
     import datetime
     from dateutil import tz
     start = datetime.datetime.fromtimestamp(1500100001, tz.tzutc())
     end = datetime.datetime.fromtimestamp(1500300000, tz.tzutc())
     taskstate = wbstatus.build_taskstate_from_transactions(
-        transactions, start, end, config)
+        transactions, start, end, config, phidstore)
     print taskstate
     assert taskstate['title']['start'] == 'C'
     assert taskstate['title']['end'] == 'E'
+
+
+class FakePhab(object):
+    """Stand-in for phabricator.Phabricator that counts the calls made to
+    each Conduit method and answers with canned results (or whatever a
+    callable result returns when given the call's arguments).
+    """
+
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+
+    def __getattr__(self, attr):
+        return FakeResource(self, attr)
+
+
+class FakeResource(object):
+    def __init__(self, phab, method):
+        self.phab = phab
+        self.method = method
+
+    def __getattr__(self, attr):
+        return FakeResource(self.phab, self.method + '.' + attr)
+
+    def __call__(self, **kwargs):
+        self.phab.calls.append((self.method, kwargs))
+        result = self.phab.results[self.method]
+        if callable(result):
+            return result(**kwargs)
+        return result
+
+
+def test_call_phab_via_cache(tmpdir):
+    phab = FakePhab({'phid.query': {'PHID-USER-a': {'name': 'a'}}})
+    cache = wbstatus.ResponseCache(str(tmpdir))
+    params = {'phids': ['PHID-USER-a', 'PHID-USER-b']}
+    first = wbstatus.call_phab_via_cache(phab, cache, 'phid.query', params)
+    # Same query with the list in a different order is a cache hit
+    second = wbstatus.call_phab_via_cache(
+        phab, cache, 'phid.query', {'phids': ['PHID-USER-b', 'PHID-USER-a']})
+    assert first == second == {'PHID-USER-a': {'name': 'a'}}
+    assert len(phab.calls) == 1
+    # A different query goes to the network
+    wbstatus.call_phab_via_cache(phab, cache, 'phid.query',
+                                 {'phids': ['PHID-USER-a']})
+    assert len(phab.calls) == 2
+
+    # A None result is cached like any other
+    phab.results['maniphest.query'] = None
+    for i in range(2):
+        assert wbstatus.call_phab_via_cache(
+            phab, cache, 'maniphest.query', {'ids': [1]}) is None
+    assert len(phab.calls) == 3
+    # fresh goes to the network, and the cache gets the new answer
+    phab.results['phid.query'] = {'PHID-USER-a': {'name': 'b'}}
+    for fresh in (True, False):
+        assert wbstatus.call_phab_via_cache(
+            phab, cache, 'phid.query', params, fresh=fresh) == \
+            {'PHID-USER-a': {'name': 'b'}}
+    assert len(phab.calls) == 4
+
+
+def test_write_atomically_cleans_up(tmpdir):
+    import pytest
+    with pytest.raises(TypeError):
+        wbstatus.write_atomically(str(tmpdir.join('x')), None)
+    assert tmpdir.listdir() == []
+
+
+def test_response_cache_expiry_and_eviction(tmpdir):
+    cache = wbstatus.ResponseCache(str(tmpdir), ttls={'phid.query': 0},
+                                   maxbytes=1)
+    cache.put('maniphest.query', {'ids': [1]}, {'x': 1})
+    assert cache.get('maniphest.query', {'ids': [1]}) is None
+    assert tmpdir.listdir() == []
+    cache.maxbytes = 10 ** 6
+    cache.put('phid.query', {'phids': ['a']}, {'a': {}})
+    import time
+    time.sleep(0.01)
+    assert cache.get('phid.query', {'phids': ['a']}) is None
+
+
+def get_fake_feed():
+    feed = []
+    for i, tact in enumerate(get_fake_transactions()):
+        feed.append({
+            'transactionID': str(i + 1),
+            'transactionType': tact['transactionType'],
+            'dateCreated': str(tact['timestamp']),
+            'authorPHID': tact['authorPHID'],
+            'oldValue': tact['oldValue'],
+            'newValue': tact['newValue']
+        })
+    return feed
+
+
+def test_eventstore_append(tmpdir):
+    store = wbstatus.EventStore(str(tmpdir.join('events.sqlite')))
+    feed = get_fake_feed()
+    assert store.highwater(42) is None
+    assert store.append(42, feed[:3]) == 3
+    assert store.highwater(42) == 1500100000
+    # Refetching the full history only adds what's new
+    comment = {'transactionID': '99', 'transactionType': 'core:comment',
+               'dateCreated': '1500500000', 'authorPHID': None,
+               'oldValue': None, 'newValue': None}
+    assert store.append(42, feed + [comment]) == 3
+    assert store.highwater(42) == 1500500000
+    assert [t['newValue'] for t in store.transactions(42)] == \
+        ['A', 'B', 'C', 'D', 'E', 'F']
+    assert store.transactions(43) == []
+
+    # Storing another transaction type means refetching everything
+    store.save_summaries('PHID-PROJ-a', [(42, 1500500000, {})])
+    store.db.execute("UPDATE meta SET value = '[]'")
+    store.db.commit()
+    store = wbstatus.EventStore(str(tmpdir.join('events.sqlite')))
+    assert store.highwater(42) is None
+    assert store.summaries('PHID-PROJ-a', [42]) == {}
+    assert store.append(42, feed + [comment]) == 0
+    assert len(store.transactions(42)) == 6
+    store = wbstatus.EventStore(str(tmpdir.join('events.sqlite')))
+    assert store.highwater(42) == 1500500000
+
+
+def test_activity_skips_unmodified_tasks(tmpdir):
+    store = wbstatus.EventStore(str(tmpdir.join('events.sqlite')))
+    feed = get_fake_feed()
+    phab = FakePhab({'maniphest.gettasktransactions':
+                     lambda ids: dict((str(x), feed) for x in ids)})
+    fetcher = wbstatus.ConduitFetcher(phab, None)
+    activity = wbstatus.get_activity_for_tasks(fetcher, [42], store)
+    assert len(phab.calls) == 1
+    # Nothing's changed on 42 since, so only 43 is fetched
+    modified = {'42': str(store.highwater(42)), '43': '1500500000'}
+    again = wbstatus.get_activity_for_tasks(fetcher, [42, 43], store,
+                                            modified)
+    assert phab.calls[1:] == [('maniphest.gettasktransactions',
+                               {'ids': [43]})]
+    assert again['42'] == activity['42']
+    assert len(again['43']) == len(feed)
+
+    # Through the cache, a task known to have new transactions is fetched
+    # fresh rather than getting the old feed back
+    store = wbstatus.EventStore(str(tmpdir.join('events2.sqlite')))
+    fetcher = wbstatus.ConduitFetcher(
+        phab, wbstatus.ResponseCache(str(tmpdir.mkdir('cache'))))
+    wbstatus.get_activity_for_tasks(fetcher, [42], store)
+    comment = {'transactionID': '99', 'transactionType': 'title',
+               'dateCreated': '1500500000', 'authorPHID': None,
+               'oldValue': 'F', 'newValue': 'G'}
+    feed.append(comment)
+    modified = {'42': '1500500000'}
+    wbstatus.get_activity_for_tasks(fetcher, [42], store, modified)
+    assert store.highwater(42) == 1500400000
+    again = wbstatus.get_activity_for_tasks(fetcher, [42], store, modified,
+                                            fresh=True)
+    assert store.highwater(42) == 1500500000
+    assert again['42'][-1]['newValue'] == 'G'
+
+
+def test_conduit_fetcher_chunks_and_retries():
+    failed = set()
+
+    def flaky_phid_query(phids):
+        # Fail the first attempt at each chunk
+        if tuple(phids) not in failed:
+            failed.add(tuple(phids))
+            raise IOError('connection reset')
+        return dict((phid, {'name': phid.lower()}) for phid in phids)
+
+    phab = FakePhab({'phid.query': flaky_phid_query})
+    fetcher = wbstatus.ConduitFetcher(
+        phab, None, {'chunksize': {'phid.query': 3}, 'backoff': 0})
+    phids = ['PHID-%d' % i for i in range(10)]
+    result = fetcher.call('phid.query', 'phids', set(phids))
+    fetcher.close()
+    assert sorted(result.keys()) == phids
+    # four chunks, each failing once before succeeding
+    assert sorted(len(kw['phids']) for method, kw in phab.calls) == \
+        [1, 1, 3, 3, 3, 3, 3, 3]
+
+
+def test_parse_workboard_html(tmpdir):
+    import collections
+    import datetime
+    import os
+    import shutil
+    from dateutil import tz
+    wbtime = datetime.datetime(2015, 3, 2, 0, 0, 0, tzinfo=tz.tzutc())
+    htmlpath = str(tmpdir.join('workboard-2015-03-02T00UTC.html'))
+    shutil.copy(os.path.join(os.path.dirname(__file__), 'data',
+                             'MediaWiki-Core-Team Board.html'), htmlpath)
+    workboard = wbstatus.parse_workboard_html(wbtime, str(tmpdir))
+    assert collections.Counter(workboard.values()) == {
+        'To Do': 83, 'In Dev/Progress': 11,
+        'Needs Review/Feedback': 10, 'Done': 5}
+    assert workboard['T84962'] == 'To Do'
+    # The second parse comes from the sidecar
+    assert os.path.exists(htmlpath + '.json')
+    with open(htmlpath + '.json', 'w') as fh:
+        fh.write('{"T1": "From sidecar"}')
+    assert wbstatus.parse_workboard_html(wbtime, str(tmpdir)) == \
+        {'T1': 'From sidecar'}
+
+
+def test_get_intervals():
+    import datetime
+    import pytest
+    from dateutil import tz
+    start = datetime.datetime(2017, 7, 1, tzinfo=tz.tzutc())
+    end = start + datetime.timedelta(days=1)
+    intervals = wbstatus.get_intervals(start, end, '5h')
+    assert len(intervals) == 5
+    assert intervals[-1] == (start + datetime.timedelta(hours=20), end)
+    # A step longer than the whole range is just the one window
+    assert wbstatus.get_intervals(start, end, '2d') == [(start, end)]
+    for bad in [(end, start, '1d'), (start, start, None),
+                (start, end, '0h'), (start, end, '1m')]:
+        with pytest.raises(ValueError):
+            wbstatus.get_intervals(*bad)
+
+
+def test_get_window():
+    import datetime
+    from dateutil import tz
+    # Dates without a timezone (as in the README) are UTC
+    start, end = wbstatus.get_window('2015-03-01', '2015-03-08')
+    assert start == datetime.datetime(2015, 3, 1, tzinfo=tz.tzutc())
+    assert end == datetime.datetime(2015, 3, 8, tzinfo=tz.tzutc())
+    assert len(wbstatus.get_intervals(start, end, '1d')) == 7
+    start, end = wbstatus.get_window(None, '2015-03-08T12:00+01:00')
+    assert end - start == datetime.timedelta(days=1)
+    assert (end - wbstatus.EPOCH).total_seconds() == 1425812400
+
+
+def test_task_history_intervals():
+    import datetime
+    from dateutil import tz
+    start = datetime.datetime.fromtimestamp(1500000000, tz.tzutc())
+    end = datetime.datetime.fromtimestamp(1500400000, tz.tzutc())
+    intervals = wbstatus.get_intervals(start, end, '1d')
+    assert len(intervals) == 5
+    assert intervals[0] == (start, start + datetime.timedelta(days=1))
+    # The last window's cut short rather than dropped
+    assert intervals[-1] == (start + datetime.timedelta(days=4), end)
+    phidstore = wbstatus.PhidStore()
+    history = wbstatus.TaskHistory(get_fake_records(phidstore),
+                                   get_fake_config(), phidstore)
+    titles = [(state['title'].get('start'), state['title'].get('end'))
+              for state in [history.state(s, e) for s, e in intervals]]
+    assert titles == [(None, 'B'), ('B', 'D'), ('D', 'E'), ('E', 'E'),
+                      ('E', 'F')]
+    # Nothing had happened yet before the first transaction
+    before = history.state(start - datetime.timedelta(days=2),
+                           start - datetime.timedelta(days=1))
+    assert before['title'] == {}
+    assert before['actorset'] == set()
+    # Transactions that arrive out of order get sorted
+    records = get_fake_records(phidstore)
+    shuffled = wbstatus.TransactionLog()
+    for i in reversed(range(len(records))):
+        shuffled.append(records.ttypes[i], records.timestamps[i],
+                        records.authors[i], records.olds[i], records.news[i])
+    history = wbstatus.TaskHistory(shuffled, get_fake_config(), phidstore)
+    assert titles == [(state['title'].get('start'), state['title'].get('end'))
+                      for state in [history.state(s, e)
+                                    for s, e in intervals]]
+
+
+def test_get_boards():
+    config = get_fake_config()
+    config['teamphid'] = 'PHID-PROJ-a'
+    assert wbstatus.get_boards(config) == [config]
+    config['boards'] = [{'name': 'A'},
+                        {'name': 'B', 'teamphid': 'PHID-PROJ-b'}]
+    boards = wbstatus.get_boards(config)
+    assert [b['teamphid'] for b in boards] == ['PHID-PROJ-a', 'PHID-PROJ-b']
+    assert all('boards' not in b and b['workboard_state_phids'] ==
+               config['workboard_state_phids'] for b in boards)
+
+
+def test_phidstore_registry(tmpdir):
+    registrypath = str(tmpdir.join('phids.json'))
+    phab = FakePhab({'phid.query': lambda phids: dict(
+        (phid, {'name': phid.lower(), 'type': 'PCOL'}) for phid in phids)})
+    fetcher = wbstatus.ConduitFetcher(phab, None)
+    phidstore = wbstatus.PhidStore(registrypath)
+    phidstore.seed({'PHID-USER-a': {'userName': 'alice'}})
+    for phid in ('PHID-USER-a', 'PHID-PCOL-b', 'PHID-PCOL-c'):
+        phidstore.add(phid)
+    phidstore.load_from_phabricator(fetcher)
+    assert phab.calls == [('phid.query',
+                           {'phids': ['PHID-PCOL-b', 'PHID-PCOL-c']})]
+    assert phidstore.name('PHID-USER-a') == 'alice'
+    assert phidstore.name('PHID-PCOL-b') == 'phid-pcol-b'
+
+    # A later run only asks about what the registry doesn't know
+    phidstore = wbstatus.PhidStore(registrypath)
+    phidstore.add('PHID-PCOL-b')
+    phidstore.add('PHID-PCOL-d')
+    phidstore.load_from_phabricator(fetcher)
+    assert phab.calls[1:] == [('phid.query', {'phids': ['PHID-PCOL-d']})]
+    assert phidstore.name('PHID-PCOL-b') == 'phid-pcol-b'
+
+    # ...unless the entries are too old
+    phidstore = wbstatus.PhidStore(registrypath, refresh_age=-1)
+    phidstore.add('PHID-PCOL-b')
+    phidstore.load_from_phabricator(fetcher)
+    fetcher.close()
+    assert phab.calls[2:] == [('phid.query', {'phids': ['PHID-PCOL-b']})]
+
+
+def test_get_filtered_transactions_for_task():
+    phidstore = wbstatus.PhidStore()
+    column = {'projectPHID': 'PHID-PROJ-team',
+              'columnPHIDs': {'1': 'PHID-PCOL-todo'}}
+    feed = get_fake_feed()[:2] + [
+        {'transactionType': 'reassign', 'dateCreated': '1500300000',
+         'authorPHID': 'PHID-USER-a', 'oldValue': None,
+         'newValue': 'PHID-USER-a'},
+        {'transactionType': 'projectcolumn', 'dateCreated': '1500300001',
+         'authorPHID': 'PHID-USER-a', 'oldValue': column,
+         'newValue': {'projectPHID': 'PHID-PROJ-team',
+                      'columnPHIDs': ['PHID-PCOL-indev']}},
+        {'transactionType': 'core:comment', 'dateCreated': '1500300002',
+         'authorPHID': 'PHID-USER-b', 'oldValue': None, 'newValue': None}]
+    records = wbstatus.get_filtered_transactions_for_task(
+        feed, phidstore, 'PHID-PROJ-team')
+    assert list(records.ttypes) == [
+        wbstatus.TITLE, wbstatus.TITLE, wbstatus.REASSIGN,
+        wbstatus.PROJECTCOLUMN]
+    user = phidstore.add('PHID-USER-a')
+    assert (records.olds[2], records.news[2], records.authors[2]) == \
+        (None, user, user)
+    assert phidstore.lookup(records.olds[3]) == 'PHID-PCOL-todo'
+    assert phidstore.lookup(records.news[3]) == 'PHID-PCOL-indev'
+    assert records.timestamps[3] == 1500300001
+    # Only the PHIDs we kept need resolving
+    assert 'PHID-USER-b' not in phidstore.phids
+    # Column moves on other boards are dropped
+    assert len(wbstatus.get_filtered_transactions_for_task(
+        feed, phidstore, 'PHID-PROJ-other')) == 3
+
+
+def test_benchmark_stages():
+    import benchmark
+    board = benchmark.SyntheticBoard(tasks=20, users=5, transactions=10)
+    for name in ('parse_workboard_html',
+                 'get_filtered_transactions_for_task',
+                 'build_taskstate_from_transactions', 'render_actor'):
+        result = benchmark.run_stage(name, board, 1)
+        assert result['items'] > 0
+        assert result['seconds'] >= 0
+
+
+def test_streaming_memory():
+    import benchmark
+    import pytest
+    # main() on a board five times as big, each in a fresh process
+    growth = []
+    for tasks in (300, 1500):
+        args = benchmark.parse_arguments(['--tasks', str(tasks),
+                                          '--repeat', '1'])
+        result = benchmark.measure_stage('end_to_end', args)
+        if result['peak_growth_kb'] is None:
+            pytest.skip('no /proc to measure memory with')
+        growth.append(result['peak_growth_kb'])
+    # The raw transactions come to about 150kB a task; only a few chunks
+    # of them should ever be held at once
+    assert (growth[1] - growth[0]) / 1200.0 < 50
+
+
+def test_metrics(tmpdir, monkeypatch):
+    metrics = wbstatus.Metrics()
+    metrics.enabled = True
+    monkeypatch.setattr(wbstatus, 'METRICS', metrics)
+    phab = FakePhab({'phid.query': {'PHID-USER-a': {'name': 'a'}}})
+    cache = wbstatus.ResponseCache(str(tmpdir))
+    with metrics.stage('resolve phids') as stage:
+        for i in range(3):
+            wbstatus.call_phab_via_cache(phab, cache, 'phid.query',
+                                         {'phids': ['PHID-USER-a', 'b']})
+        stage['objects'] = 2
+    assert metrics.conduit['phid.query']['calls'] == 3
+    assert metrics.conduit['phid.query']['ids'] == 6
+    assert metrics.conduit['phid.query']['hits'] == 2
+    assert metrics.conduit['phid.query']['misses'] == 1
+    assert metrics.conduit['phid.query']['bytes'] == \
+        3 * len('{"PHID-USER-a": {"name": "a"}}')
+    assert [(s['stage'], s['objects']) for s in metrics.stages] == \
+        [('resolve phids', 2)]
+    assert 'resolve phids' in metrics.summary()
+
+
+def test_conduit_client_pools_connections():
+    import fakeconduit
+    server = fakeconduit.FakeConduitServer(
+        {'phid.query': lambda phids: dict(
+            (phid, {'name': phid.lower()}) for phid in phids)},
+        delay=0.02)
+    try:
+        client = wbstatus.ConduitClient(server.url, 'api-test',
+                                        connections=3)
+        fetcher = wbstatus.ConduitFetcher(
+            client, None, {'workers': 6, 'chunksize': {'phid.query': 2}})
+        phids = ['PHID-%02d' % i for i in range(40)]
+        result = fetcher.call('phid.query', 'phids', phids)
+        fetcher.close()
+        assert sorted(result) == phids
+        assert result['PHID-07'] == {'name': 'phid-07'}
+        assert server.requests == 20
+        # Requests overlapped, but never more than the pool allows, and
+        # the connections got reused
+        assert 1 < server.max_inflight <= 3
+        assert server.connections <= 3
+
+        client = wbstatus.ConduitClient(server.url, 'wrong-token')
+        try:
+            client.phid.query(phids=['PHID-01'])
+            assert False, 'expected an APIError'
+        except wbstatus.phabricator.APIError:
+            pass
+    finally:
+        server.stop()
+
+
+def test_conduit_record_and_replay(tmpdir):
+    import fakeconduit
+    recording = str(tmpdir.join('conduit.jsonl'))
+    transactions = dict((str(i), [{'taskID': str(i), 'dateCreated': str(i),
+                                   'transactionID': str(10 * i)}])
+                        for i in range(1, 7))
+    phab = wbstatus.ConduitRecorder(FakePhab({
+        'maniphest.gettasktransactions': lambda ids: dict(
+            (str(i), transactions[str(i)]) for i in ids),
+        'phid.query': lambda phids: {}}), recording)
+    fetcher = wbstatus.ConduitFetcher(
+        phab, None, {'chunksize': {'maniphest.gettasktransactions': 3}})
+    assert fetcher.call('maniphest.gettasktransactions', 'ids',
+                        range(1, 7)) == transactions
+    phab.phid.query(phids=['PHID-GONE'])
+
+    # Replayed with another chunk size, calls get answered per task
+    replay = wbstatus.ConduitReplay(recording)
+    fetcher = wbstatus.ConduitFetcher(
+        replay, None, {'chunksize': {'maniphest.gettasktransactions': 2}})
+    assert fetcher.call('maniphest.gettasktransactions', 'ids',
+                        range(1, 7)) == transactions
+    assert replay.phid.query(phids=['PHID-GONE']) == {}
+    try:
+        replay.maniphest.gettasktransactions(ids=[7])
+        assert False, 'expected an APIError'
+    except wbstatus.phabricator.APIError as e:
+        assert e.code == 'ERR-REPLAY'
+
+    replay = wbstatus.ConduitReplay(recording, errors=1, scale=3)
+    try:
+        replay.phid.query(phids=['PHID-GONE'])
+        assert False, 'expected an IOError'
+    except IOError:
+        pass
+    replay.errors = 0
+    result = replay.maniphest.gettasktransactions(ids=[1, 2])
+    assert len(result['2']) == len(transactions['2']) * 3
+    assert result['2'][:len(transactions['2'])] == transactions['2']
+    # Each copy is a transaction of its own, a second later
+    assert len(set(t['transactionID'] for t in result['2'])) == \
+        len(result['2'])
+    copy = result['2'][len(transactions['2'])]
+    assert int(copy['dateCreated']) == \
+        int(transactions['2'][0]['dateCreated']) + 1
+
+    # Served over HTTP to the real client
+    server = fakeconduit.FakeConduitServer(
+        fakeconduit.ReplayHandlers(wbstatus.ConduitReplay(recording)))
+    try:
+        client = wbstatus.ConduitClient(server.url, 'api-test')
+        assert client.maniphest.gettasktransactions(ids=[5]) == \
+            {'5': transactions['5']}
+        try:
+            client.maniphest.gettasktransactions(ids=[7])
+            assert False, 'expected an APIError'
+        except wbstatus.phabricator.APIError as e:
+            assert e.code == 'ERR-REPLAY'
+        client.close()
+    finally:
+        server.stop()
+
+
+def test_report_state(tmpdir, monkeypatch):
+    import benchmark
+    import datetime
+    import json
+    import re
+    import urllib2
+    board = benchmark.SyntheticBoard(tasks=30, users=5, transactions=10,
+                                     days=30)
+    board.write_snapshots(str(tmpdir))
+    phab = FakePhab(dict(
+        (method, benchmark.SyntheticConduit(board, method))
+        for method in ('maniphest.gettasktransactions', 'maniphest.query',
+                       'phid.query')))
+    monkeypatch.setattr(wbstatus, 'get_phab', lambda config: phab)
+    config = board.config
+    config['htmlcachedir'] = str(tmpdir)
+    state = wbstatus.ReportState(config)
+    start = board.end - datetime.timedelta(days=1)
+
+    html = state.report(start, board.end)
+    assert "<li class='userentry'>" in html
+    calls = len(phab.calls)
+    # Same window again comes straight from memory
+    assert state.report(start, board.end) is html
+    assert len(phab.calls) == calls
+    # Nothing changed, so a refresh keeps the rendered report
+    state.refresh()
+    assert state.report(start, board.end) is html
+    # New transactions throw it away
+    board.ntransactions = 20
+    state.refresh()
+    assert state.report(start, board.end) is not html
+
+    # With a cache, refresh still picks up changes the cached responses
+    # predate
+    config['cachedir'] = str(tmpdir.mkdir('cache'))
+    state = wbstatus.ReportState(config)
+    html = state.report(start, board.end)
+    before = dict(state.taskstore.bytasknum)
+    board.ntransactions = 30
+    state.refresh()
+    assert state.report(start, board.end) is not html
+    uncached = wbstatus.ReportState(dict(config, cachedir=None))
+    uncached.report(start, board.end)
+    assert state.taskstore.bytasknum == uncached.taskstore.bytasknum
+    moved = [tasknum for tasknum, task in before.iteritems()
+             if task != state.taskstore.bytasknum[tasknum]]
+    assert moved
+    for tasknum in moved:
+        assert state.feedhashes[tasknum] == uncached.feedhashes[tasknum]
+
+    # Users rendered concurrently still come out in team order
+    html = state.report(start, board.end)
+    state.boards[0]['render_workers'] = 4
+    state.reports.clear()
+    assert state.report(start, board.end) == html
+    report = json.loads(state.report(start, board.end, fmt='json'))
+    users = report['boards'][0]['intervals'][0]['users']
+    assert [user['name'] for user in users] == re.findall(
+        "<span class='user'>([^<]*)</span>", html)
+    assert sum(len(user['tasks']) for user in users) == html.count(
+        "<span class='tasknum'>")
+
+    server = wbstatus.get_report_server(('127.0.0.1', 0), state)
+    import threading
+    threading.Thread(target=server.serve_forever).start()
+    try:
+        url = 'http://{}:{}/'.format(*server.server_address)
+        query = '?start={}&end={}'.format(
+            start.isoformat(), board.end.isoformat()).replace('+', '%2B')
+        response = urllib2.urlopen(url + query)
+        assert response.read() == state.report(start, board.end)
+        response = urllib2.urlopen(url + query + '&format=json')
+        assert response.info().gettype() == 'application/json'
+        assert 'boards' in json.load(response)
+        # Dates without a timezone are UTC
+        response = urllib2.urlopen(url + '?start={:%Y-%m-%d}&end={:%Y-%m-%d}'
+                                   .format(start, board.end))
+        assert response.read() == state.report(start, board.end)
+        for query, code in (('?end=garbage', 400),
+                            ('?start=2015-03-08&end=2015-03-01', 400),
+                            ('?end=2001-01-01T00:00Z', 404)):
+            try:
+                urllib2.urlopen(url + query)
+                assert False, 'expected an HTTP error'
+            except urllib2.HTTPError as e:
+                assert e.code == code
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def get_fake_board_feeds(team):
+    def column(timestamp, old, new, project=team):
+        return {'transactionType': 'projectcolumn',
+                'dateCreated': str(timestamp),
+                'authorPHID': 'PHID-USER-a',
+                'oldValue': {'projectPHID': project,
+                             'columnPHIDs': {'0': old} if old else []},
+                'newValue': {'projectPHID': project, 'columnPHIDs': [new]}}
+
+    def other(timestamp, ttype, old, new):
+        return {'transactionType': ttype, 'dateCreated': str(timestamp),
+                'authorPHID': 'PHID-USER-a', 'oldValue': old,
+                'newValue': new}
+    return {
+        1: [column(100, None, 'A'), column(200, 'A', 'B'),
+            other(300, 'status', 'open', 'resolved'),
+            other(400, 'status', 'resolved', 'open')],
+        2: [other(150, 'core:edge', [], [team]), column(250, None, 'A'),
+            other(350, 'core:edge', {team: {}}, {})],
+        3: [column(120, None, 'A', 'PHID-PROJ-other')],
+    }
+
+
+def test_board_history():
+    import datetime
+    from dateutil import tz
+    team = 'PHID-PROJ-team'
+    expected = [(50, {}), (100, {1: 'A'}), (160, {1: 'A', 2: None}),
+                (260, {1: 'B', 2: 'A'}), (300, {2: 'A'}), (360, {}),
+                (400, {1: 'B'})]
+    for every in (1, 2, 3, 1000):
+        history = wbstatus.BoardHistory(team, checkpoint_every=every)
+        for tasknum, feed in get_fake_board_feeds(team).iteritems():
+            history.set_feed(tasknum, feed)
+        assert [(t, history.board_at(t)) for t, board in expected] == \
+            expected
+
+    # Workboards come out of the history when there's no htmlcachedir
+    board = {'teamphid': team, 'history': history}
+    start = datetime.datetime.fromtimestamp(160, tz.tzutc())
+    end = datetime.datetime.fromtimestamp(260, tz.tzutc())
+    assert wbstatus.get_workboards(board, [(start, end)]) == \
+        {start: set(['1', '2']), end: set(['1', '2'])}
+
+    # Closed tasks untouched since the start of the report are skipped
+    phab = FakePhab({'maniphest.query': {
+        'PHID-TASK-1': {'id': '1', 'isClosed': False, 'dateModified': '10'},
+        'PHID-TASK-2': {'id': '2', 'isClosed': True, 'dateModified': '10'},
+        'PHID-TASK-3': {'id': '3', 'isClosed': True,
+                        'dateModified': '500'}}})
+    fetcher = wbstatus.ConduitFetcher(phab, None)
+    assert wbstatus.discover_board_tasks(fetcher, board, 100) == set([1, 3])
+    assert phab.calls[0][1]['projectPHIDs'] == [team]
+    # The project's queried a page at a time
+    tasks = sorted(phab.results['maniphest.query'].items())
+    phab.results['maniphest.query'] = \
+        lambda offset, limit, **params: dict(tasks[offset:offset + limit])
+    fetcher.chunksizes['maniphest.query'] = 2
+    assert wbstatus.discover_board_tasks(fetcher, board, 100) == set([1, 3])
+    assert [call[1]['offset'] for call in phab.calls[1:]] == [0, 2]
+    fetcher.close()
+
+
+def test_snapshot_store(tmpdir):
+    import datetime
+    import os
+    import shutil
+    from dateutil import tz
+    htmldir = tmpdir.mkdir('html')
+    for hour in (0, 1, 5):
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'data',
+                                 'MediaWiki-Core-Team Board.html'),
+                    str(htmldir.join('workboard-2015-03-02T%02dUTC.html' %
+                                     hour)))
+    htmldir.join('README').write('not a snapshot')
+    board = {'htmlcachedir': str(htmldir),
+             'snapshotstore': str(tmpdir.join('snapshots.sqlite')),
+             'snapshot_keep_html': True}
+    assert wbstatus.backfill_snapshots(board, 2, prune=True) == 3
+    assert wbstatus.backfill_snapshots(board) == 0
+    assert os.listdir(str(htmldir)) == ['README']
+    store = board['snapshots']
+    # Identical scrapes are only stored once
+    assert store.counts() == (3, 1)
+    store.add(1425261600, {'T1': 'To Do'})
+    assert store.counts() == (4, 2)
+
+    def at(hour, minute=0):
+        return datetime.datetime(2015, 3, 2, hour, minute, 0,
+                                 tzinfo=tz.tzutc())
+    workboards = wbstatus.get_workboards(board, [(at(0, 30), at(2)),
+                                                 (at(4), at(6))])
+    assert len(workboards[at(0, 30)]) == 109
+    assert workboards[at(2)] == set(['1'])
+    assert workboards[at(4)] == set(['1'])
+    assert workboards[at(6)] == workboards[at(0, 30)]
+    try:
+        store.at(1425254400 - 1)
+        assert False, 'expected an IOError'
+    except IOError:
+        pass
+    assert 'phui-workpanel-view' in store.html_at(1425254400)
+    assert store.html_at(1425261600) is None
+
+    # Scrapes that haven't been imported yet still get used
+    store.add(1425276000, {'T1': 'To Do'})
+    shutil.copy(os.path.join(os.path.dirname(__file__), 'data',
+                             'MediaWiki-Core-Team Board.html'),
+                str(htmldir.join('workboard-2015-03-02T07UTC.html')))
+    workboards = wbstatus.get_workboards(board, [(at(6), at(7))])
+    assert workboards[at(6)] == set(['1'])
+    assert len(workboards[at(7)]) == 109
+    # A snapshot too long before the time asked for isn't used
+    later = at(7) + datetime.timedelta(days=2)
+    try:
+        wbstatus.get_workboards(board, [(at(7), later)])
+        assert False, 'expected an IOError'
+    except IOError:
+        pass
+    board['snapshot_max_age'] = None
+    assert wbstatus.get_workboards(board, [(at(7), later)])[later] == \
+        set(['1'])
+
+
+def test_backfill_sidecars(tmpdir):
+    import os
+    import shutil
+    for hour in range(4):
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'data',
+                                 'MediaWiki-Core-Team Board.html'),
+                    str(tmpdir.join('workboard-2015-03-02T%02dUTC.html' %
+                                    hour)))
+    board = {'htmlcachedir': str(tmpdir)}
+    # As if an earlier backfill got halfway
+    wbstatus.parse_workboard_file(
+        str(tmpdir.join('workboard-2015-03-02T01UTC.html')))
+    assert wbstatus.backfill_snapshots(board, 2) == 3
+    assert len(tmpdir.listdir('*.json')) == 4
+    assert wbstatus.backfill_snapshots(board, 2) == 0
+
+
+def test_unchanged_tasks(tmpdir):
+    import datetime
+    from dateutil import tz
+    config = get_fake_config()
+    phidstore = wbstatus.PhidStore()
+    records = get_fake_records(phidstore)
+    records.append(wbstatus.REASSIGN, 1500300000,
+                   phidstore.add('PHID-USER-blahblahblah'), None,
+                   phidstore.add('PHID-USER-assignee'))
+    history = wbstatus.TaskHistory(records, config, phidstore)
+    start = datetime.datetime.fromtimestamp(1500400001, tz.tzutc())
+    end = start + datetime.timedelta(days=1)
+    since = 1500400001
+    # Past the last transaction, the summary is as good as the history
+    assert wbstatus.taskstate_from_summary(
+        history.summary(phidstore), phidstore) == history.state(start, end)
+
+    eventstore = wbstatus.EventStore(str(tmpdir.join('events.sqlite')))
+    board = {'teamphid': 'PHID-PROJ-team', 'tasks': set(['1', '2', '3']),
+             'histories': {'1': history, '2': history}}
+    taskstore = wbstatus.TaskStore()
+    taskstore.bytasknum = dict((tasknum, {'dateModified': '1500400000'})
+                               for tasknum in board['tasks'])
+    for tasknum in (1, 2):
+        eventstore.append(tasknum, get_fake_feed())
+    # Task 4's transactions are behind its dateModified, so its summary
+    # would be of an out of date state
+    board['histories']['4'] = history
+    taskstore.bytasknum['4'] = {'dateModified': '1500400500'}
+    eventstore.append(4, get_fake_feed())
+    wbstatus.save_task_summaries([board], taskstore, eventstore, phidstore)
+    assert eventstore.summaries('PHID-PROJ-team', ['4']) == {}
+    # Task 2 has changed since, and task 3 has no summary
+    taskstore.bytasknum['2']['dateModified'] = '1500400500'
+    assert wbstatus.load_unchanged_tasks([board], taskstore, eventstore,
+                                         since, phidstore) == set(['1'])
+    assert board['unchanged'] == {'1': history.state(start, end)}
+    # Nothing is unchanged if the window starts before the last change
+    assert wbstatus.load_unchanged_tasks([board], taskstore, eventstore,
+                                         1500300000, phidstore) == set()
+
+
+def test_day_histories(tmpdir):
+    import datetime
+    config = get_fake_config()
+    phidstore = wbstatus.PhidStore()
+    records = get_fake_records(phidstore)
+    # A reassignment on the stroke of midnight counts for both days
+    records.append(wbstatus.REASSIGN, 1500336000,
+                   phidstore.add('PHID-USER-blahblahblah'), None,
+                   phidstore.add('PHID-USER-assignee'))
+    history = wbstatus.TaskHistory(records, config, phidstore)
+    path = str(tmpdir.join('fragments.sqlite'))
+    board = {'teamphid': 'PHID-PROJ-team', 'tasks': set(['1']),
+             'histories': {'1': history}, 'fragmentcache': path}
+    taskstore = wbstatus.TaskStore()
+    taskstore.bytasknum = {'1': {'dateModified': '1500400000'}}
+    first = 1499990400
+    wbstatus.save_day_histories([board], taskstore, phidstore,
+                                first + 3600, first + 6 * wbstatus.DAY + 5)
+
+    def day(n):
+        return wbstatus.EPOCH + datetime.timedelta(
+            seconds=first + n * wbstatus.DAY)
+    # Any window of whole days, including those after the last day
+    # stored, comes out the same as from the transactions
+    intervals = [(day(a), day(b)) for a in range(9) for b in range(a + 1, 10)]
+    board = {'teamphid': 'PHID-PROJ-team', 'tasks': set(['1']),
+             'fragmentcache': path}
+    assert wbstatus.load_day_histories([board], taskstore, intervals,
+                                       phidstore) == set(['1'])
+    for start, end in intervals:
+        assert board['dayhistories']['1'].state(start, end) == \
+            history.state(start, end)
+    # Not for windows starting before the first day, or not on midnight
+    for start, end in ((day(-1), day(1)),
+                       (day(1) + datetime.timedelta(hours=1), day(2))):
+        assert wbstatus.load_day_histories([board], taskstore, [(start, end)],
+                                           phidstore) == set()
+    # Nor past when the dateModified is known to be current as of
+    assert wbstatus.load_day_histories([board], taskstore, [(day(6), day(9))],
+                                       phidstore, first + 8 * wbstatus.DAY) \
+        == set()
+    assert wbstatus.load_day_histories([board], taskstore, [(day(6), day(8))],
+                                       phidstore, first + 8 * wbstatus.DAY) \
+        == set(['1'])
+    # Nor once the task has changed
+    taskstore.bytasknum['1']['dateModified'] = '1500500000'
+    assert wbstatus.load_day_histories([board], taskstore, intervals,
+                                       phidstore) == set()
+
+
+def test_flow_metrics(tmpdir):
+    import csv
+    import datetime
+    from dateutil import tz
+    day = 24 * 60 * 60
+    team = 'PHID-PROJ-team'
+    user = 'PHID-USER-x'
+    board = get_fake_config()
+    board.update({'teamphid': team, 'team': {user: {'userName': 'x'}}})
+    columns = board['workboard_state_phids']
+
+    def tact(when, ttype, old, new):
+        return {'transactionType': ttype, 'dateCreated': str(when),
+                'authorPHID': user, 'oldValue': old, 'newValue': new}
+
+    def column(when, old, new):
+        return tact(when, 'projectcolumn',
+                    {'projectPHID': team,
+                     'columnPHIDs': {'0': columns[old]} if old else []},
+                    {'projectPHID': team, 'columnPHIDs': [columns[new]]})
+    feed = [tact(0, 'title', None, 'A task'), column(day, None, 'todo'),
+            column(2 * day, 'todo', 'indev'),
+            tact(2 * day, 'reassign', None, user),
+            column(5 * day, 'indev', 'done')]
+    phidstore = wbstatus.PhidStore()
+    phidstore.seed(board['team'])
+    board['transactions'] = {
+        '1': wbstatus.get_filtered_transactions_for_task(feed, phidstore,
+                                                         team)}
+    samples = wbstatus.get_flow_samples(board, 0, 7 * day, phidstore)
+    userid = phidstore.add(user)
+    assert list(samples[('user', userid)]['cycle time']) == [3 * day]
+    assert list(samples[('user', userid)]['lead time']) == [5 * day]
+    assert list(samples[('board', None)]['time in column']) == \
+        [day, 3 * day]
+    assert list(samples[('column', phidstore.add(columns['indev']))][
+        'time in column']) == [3 * day]
+    # Nothing finished in a period that ends before the task did
+    assert not wbstatus.get_flow_samples(board, 0, 4 * day, phidstore)[
+        ('board', None)]['completed']
+
+    path = str(tmpdir.join('flow.csv'))
+    start = datetime.datetime.fromtimestamp(0, tz.tzutc())
+    end = datetime.datetime.fromtimestamp(14 * day, tz.tzutc())
+    board['name'] = u'Caf\xe9'
+    wbstatus.write_flow_metrics([board], start, end, phidstore, path)
+    with open(path) as fh:
+        rows = list(csv.DictReader(fh))
+    assert rows[0]['board'].decode('utf-8') == u'Caf\xe9'
+    completed = [row for row in rows if row['scope'] == 'user' and
+                 row['metric'] == 'completed']
+    assert completed[0]['name'] == 'x'
+    assert completed[0]['per week'] == '0.50'
+    cycle = [row for row in rows if row['scope'] == 'board' and
+             row['metric'] == 'cycle time']
+    assert cycle[0]['median days'] == '3.00'
+
+
+def test_offline(tmpdir, monkeypatch):
+    import os
+    import pytest
+    import subprocess
+    import sys
+    # Nothing needs phabricator, or the modules only some runs use, just to
+    # start up
+    assert subprocess.check_output([
+        sys.executable, '-c', 'import sys, wbstatus; print [m for m in '
+        '("phabricator", "BaseHTTPServer", "SocketServer", "cProfile", '
+        '"csv", "httplib", "multiprocessing", "sqlite3") '
+        'if m in sys.modules]'],
+        cwd=os.path.dirname(os.path.abspath(wbstatus.__file__))) == '[]\n'
+
+    phab = FakePhab({'phid.query': lambda phids: dict(
+        (phid, {'name': phid.lower()}) for phid in phids)})
+    built = []
+    monkeypatch.setattr(wbstatus, 'get_phab',
+                        lambda config: built.append(config) or phab)
+    config = {'cachedir': str(tmpdir), 'cache_ttl': {'phid.query': -1}}
+    fetcher = wbstatus.get_fetcher(config)
+    assert fetcher.call('phid.query', 'phids', ['PHID-USER-a']) == \
+        {'PHID-USER-a': {'name': 'phid-user-a'}}
+    fetcher.close()
+    assert len(built) == 1
+
+    # Offline, the (expired) cache entry still does, and the client is
+    # never built; anything not in the cache is an error
+    config['offline'] = True
+    fetcher = wbstatus.get_fetcher(config)
+    assert fetcher.call('phid.query', 'phids', ['PHID-USER-a']) == \
+        {'PHID-USER-a': {'name': 'phid-user-a'}}
+    with pytest.raises(wbstatus.OfflineError):
+        fetcher.call('phid.query', 'phids', ['PHID-USER-b'])
+    fetcher.close()
+    assert len(built) == 1 and len(phab.calls) == 1
+
+
+def test_conduit_scheduler():
+    import threading
+    import time
+    scheduler = wbstatus.ConduitScheduler(1)
+    # With the one slot taken, waiting calls go in priority order
+    scheduler.acquire(0)
+    order = []
+
+    def call(priority):
+        scheduler.acquire(priority)
+        order.append(priority)
+        scheduler.release(0)
+    threads = []
+    for priority in (2, 0, 1):
+        threads.append(threading.Thread(target=call, args=(priority,)))
+        threads[-1].start()
+        while len(scheduler.waiting) < len(threads):
+            time.sleep(0.01)
+    scheduler.release(0)
+    for thread in threads:
+        thread.join()
+    assert order == [0, 1, 2]
+
+    # The limit grows while calls go fine, and halves when they don't
+    scheduler = wbstatus.ConduitScheduler(1, 4)
+    for i in range(20):
+        scheduler.acquire(0)
+        scheduler.release(0)
+    assert scheduler.limit == 4
+    scheduler.acquire(0)
+    scheduler.release(0, failed=True)
+    assert scheduler.limit == 2
+    scheduler.slow = 1
+    scheduler.acquire(0)
+    scheduler.release(5)
+    assert scheduler.limit == 1
+
+    # Past the burst, calls are paced at the rate
+    scheduler = wbstatus.ConduitScheduler(4, rate=50, burst=2)
+    began = time.time()
+    for i in range(7):
+        scheduler.acquire(0)
+        scheduler.release(0)
+    assert time.time() - began >= 0.09
+
+
+def test_user_index(tmpdir, monkeypatch, capsys):
+    import benchmark
+    import datetime
+    import json
+    import sys
+    board = benchmark.SyntheticBoard(tasks=40, users=5, transactions=10,
+                                     days=30)
+    phab = FakePhab(dict(
+        (method, benchmark.SyntheticConduit(board, method))
+        for method in ('maniphest.gettasktransactions', 'maniphest.query',
+                       'phid.query')))
+    monkeypatch.setattr(wbstatus, 'get_phab', lambda config: phab)
+    argv = benchmark.end_to_end_arguments(board, str(tmpdir))
+    config = board.config
+    config['htmlcachedir'] = str(tmpdir)
+    config['userindex'] = str(tmpdir.join('users.sqlite'))
+    indexed = str(tmpdir.join('indexed.json'))
+    with open(indexed, 'w') as fh:
+        json.dump(config, fh)
+
+    def run(*args):
+        monkeypatch.setattr(sys, 'argv', ['wbstatus.py'] + argv +
+                            list(args))
+        wbstatus.main()
+        return capsys.readouterr()[0]
+    run('--config', indexed)
+    calls = len(phab.calls)
+    reports = 0
+    for i, phid in enumerate(board.users):
+        # Straight from the index, without fetching anything, and the same
+        # as the report from the whole works
+        report = run('--config', indexed, '--user', phid)
+        assert len(phab.calls) == calls
+        assert report == run('--user', 'user%d' % i)
+        calls = len(phab.calls)
+        reports += "<li class='userentry'>" in report
+    assert reports
+
+    # Windows whose data stopped short of their end are only used while
+    # there's nothing newer to be had; past that it's the whole works
+    # again, which brings them up to date
+    userindex = wbstatus.UserIndex(config['userindex'])
+    first, last = userindex.db.execute(
+        'SELECT start, end FROM windows').fetchone()
+    assert userindex.has(board.teamphid, first, last, last + 1)
+    with userindex.db:
+        userindex.db.execute('UPDATE windows SET built = ?', (last - 1,))
+    assert userindex.has(board.teamphid, first, last, last - 1)
+    assert not userindex.has(board.teamphid, first, last, last + 1)
+    report = run('--config', indexed, '--user', board.users[0])
+    assert len(phab.calls) > calls
+    calls = len(phab.calls)
+    assert run('--config', indexed, '--user', board.users[0]) == report
+    assert len(phab.calls) == calls
+
+    # The server keeps its index in memory
+    state = wbstatus.ReportState(config)
+    start = board.end - datetime.timedelta(days=1)
+    full = state.report(start, board.end)
+    assert (start, board.end) in state.boards[0]['indexes']
+    for i, phid in enumerate(board.users):
+        report = state.report(start, board.end, user='user%d' % i)
+        if "<li class='userentry'>" in report:
+            assert report[report.find("<li class='userentry'>"):
+                          report.rfind('</li>') + 5] in full
+
+
+def test_first_interned_column():
+    # Interned ids are all true, so the first PHID interned (here a
+    # column) isn't mistaken for no column at all
+    phidstore = wbstatus.PhidStore()
+    first = phidstore.add('PHID-PCOL-first')
+    assert first
+    other = phidstore.add('PHID-PCOL-other')
+    for phid in ('PHID-PCOL-first', 'PHID-PCOL-other'):
+        phidstore.query[phid] = {'name': phid[10:]}
+    actor = phidstore.get_user('PHID-USER-a')
+    actor.tasks = ['1']
+    taskstate = {'1': {'assignee': {'start': actor.id, 'end': actor.id},
+                       'column': {'start': first, 'end': other},
+                       'status': {'start': 'open', 'end': 'open'},
+                       'actorset': set([actor.id])}}
+    taskstore = wbstatus.TaskStore()
+    taskstore.bytasknum = {'1': {'title': 'One'}}
+    wbstate = phidstore.add_map(get_fake_config()['workboard_state_phids'])
+    assert wbstatus.get_actor_tasks(actor, phidstore, taskstate, wbstate,
+                                    taskstore) == \
+        [('1', 'One', [('taskstatus', 'first -> other')])]
@@ -15,25 +15,159 @@
 # limitations under the License.
 
 
+from array import array
 import argparse
-from bs4 import BeautifulSoup
+import bisect
+import codecs
+import collections
+import contextlib
 from xml.sax.saxutils import escape
 import datetime
 import dateutil.parser
+import errno
+import hashlib
+import heapq
+from HTMLParser import HTMLParser
+import importlib
+import itertools
 import json
 import os
-import phabricator
-import pickle
+import Queue
+import random
+import re
+import socket
 import string
+from StringIO import StringIO
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import zlib
+
+
+class LazyModule(object):
+    """Stand-in for a module that only gets imported the first time one of
+    its attributes is used.  Importing phabricator (which loads its whole
+    interface spec) takes most of our startup time, and a run answered
+    entirely from the cache, or a --backfill, never needs it.  The same
+    goes for the standard modules only some runs use: the HTTP ones for
+    talking to Conduit, multiprocessing for --backfill, sqlite3 for the
+    optional stores, and so on.  Setting an attribute sets it on the real
+    module.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+
+phabricator = LazyModule('phabricator')
+cProfile = LazyModule('cProfile')
+csv = LazyModule('csv')
+httplib = LazyModule('httplib')
+multiprocessing = LazyModule('multiprocessing')
+sqlite3 = LazyModule('sqlite3')
+urlparse = LazyModule('urlparse')
+
+
+# How long (in seconds) a cached Conduit response stays fresh, by method.
+# Transactions change all the time, titles now and then, and PHID names
+# almost never.  Override with "cache_ttl" in the config file.  A task's
+# transactions can change without the call asking for them changing, so
+# their entries only last long enough for reruns (e.g. with another
+# --step or --format) to hit them; what a daily run saves comes from the
+# titles and names, and from the eventstore and fragmentcache skipping
+# tasks that haven't been modified.  Backfilling old reports from a
+# stable set of transactions is the time to raise it.
+DEFAULT_CACHE_TTLS = {
+    'maniphest.gettasktransactions': 60 * 60,
+    'maniphest.query': 6 * 60 * 60,
+    'phid.query': 7 * 24 * 60 * 60,
+}
+DEFAULT_CACHE_MAXBYTES = 256 * 1024 * 1024
+
+# User and column names rarely change, so names in the PHID registry are
+# only looked up again after this many seconds ("phid_refresh_age").
+DEFAULT_PHID_REFRESH_AGE = 30 * 24 * 60 * 60
+
+# A workboard snapshot stands in for a later time only if it's at most
+# this many seconds older ("snapshot_max_age", null for no limit); past
+# that, the scrape cron was likely down and the report would be wrong.
+DEFAULT_SNAPSHOT_MAX_AGE = 24 * 60 * 60
+
+# Conduit calls with big id/PHID lists time out or hit response size
+# limits, so they're split into chunks of at most this many items.
+# Override with "fetch": {"chunksize": {...}} in the config file, along
+# with "workers", "retries" and "backoff" (seconds, doubled per retry),
+# and the ConduitScheduler's "max_workers", "rate" (calls a second, or
+# null for no limit), "burst" and "slow" (seconds).
+DEFAULT_CHUNKSIZES = {
+    'maniphest.gettasktransactions': 50,
+    'maniphest.query': 100,
+    'phid.query': 200,
+}
+DEFAULT_FETCH_OPTIONS = {
+    'workers': 4,
+    'max_workers': 8,
+    'retries': 3,
+    'backoff': 1.0,
+    'rate': None,
+    'burst': None,
+    'slow': 10.0,
+}
+
+# Order in which waiting Conduit calls go out, lowest first: everything
+# else waits on the transactions, whereas titles and names are only
+# needed once it comes to rendering.
+CALL_PRIORITIES = {
+    'maniphest.gettasktransactions': 0,
+    'maniphest.query': 1,
+    'phid.query': 2,
+}
+
+# The only transaction types get_filtered_transactions_for_task cares
+# about.  TransactionLogs refer to them by their index in this tuple.
+TRANSACTION_TYPES = ('status', 'title', 'reassign', 'projectcolumn')
+STATUS, TITLE, REASSIGN, PROJECTCOLUMN = range(len(TRANSACTION_TYPES))
+TRANSACTION_CODES = dict((ttype, code)
+                         for code, ttype in enumerate(TRANSACTION_TYPES))
+# The EventStore also keeps edge transactions, which is how BoardHistory
+# sees tasks being added to and removed from projects.
+STORED_TRANSACTION_TYPES = TRANSACTION_TYPES + ('core:edge',)
+# Statuses that take a task off the workboard
+CLOSED_STATUSES = ('resolved', 'wontfix', 'invalid', 'duplicate',
+                   'declined', 'spite')
+
+# How often (in seconds) the report server refetches the tasks it knows
+# about ("refresh_interval"), and how many rendered reports it keeps.
+DEFAULT_REFRESH_INTERVAL = 15 * 60
+REPORT_CACHE_SIZE = 64
+
+# How many users of a window are rendered at a time ("render_workers").
+# Rendering is pure Python, so under the GIL more threads hardly speed it
+# up; raise it only if a report writer spends its time waiting on I/O.
+DEFAULT_RENDER_WORKERS = 1
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Generate a summary ' +
         'of Phabricator workboard activity for a given time period')
-    parser.add_argument('--use-buggy-cache',
-                        help='Overly aggressive cache that should ' +
-                        'only be used for development purposes',
+    parser.add_argument('--no-cache',
+                        help='Ignore the Conduit response cache ' +
+                        'and fetch everything from Phabricator',
                         action='store_true')
     parser.add_argument('--start', help='Start of the interval for ' +
                         'the generated summary.  Default: 24 hours ' +
@@ -41,8 +175,72 @@ def parse_arguments():
     parser.add_argument('--end', help='End of the interval for ' +
                         'the generated summary.  Default: midnight at' +
                         ' start of today.')
+    parser.add_argument('--step', help='Split the interval into ' +
+                        'windows of this length (e.g. "1d", "12h" ' +
+                        'or "1w") and report on each of them.')
     parser.add_argument('--config', help='Location of the config ' +
                         'file.', default='wbstatus-config.json')
+    parser.add_argument('--profile', help='Print a summary of where ' +
+                        'the time went to stderr', action='store_true')
+    parser.add_argument('--metrics-out', help='Write stage timings and ' +
+                        'Conduit call metrics to this file as JSON')
+    parser.add_argument('--cprofile-out', help='Write cProfile stats ' +
+                        'for the filtering, task state and rendering ' +
+                        'loops to this file')
+    parser.add_argument('--format', help='Write the report as HTML ' +
+                        '(the default) or as JSON',
+                        choices=sorted(REPORT_WRITERS), default='html')
+    parser.add_argument('--flow-metrics', help='Also write cycle ' +
+                        'time, lead time, throughput and time in column ' +
+                        'per board, column and user over the whole of ' +
+                        '--start to --end to this file, as CSV')
+    parser.add_argument('--record-conduit', help='Append every ' +
+                        'Conduit call made (that misses the cache) to ' +
+                        'this file, for --replay-conduit')
+    parser.add_argument('--replay-conduit', help='Answer Conduit calls ' +
+                        'from a file written by --record-conduit rather ' +
+                        'than from Phabricator')
+    parser.add_argument('--replay-latency', help='With ' +
+                        '--replay-conduit, make each call take this many ' +
+                        'seconds', type=float)
+    parser.add_argument('--replay-errors', help='With ' +
+                        '--replay-conduit, make this fraction (0 to 1) ' +
+                        'of calls fail', type=float)
+    parser.add_argument('--replay-scale', help='With ' +
+                        '--replay-conduit, repeat each list in the ' +
+                        'responses (i.e. the transactions) this many ' +
+                        'times', type=int)
+    parser.add_argument('--backfill', help='Parse all of the ' +
+                        'workboard HTML in htmlcachedir that has not ' +
+                        'been parsed yet, into sidecars or the ' +
+                        'snapshotstore, then exit.  An interrupted ' +
+                        'backfill carries on where it left off.',
+                        action='store_true')
+    parser.add_argument('--jobs', help='Number of processes for ' +
+                        '--backfill.  Default: one per CPU', type=int)
+    parser.add_argument('--prune-imported', help='With --backfill ' +
+                        'and a snapshotstore, delete each HTML file (and ' +
+                        'its sidecar) once it is in the store',
+                        action='store_true')
+    parser.add_argument('--serve', help='Rather than printing one ' +
+                        'report, keep everything in memory and serve ' +
+                        'reports over HTTP on this port, e.g. ' +
+                        '/?start=2015-03-01&end=2015-03-08&step=1d',
+                        type=int)
+    parser.add_argument('--bind', help='Address for --serve to listen ' +
+                        'on.  Default: 127.0.0.1', default='127.0.0.1')
+    parser.add_argument('--refresh-interval', help='Seconds between ' +
+                        'background refreshes with --serve.  Default: ' +
+                        str(DEFAULT_REFRESH_INTERVAL), type=int)
+    parser.add_argument('--user', help='Only report on this member ' +
+                        'of the team (their userName or PHID).  With a ' +
+                        '"userindex" that has the windows asked for, the ' +
+                        'report comes straight from the index')
+    parser.add_argument('--offline', help='Never contact Phabricator: ' +
+                        'render only from the response cache (however ' +
+                        'old), the PHID registry and the snapshots, and ' +
+                        'fail if anything is missing from them',
+                        action='store_true')
     return parser.parse_args()
 
 
@@ -55,22 +253,111 @@ def get_config():
     with open(args.config) as fh:
         config = json.load(fh)
 
-    if args.end:
-        config['end'] = dateutil.parser.parse(args.end)
+    config['start'], config['end'] = get_window(args.start, args.end)
+    config['intervals'] = get_intervals(config['start'], config['end'],
+                                        args.step)
+
+    if args.no_cache:
+        config['cachedir'] = None
+
+    config['profile'] = args.profile
+    config['metrics_out'] = args.metrics_out
+    config['cprofile_out'] = args.cprofile_out
+    config['flow_metrics'] = args.flow_metrics
+    config['format'] = args.format
+    for option in ('record_conduit', 'replay_conduit', 'replay_latency',
+                   'replay_errors', 'replay_scale'):
+        if getattr(args, option) is not None:
+            config[option] = getattr(args, option)
+    config['offline'] = args.offline
+    config['user'] = args.user
+    config['backfill'] = args.backfill
+    config['jobs'] = args.jobs
+    config['prune_imported'] = args.prune_imported
+    config['serve'] = args.serve
+    config['bind'] = args.bind
+    if args.refresh_interval:
+        config['refresh_interval'] = args.refresh_interval
+
+    return config
+
+
+def get_window(start=None, end=None):
+    """Parse the start and end of the report (strings, or None for the
+    defaults: midnight at the start of today for the end, and 24 hours
+    before the end for the start) into datetimes.  Times without a
+    timezone are taken to be UTC.
+    """
+    if end:
+        end = parse_time(end)
     else:
         now = datetime.datetime.utcnow()
-        config['end'] = datetime.datetime(now.year, now.month, now.day,
-                                          0, 0, 0, tzinfo=dateutil.tz.tzutc())
+        end = datetime.datetime(now.year, now.month, now.day,
+                                0, 0, 0, tzinfo=dateutil.tz.tzutc())
 
-    if args.start:
-        config['start'] = dateutil.parser.parse(args.start)
+    if start:
+        start = parse_time(start)
     else:
-        config['start'] = config['end'] - datetime.timedelta(days=1)
+        start = end - datetime.timedelta(days=1)
+    return start, end
 
-    if not args.use_buggy_cache:
-        config['cachedir'] = None
 
-    return config
+def parse_time(value):
+    """Parse a date or time string into a datetime, in UTC unless it says
+    otherwise.
+    """
+    parsed = dateutil.parser.parse(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dateutil.tz.tzutc())
+    return parsed
+
+
+def parse_step(step):
+    """Turn a --step value like "1d", "12h" or "2w" into a timedelta."""
+    units = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+    try:
+        delta = datetime.timedelta(**{units[step[-1]]: int(step[:-1])})
+    except (KeyError, ValueError):
+        delta = None
+    if not delta or delta < datetime.timedelta(0):
+        raise ValueError('Invalid step: {}'.format(step))
+    return delta
+
+
+def get_intervals(start, end, step=None):
+    """Return the list of (start, end) windows to report on: just the one
+    window without a step, otherwise consecutive windows of length "step"
+    covering start to end, the last cut short at end if step doesn't
+    divide it evenly.  Raises ValueError if end isn't after start.
+    """
+    if end <= start:
+        raise ValueError('Empty window: {} to {}'.format(start, end))
+    if not step:
+        return [(start, end)]
+    step = parse_step(step)
+    intervals = []
+    while start < end:
+        intervals.append((start, min(start + step, end)))
+        start += step
+    return intervals
+
+
+def get_boards(config):
+    """Return the list of boards to report on.  Normally that's just the
+    config itself, but the config can instead have a "boards" list, each
+    entry overriding "teamphid", "team", "workboard_state_phids",
+    "htmlcachedir" and "snapshotstore" (plus a "name" for the report) for
+    one board.  A board with a "snapshotstore" gets its workboards from
+    there (see SnapshotStore); one with neither that nor an "htmlcachedir"
+    has them rebuilt from transactions (see BoardHistory).
+    """
+    boards = []
+    for override in config.get('boards') or [{}]:
+        board = dict(config)
+        board.pop('boards', None)
+        board.update(override)
+        boards.append(board)
+    return boards
 
 
 class PhidStore(object):
@@ -78,34 +365,95 @@ class PhidStore(object):
     of PHIDs so that we only need to make one call to Phabricator.phid.query
     to lookup a big batch of PHIDs, rather than making dozens/hundreds of
     calls to look them up one at a time.
+
+    PHIDs are also interned: add() hands back a small int standing in for
+    the PHID, which is what TransactionLogs and task state hold, and
+    lookup() turns it back into the PHID.  The ints start at 1, so that
+    they're all true, like the PHIDs they stand in for.
+
+    If given a registry path, names are kept in a persistent JSON registry
+    and phid.query is only asked about PHIDs that aren't in the registry or
+    were last looked up more than refresh_age seconds ago.
     """
 
-    def __init__(self):
-        self.phids = set()
+    def __init__(self, registrypath=None,
+                 refresh_age=DEFAULT_PHID_REFRESH_AGE):
+        self.phids = {}
+        self.phidlist = [None]
         self.users = {}
+        self.registrypath = registrypath
+        self.refresh_age = refresh_age
+        self.query = {}
+        if registrypath:
+            try:
+                with open(registrypath) as fh:
+                    self.query = json.load(fh)
+            except (IOError, ValueError):
+                pass
 
     def add(self, phid):
-        self.phids.add(phid)
+        retval = self.phids.get(phid)
+        if retval is None:
+            retval = self.phids[phid] = len(self.phidlist)
+            self.phidlist.append(phid)
+        return retval
+
+    def add_map(self, phidmap):
+        """Return a copy of phidmap with each PHID value interned."""
+        return dict((key, self.add(phid))
+                    for key, phid in phidmap.iteritems())
+
+    def lookup(self, phid):
+        """Return the PHID for an interned id (PHIDs pass straight through)."""
+        if isinstance(phid, (int, long)):
+            return self.phidlist[phid]
+        return phid
+
+    def seed(self, team):
+        """Add the names from the "team" block of the config, which we
+        already know without asking Phabricator.
+        """
+        now = time.time()
+        for phid, member in team.iteritems():
+            self.query[phid] = {'name': member['userName'], 'fetched': now}
 
-    def load_from_phabricator(self, phab, cachedir):
-        self.query = call_phab_via_cache(
-            cachedir, "phidquery",
-            lambda: phab.phid.query(phids=list(self.phids)))
+    def load_from_phabricator(self, fetcher):
+        cutoff = time.time() - self.refresh_age
+        unknown = [phid for phid in self.phids if phid not in self.query or
+                   self.query[phid].get('fetched', 0) < cutoff]
+        result = fetcher.call('phid.query', 'phids', unknown)
+        now = time.time()
+        for phid, info in result.iteritems():
+            self.query[phid] = {'name': info['name'], 'fetched': now}
+        if self.registrypath:
+            write_atomically(self.registrypath, json.dumps(self.query))
 
     def name(self, phid):
         try:
-            return self.query[phid]['name']
+            return self.query[self.lookup(phid)]['name']
         except KeyError:
             return None
 
     def get_user(self, phid):
+        phid = self.lookup(phid)
         retval = self.users.get(phid)
         if not retval:
             retval = self.users[phid] = User(phid)
+            retval.id = self.add(phid)
             retval.phidstore = self
         return retval
 
 
+def get_phid_refresh_age(config):
+    """How old a name in the PHID registry can get before it's looked up
+    again ("phid_refresh_age").  Offline, only names the registry doesn't
+    have at all get looked up (from the cache).
+    """
+    if config.get('offline'):
+        return float('inf')
+    return config.get('phid_refresh_age', DEFAULT_PHID_REFRESH_AGE)
+
+
 class TaskStore(object):
     """The TaskStore is a wrapper around the Phabricator manifest.query API
     call, so this object indexes the result by task number.  This is necessary
@@ -115,12 +463,15 @@ class TaskStore(object):
 
     def __init__(self, tasknums=set()):
         self.tasknums = tasknums
-
-    def load_from_phabricator(self, phab, cachedir):
-        self.query = call_phab_via_cache(
-            cachedir, "taskquery",
-            lambda: phab.maniphest.query(ids=self.tasknums))
         self.bytasknum = {}
+
+    def load_from_phabricator(self, fetcher, fresh=False):
+        """Look the tasks up, straight from Phabricator if fresh (when
+        their dateModified is going to be trusted) rather than from the
+        cache.
+        """
+        self.query = fetcher.call('maniphest.query', 'ids', self.tasknums,
+                                  fresh=fresh)
         for phid, task in self.query.iteritems():
             self.bytasknum[task['id']] = task
 
@@ -133,6 +484,7 @@ class User(object):
     def __init__(self, phid):
         assert phid
         self.phid = phid
+        self.id = None
         self.tasks = []
         self.phidstore = None
 
@@ -151,158 +503,2141 @@ def parse_workboard_html(wbtime, wbhtmlcache):
     # File name will look something like workboard-2014-12-22T00.html,
     # which corresponds to midnight on 2014-12-22
     filename = 'workboard-{:%Y-%m-%dT%H%Z}.html'.format(wbtime)
-    htmlhandle = open(os.path.join(wbhtmlcache, filename))
-    soup = BeautifulSoup(htmlhandle)
-    columns = soup.find_all(class_="phui-workpanel-view")
-    retval = {}
-    for col in columns:
-        state = col.find(class_="phui-action-header-title").strings.next()
-        objnames = col.find_all(class_="phui-object-item-objname")
-        for objname in objnames:
-            retval[objname.string] = state
-    return retval
+    return parse_workboard_file(os.path.join(wbhtmlcache, filename))
+
+
+def parse_workboard_file(htmlpath):
+    """Return the task->column dict for the workboard HTML in htmlpath.  The
+    result is saved in a JSON sidecar file next to the HTML (htmlpath +
+    ".json"), so any given snapshot only gets parsed once; the sidecar is
+    ignored if it's older than the HTML.
+    """
+    sidecar = htmlpath + '.json'
+    try:
+        if has_fresh_sidecar(htmlpath):
+            with open(sidecar) as fh:
+                return json.load(fh)
+    except (IOError, OSError, ValueError):
+        pass
+    parser = WorkboardParser()
+    with codecs.open(htmlpath, encoding='utf-8', errors='replace') as fh:
+        for chunk in iter(lambda: fh.read(64 * 1024), u''):
+            parser.feed(chunk)
+    parser.close()
+    try:
+        write_atomically(sidecar, json.dumps(parser.workboard))
+    except (IOError, OSError):
+        # Read-only snapshot directory; we'll just parse again next time
+        pass
+    return parser.workboard
+
 
+def has_fresh_sidecar(htmlpath):
+    """Whether the HTML in htmlpath has a sidecar at least as new as it."""
+    try:
+        return (os.path.getmtime(htmlpath + '.json') >=
+                os.path.getmtime(htmlpath))
+    except OSError:
+        return False
+
+
+class WorkboardParser(HTMLParser):
+    """Streaming (SAX-style) parser for workboard HTML.  Rather than building
+    a tree of the whole multi-megabyte page, it just watches for the handful
+    of elements we need: the "phui-workpanel-view" columns, the first bit of
+    text in each column's "phui-action-header-title", and the task numbers in
+    the "phui-object-item-objname" elements.  The result ends up in
+    self.workboard, mapping task number (e.g. "T1234") to column title.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.workboard = {}
+        self.column_tag = None
+        self.column_depth = 0
+        self.state = None
+        self.capture = None
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if self.capture == 'title' and self.text:
+            # Only the first string in the title is the column name; the
+            # rest is subtitle.
+            self.end_capture()
+        classes = (dict(attrs).get('class') or '').split()
+        if self.column_tag:
+            if tag == self.column_tag:
+                self.column_depth += 1
+            if ('phui-action-header-title' in classes and
+                    self.state is None):
+                self.start_capture('title')
+            elif 'phui-object-item-objname' in classes:
+                self.start_capture('objname')
+        elif 'phui-workpanel-view' in classes:
+            self.column_tag = tag
+            self.column_depth = 1
+            self.state = None
+
+    def handle_endtag(self, tag):
+        if self.capture:
+            self.end_capture()
+        if tag == self.column_tag:
+            self.column_depth -= 1
+            if not self.column_depth:
+                self.column_tag = None
+
+    def handle_data(self, data):
+        if self.capture:
+            self.text.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&{};'.format(name)))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#{};'.format(name)))
+
+    def start_capture(self, what):
+        self.capture = what
+        self.text = []
+
+    def end_capture(self):
+        text = u''.join(self.text)
+        if self.capture == 'title':
+            self.state = text
+        elif self.capture == 'objname':
+            self.workboard[text] = self.state
+        self.capture = None
+
+
+def write_atomically(path, data):
+    """Write data to path such that readers never see a partial file."""
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.rename(tmppath, path)
+    finally:
+        # Already gone if the rename went through
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+
+
+class SnapshotStore(object):
+    """SQLite store of workboard snapshots, indexed by time, so that a
+    lookup returns the latest snapshot at or before the time asked for
+    rather than needing a scrape from that exact hour.  Only the parsed
+    task->column dict is kept, as zlib-compressed JSON, and identical ones
+    (which most hourly scrapes are) are stored once, keyed by the sha1 of
+    the JSON.  With keep_html the scraped HTML is kept too, compressed and
+    deduplicated the same way.  Safe to share between threads.
+    """
+
+    def __init__(self, path, keep_html=False):
+        self.keep_html = keep_html
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                timestamp INTEGER PRIMARY KEY,
+                hash TEXT NOT NULL,
+                htmlhash TEXT
+            );
+            CREATE TABLE IF NOT EXISTS workboards (
+                hash TEXT PRIMARY KEY,
+                data BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS html (
+                hash TEXT PRIMARY KEY,
+                data BLOB NOT NULL
+            );
+        """)
+
+    def add(self, timestamp, workboard, html=None):
+        """Store workboard (and html, if keeping HTML) as the snapshot
+        taken at timestamp (epoch seconds), replacing any snapshot already
+        stored for that time.
+        """
+        data = json.dumps(workboard, sort_keys=True, separators=(',', ':'))
+        digest = hashlib.sha1(data).hexdigest()
+        htmldigest = None
+        with self.lock, self.db:
+            self.db.execute('INSERT OR IGNORE INTO workboards VALUES (?, ?)',
+                            (digest, buffer(zlib.compress(data))))
+            if html is not None and self.keep_html:
+                html = html.encode('utf-8')
+                htmldigest = hashlib.sha1(html).hexdigest()
+                self.db.execute('INSERT OR IGNORE INTO html VALUES (?, ?)',
+                                (htmldigest, buffer(zlib.compress(html))))
+            self.db.execute(
+                'INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)',
+                (int(timestamp), digest, htmldigest))
+
+    def has(self, timestamp):
+        with self.lock:
+            return self.db.execute(
+                'SELECT 1 FROM snapshots WHERE timestamp = ?',
+                (int(timestamp),)).fetchone() is not None
+
+    def at(self, timestamp, max_age=None):
+        """Return the task->column dict of the latest snapshot taken at or
+        before timestamp (epoch seconds), and no more than max_age seconds
+        before it if given.  Raises IOError if there isn't one.
+        """
+        oldest = -1 if max_age is None else timestamp - max_age
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data FROM snapshots JOIN workboards USING (hash) '
+                'WHERE timestamp <= ? AND timestamp >= ? '
+                'ORDER BY timestamp DESC LIMIT 1',
+                (int(timestamp), oldest)).fetchone()
+        if row is None:
+            raise IOError(errno.ENOENT, 'No workboard snapshot at or '
+                          'before {}{}'.format(
+                              format_epoch(timestamp, '%Y-%m-%d %H:%M'),
+                              '' if max_age is None else
+                              ' (within {}s)'.format(max_age)))
+        return json.loads(zlib.decompress(row[0]))
+
+    def html_at(self, timestamp):
+        """Return the HTML kept for the snapshot taken exactly at timestamp,
+        or None.
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data FROM snapshots JOIN html ON htmlhash = html.hash '
+                'WHERE timestamp = ?', (int(timestamp),)).fetchone()
+        return zlib.decompress(row[0]).decode('utf-8') if row else None
+
+    def counts(self):
+        """Return the number of snapshots and of distinct workboards."""
+        with self.lock:
+            return tuple(self.db.execute(
+                'SELECT (SELECT COUNT(*) FROM snapshots), '
+                '(SELECT COUNT(*) FROM workboards)').fetchone())
+
+
+def get_snapshotstore(board):
+    """Open the board's SnapshotStore (once; it's kept on the board as
+    "snapshots"), or return None if it doesn't have one configured.
+    """
+    if not board.get('snapshotstore'):
+        return None
+    if 'snapshots' not in board:
+        board['snapshots'] = SnapshotStore(
+            board['snapshotstore'], board.get('snapshot_keep_html', False))
+    return board['snapshots']
+
+
+SNAPSHOT_FILENAME = re.compile(
+    r'^workboard-(\d{4}-\d\d-\d\dT\d\d)([A-Za-z]*)\.html$')
+
+
+def parse_snapshot(job):
+    """Worker for backfill_snapshots: parse one scrape (writing its
+    sidecar), and read its HTML too if it's to be kept.
+    """
+    htmlpath, keep_html = job
+    html = None
+    if keep_html:
+        with codecs.open(htmlpath, encoding='utf-8', errors='replace') as fh:
+            html = fh.read()
+    return htmlpath, parse_workboard_file(htmlpath), html
+
+
+def snapshot_time(filename):
+    """Return the epoch time of a workboard-YYYY-MM-DDTHHZZZ.html scrape,
+    or None if filename isn't one.
+    """
+    match = SNAPSHOT_FILENAME.match(filename)
+    if not match:
+        return None
+    wbtime = parse_time('{}:00 {}'.format(*match.groups()))
+    return (wbtime - EPOCH).total_seconds()
+
+
+def backfill_snapshots(board, jobs=None, prune=False):
+    """Parse every scrape in the board's htmlcachedir that hasn't been parsed
+    yet (that has no fresh sidecar or, with a SnapshotStore, isn't in the
+    store), on a pool of jobs processes (default: one per CPU).  Results
+    are saved as each file finishes, in its sidecar and in the store if
+    there is one, so an interrupted backfill just carries on from where it
+    got to next time.  With prune and a store, each file (and its sidecar)
+    is deleted once it's safely in the store.  Returns the number of
+    scrapes parsed.
+    """
+    store = get_snapshotstore(board)
+    times = {}
+    pending = []
+    for filename in sorted(os.listdir(board['htmlcachedir'])):
+        timestamp = snapshot_time(filename)
+        if timestamp is None:
+            continue
+        htmlpath = os.path.join(board['htmlcachedir'], filename)
+        times[htmlpath] = timestamp
+        if store and not store.has(timestamp):
+            pending.append((htmlpath, store.keep_html))
+        elif not store and not has_fresh_sidecar(htmlpath):
+            pending.append((htmlpath, False))
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(jobs) if jobs > 1 and pending else None
+    try:
+        if pool:
+            results = pool.imap_unordered(parse_snapshot, pending)
+        else:
+            results = (parse_snapshot(job) for job in pending)
+        for htmlpath, workboard, html in results:
+            if store:
+                store.add(times[htmlpath], workboard, html)
+    finally:
+        if pool:
+            pool.terminate()
+    if store and prune:
+        for htmlpath in times:
+            for path in (htmlpath, htmlpath + '.json'):
+                if os.path.exists(path):
+                    os.remove(path)
+    return len(pending)
+
+
+def get_workboards(board, intervals):
+    """Return the set of task numbers (as strings, e.g. "1234") on the board
+    at the start and end of each interval, keyed by time.  They come from
+    the board's SnapshotStore if it has one (see get_snapshot_workboard),
+    otherwise the scrapes in its "htmlcachedir", otherwise its
+    BoardHistory ("history").
+    """
+    workboards = {}
+    for start, end in intervals:
+        for wbtime in (start, end):
+            if wbtime in workboards:
+                continue
+            if board.get('snapshotstore'):
+                workboard = get_snapshot_workboard(board, wbtime)
+                workboards[wbtime] = set(
+                    str(int(string.lstrip(x, "T"))) for x in workboard)
+            elif board.get('htmlcachedir'):
+                workboard = parse_workboard_html(wbtime,
+                                                 board['htmlcachedir'])
+                workboards[wbtime] = set(
+                    str(int(string.lstrip(x, "T"))) for x in workboard)
+            else:
+                workboard = board['history'].board_at(
+                    (wbtime - EPOCH).total_seconds())
+                workboards[wbtime] = set(str(x) for x in workboard)
+    return workboards
+
+
+def get_snapshot_workboard(board, wbtime):
+    """Return the task->column dict for the board at wbtime from its
+    SnapshotStore: the snapshot taken right then, failing that a scrape
+    from then in "htmlcachedir" that hasn't been imported yet, and failing
+    that the latest snapshot at most "snapshot_max_age" seconds older.
+    Raises IOError if there's none of those.
+    """
+    store = get_snapshotstore(board)
+    timestamp = (wbtime - EPOCH).total_seconds()
+    if board.get('htmlcachedir') and not store.has(timestamp):
+        try:
+            return parse_workboard_html(wbtime, board['htmlcachedir'])
+        except (IOError, OSError):
+            pass
+    return store.at(timestamp, board.get('snapshot_max_age',
+                                         DEFAULT_SNAPSHOT_MAX_AGE))
+
+
+class BoardHistory(object):
+    """Which tasks were on a board, and in which column, at any point in
+    time, rebuilt from the tasks' transactions instead of from scraped
+    workboard HTML.  A task is on the board while it's open and in the
+    board's project, i.e. it's been put in one of the board's columns or
+    had the project added, and the project hasn't been removed since.
+
+    The events from all of the tasks are merged into one time-ordered log,
+    and every checkpoint_every events the state of the whole board is
+    saved, so that looking up any time only replays the events since the
+    checkpoint before it.
+    """
+    COLUMN, PROJECT, OPEN = range(3)
+
+    def __init__(self, teamphid, checkpoint_every=1000):
+        self.teamphid = teamphid
+        self.checkpoint_every = checkpoint_every
+        self.feeds = {}
+        self.checkpoints = None
+
+    def set_feed(self, tasknum, taskfeed):
+        """Take the events for task number tasknum from its transactions,
+        replacing whatever we had for it.
+        """
+        events = []
+        for tact in taskfeed:
+            ttype = tact['transactionType']
+            timestamp = int(tact['dateCreated'])
+            if ttype == 'projectcolumn':
+                if tact['newValue']['projectPHID'] == self.teamphid:
+                    events.append((timestamp, self.COLUMN,
+                                   tact['newValue']['columnPHIDs'][0]))
+            elif ttype == 'core:edge':
+                # Old and new edge sets come as lists or as dicts keyed by
+                # PHID; membership tests work the same on both.
+                old = tact['oldValue'] or ()
+                new = tact['newValue'] or ()
+                if (self.teamphid in old) != (self.teamphid in new):
+                    events.append((timestamp, self.PROJECT,
+                                   self.teamphid in new))
+            elif ttype == 'status':
+                events.append((timestamp, self.OPEN,
+                               tact['newValue'] not in CLOSED_STATUSES))
+        events.sort(key=lambda event: event[0])
+        self.feeds[tasknum] = events
+        self.checkpoints = None
+
+    def build(self):
+        """Merge the events into the log and take the checkpoints."""
+        events = sorted(((timestamp, tasknum, kind, value)
+                         for tasknum, taskevents in self.feeds.iteritems()
+                         for timestamp, kind, value in taskevents),
+                        key=lambda event: event[0])
+        self.times = array('l', (event[0] for event in events))
+        self.tasks = array('l', (event[1] for event in events))
+        self.kinds = array('b', (event[2] for event in events))
+        self.values = [event[3] for event in events]
+        self.checkpoints = []
+        state = {}
+        for i in xrange(len(events)):
+            if not i % self.checkpoint_every:
+                self.checkpoints.append(dict(state))
+            self.replay(state, i)
+
+    def replay(self, state, i):
+        """Apply event number i to state (task number -> (column, in
+        project, open)).
+        """
+        tasknum = self.tasks[i]
+        column, member, isopen = state.get(tasknum, (None, False, True))
+        kind = self.kinds[i]
+        if kind == self.COLUMN:
+            column = self.values[i]
+            member = True
+        elif kind == self.PROJECT:
+            member = self.values[i]
+        else:
+            isopen = self.values[i]
+        state[tasknum] = (column, member, isopen)
 
-def get_activity_for_tasks(phab, cachedir, tasknums):
+    def board_at(self, timestamp):
+        """Return the tasks on the board at timestamp (epoch seconds), as a
+        dict of task number to column PHID (None if the task has never been
+        put in a column).
+        """
+        if self.checkpoints is None:
+            self.build()
+        upto = bisect.bisect_right(self.times, timestamp)
+        checkpoint = min(upto // self.checkpoint_every,
+                         len(self.checkpoints) - 1)
+        state = {}
+        if checkpoint >= 0:
+            state.update(self.checkpoints[checkpoint])
+        for i in xrange(max(checkpoint, 0) * self.checkpoint_every, upto):
+            self.replay(state, i)
+        return dict((tasknum, column)
+                    for tasknum, (column, member, isopen)
+                    in state.iteritems() if member and isopen)
+
+
+def discover_board_tasks(fetcher, board, since, fresh=False):
+    """Return the numbers of the tasks in the board's project that could
+    have been on the board at or after since (epoch seconds): the open
+    ones, plus the closed ones modified since then.  Tasks that have since
+    been taken out of the project aren't found this way.  The project is
+    queried a page (of the maniphest.query chunk size) at a time, oldest
+    task first so that tasks modified meanwhile don't shift the pages;
+    with fresh, the pages skip the cache.
+    """
+    size = fetcher.chunksizes['maniphest.query']
+    found = set()
+    offset = 0
+    while True:
+        tasks = fetcher.query('maniphest.query',
+                              {'projectPHIDs': [board['teamphid']],
+                               'status': 'status-any',
+                               'order': 'order-created',
+                               'limit': size, 'offset': offset},
+                              fresh=fresh) or {}
+        found.update(int(task['id']) for task in tasks.itervalues()
+                     if not task.get('isClosed') or
+                     int(task['dateModified']) >= since)
+        if len(tasks) < size:
+            return found
+        offset += size
+
+
+def get_activity_for_tasks(fetcher, tasknums, eventstore=None,
+                           modified=None, fresh=False, stale=()):
     """Pretty much the minimal wrapper around maniphest.gettasktransactions to
-    use the cache.
+    use the cache.  If there's an EventStore, the fetched transactions are
+    appended to it and the result is read back out of the store, so the
+    caller always sees the full (time-ordered) history for each task; see
+    iter_activity_for_tasks for modified, fresh and stale.
     """
-    activity = call_phab_via_cache(
-        cachedir, "gettasktransactions",
-        lambda: phab.maniphest.gettasktransactions(ids=tasknums))
+    activity = {}
+    for chunk in iter_activity_for_tasks(fetcher, tasknums, eventstore,
+                                         modified, fresh, stale):
+        activity.update(chunk)
     return activity
 
 
-def call_phab_via_cache(cachedir, key, apicall):
-    """Really lame overzealous caching implementation that's only currently
-    useful as a developer convenience.  It stores queries to Phabricator based
-    on named token.  Purging is entirely manual, even if the query changes (no
-    signature checking).
+def iter_activity_for_tasks(fetcher, tasknums, eventstore=None,
+                            modified=None, fresh=False, stale=()):
+    """Same as get_activity_for_tasks, but yield the activity one chunk
+    (see ConduitFetcher.iter_call) at a time.  Given each task's
+    dateModified (a dict keyed by task number string, as in
+    TaskStore.bytasknum), tasks whose newest transaction the EventStore
+    already has aren't fetched at all, just read back from the store.
+    Those it's known to be behind on have new transactions that a cached
+    response may well predate, so with fresh they bypass the cache.  So
+    do the tasks in stale, which the caller knows have changed since they
+    were last fetched.
     """
-    if not cachedir:
-        result = apicall()
-    else:
-        print cachedir
-        picklefile = os.path.join(cachedir, key + ".pickle")
+    stale = set(stale)
+    uptodate = []
+    behind = [x for x in tasknums if x in stale]
+    tasknums = [x for x in tasknums if x not in stale]
+    if eventstore and modified:
+        for tasknum in tasknums:
+            highwater = eventstore.highwater(int(tasknum))
+            if highwater is None or str(tasknum) not in modified:
+                continue
+            if highwater >= int(modified[str(tasknum)]):
+                uptodate.append(tasknum)
+            elif fresh:
+                behind.append(tasknum)
+        skipped = set(uptodate) | set(behind)
+        tasknums = [x for x in tasknums if x not in skipped]
+    for chunk, activity in itertools.chain(
+            fetcher.iter_call('maniphest.gettasktransactions', 'ids',
+                              behind, fresh=True),
+            fetcher.iter_call('maniphest.gettasktransactions', 'ids',
+                              tasknums)):
+        if eventstore:
+            for tasknum, taskfeed in activity.iteritems():
+                eventstore.append(int(tasknum), taskfeed)
+            activity = dict((str(tasknum), eventstore.transactions(tasknum))
+                            for tasknum in chunk)
+        yield activity
+    size = fetcher.chunksizes['maniphest.gettasktransactions']
+    for i in xrange(0, len(uptodate), size):
+        yield dict((str(tasknum), eventstore.transactions(int(tasknum)))
+                   for tasknum in uptodate[i:i + size])
+
+
+def stream_activity(boards, fetcher, tasknums, eventstore, phidstore,
+                    modified=None, fresh=False):
+    """Fetch the activity of tasknums a chunk at a time, and boil each
+    chunk down before going on to the next: the tasks' events go into the
+    BoardHistory of each board being rebuilt from transactions that
+    discovered them, and the transactions of each board's tasks get
+    filtered and indexed into the board's TaskHistory objects
+    ("histories").  The raw transactions, and the TransactionLogs, are
+    dropped as soon as that's done, so memory use depends on the chunk
+    size rather than on the number of tasks.  See iter_activity_for_tasks
+    for modified and fresh.  Returns the number of transactions kept.
+    """
+    kept = 0
+    for board in boards:
+        board.setdefault('transactions', {})
+        board.setdefault('histories', {})
+    for activity in iter_activity_for_tasks(fetcher, tasknums, eventstore,
+                                            modified, fresh):
+        for board in boards:
+            if 'history' in board:
+                for tasknum, taskfeed in activity.iteritems():
+                    if int(tasknum) in board['discovered']:
+                        board['history'].set_feed(int(tasknum), taskfeed)
+            kept += filter_board_transactions(board, activity, phidstore)
+            get_histories(board, phidstore)
+            board['transactions'] = {}
+    return kept
+
+
+class EventStore(object):
+    """Persistent SQLite store of task transactions, so that each transaction
+    only ever needs to be processed once.  Every task has a high-water mark
+    (the timestamp of the newest transaction fetched for it); appending a
+    freshly fetched feed only inserts transactions at or after that mark,
+    and a task not modified since needn't be fetched at all.
+    Only the transaction types in STORED_TRANSACTION_TYPES are kept, as the
+    raw Conduit dicts, so that filtering for a particular team still happens
+    in get_filtered_transactions_for_task.  Safe to share between threads.
+
+    It also keeps the final state of each task on each board (see
+    TaskHistory.summary), along with the task's dateModified, so that
+    tasks that haven't changed since needn't be fetched again.
+
+    A store written with a different STORED_TRANSACTION_TYPES lacks the
+    transactions of any newly stored type, so opening it forgets the
+    high-water marks and summaries, and every task's full history gets
+    fetched (and deduplicated against what's there) once more.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                tasknum INTEGER NOT NULL,
+                txid TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (tasknum, txid)
+            );
+            CREATE TABLE IF NOT EXISTS highwater (
+                tasknum INTEGER PRIMARY KEY,
+                timestamp INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS summaries (
+                teamphid TEXT NOT NULL,
+                tasknum INTEGER NOT NULL,
+                modified INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (teamphid, tasknum)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        types = json.dumps(sorted(STORED_TRANSACTION_TYPES))
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'types'").fetchone()
+        if not row or row[0] != types:
+            with self.db:
+                self.db.execute('DELETE FROM highwater')
+                self.db.execute('DELETE FROM summaries')
+                self.db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('types', ?)",
+                    (types,))
+
+    def highwater(self, tasknum):
+        """Timestamp of the newest stored transaction for the task, or None
+        if we've never seen the task.
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT timestamp FROM highwater WHERE tasknum = ?',
+                (tasknum,)).fetchone()
+        return row[0] if row else None
+
+    def append(self, tasknum, taskfeed):
+        """Store the transactions from taskfeed that are newer than what we
+        already have.  Transactions sharing the high-water timestamp are
+        deduplicated by transaction id.  Returns the number stored.
+        """
+        with self.lock:
+            return self._append(tasknum, taskfeed)
+
+    def _append(self, tasknum, taskfeed):
+        hwm = self.highwater(tasknum)
+        rows = []
+        for tact in taskfeed:
+            timestamp = int(tact['dateCreated'])
+            if hwm is not None and timestamp < hwm:
+                continue
+            if tact['transactionType'] not in STORED_TRANSACTION_TYPES:
+                continue
+            txid = tact.get('transactionID') or hashlib.sha1(
+                json.dumps(tact, sort_keys=True)).hexdigest()
+            rows.append((tasknum, txid, timestamp,
+                         json.dumps(tact, separators=(',', ':'))))
+        newest = max([int(t['dateCreated']) for t in taskfeed] +
+                     [hwm or 0])
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO transactions VALUES (?, ?, ?, ?)',
+                rows)
+            stored = self.db.total_changes - before
+            self.db.execute(
+                'INSERT OR REPLACE INTO highwater VALUES (?, ?)',
+                (tasknum, newest))
+        return stored
+
+    def transactions(self, tasknum):
+        """Return the stored transactions for the task, oldest first."""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT data FROM transactions WHERE tasknum = ? '
+                'ORDER BY timestamp, rowid', (tasknum,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def summaries(self, teamphid, tasknums):
+        """Return the stored summaries of the tasks on the board for
+        teamphid, as a dict of task number (a string) to (dateModified,
+        summary).
+        """
+        retval = {}
+        with self.lock:
+            for tasknum in tasknums:
+                row = self.db.execute(
+                    'SELECT modified, data FROM summaries '
+                    'WHERE teamphid = ? AND tasknum = ?',
+                    (teamphid, int(tasknum))).fetchone()
+                if row:
+                    retval[str(tasknum)] = (row[0], json.loads(row[1]))
+        return retval
+
+    def save_summaries(self, teamphid, summaries):
+        """Store (task number, dateModified, summary) tuples for the board
+        for teamphid.
+        """
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?)',
+                ((teamphid, int(tasknum), int(modified),
+                  json.dumps(summary, separators=(',', ':')))
+                 for tasknum, modified, summary in summaries))
+
+
+def get_eventstore(config):
+    """Open the EventStore named in the config, or return None if there
+    isn't one configured.
+    """
+    if not config.get('eventstore'):
+        return None
+    return EventStore(config['eventstore'])
+
+
+class FragmentCache(object):
+    """Persistent SQLite store of the state of each task on each board for
+    each day (see get_daystates), so that a report over a longer window
+    can be put together from the days already worked out instead of from
+    the transactions.  For each task it also keeps the span of days stored
+    ("first" up to "upto", in epoch seconds of midnight UTC) and the
+    task's dateModified when they were worked out.  Safe to share between
+    threads.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS spans (
+                teamphid TEXT NOT NULL,
+                tasknum INTEGER NOT NULL,
+                modified INTEGER NOT NULL,
+                first INTEGER NOT NULL,
+                upto INTEGER NOT NULL,
+                PRIMARY KEY (teamphid, tasknum)
+            );
+            CREATE TABLE IF NOT EXISTS days (
+                teamphid TEXT NOT NULL,
+                tasknum INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (teamphid, tasknum, day)
+            );
+        """)
+
+    def span(self, teamphid, tasknum):
+        """Return (dateModified, first, upto) for the days stored for the
+        task, or None.
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT modified, first, upto FROM spans '
+                'WHERE teamphid = ? AND tasknum = ?',
+                (teamphid, int(tasknum))).fetchone()
+
+    def days(self, teamphid, tasknum, start, end):
+        """Return the stored day states of the task needed for start to end
+        (epoch seconds), as a dict of day to the JSON form (see
+        daystate_to_json): those in the window, and the last one before
+        it.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT day, data FROM days '
+                'WHERE teamphid = ? AND tasknum = ? AND day < ? AND day >= '
+                '(SELECT MAX(day) FROM days WHERE teamphid = ? '
+                'AND tasknum = ? AND day <= ?)',
+                (teamphid, int(tasknum), end,
+                 teamphid, int(tasknum), start)).fetchall()
+        return dict((day, json.loads(data)) for day, data in rows)
+
+    def save(self, teamphid, tasknum, modified, first, upto, days):
+        """Replace whatever is stored for the task with the days (a dict of
+        day to JSON form) from first up to upto.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                'DELETE FROM days WHERE teamphid = ? AND tasknum = ?',
+                (teamphid, int(tasknum)))
+            self.db.executemany(
+                'INSERT INTO days VALUES (?, ?, ?, ?)',
+                ((teamphid, int(tasknum), day,
+                  json.dumps(data, separators=(',', ':')))
+                 for day, data in days.iteritems()))
+            self.db.execute(
+                'INSERT OR REPLACE INTO spans VALUES (?, ?, ?, ?, ?)',
+                (teamphid, int(tasknum), int(modified), first, upto))
+
+
+def get_fragmentcache(board):
+    """Return the board's FragmentCache, or None if it has no
+    "fragmentcache".  It's opened once and kept on the board
+    ("fragments").
+    """
+    if not board.get('fragmentcache'):
+        return None
+    if 'fragments' not in board:
+        board['fragments'] = FragmentCache(board['fragmentcache'])
+    return board['fragments']
+
+
+class UserIndex(object):
+    """Persistent SQLite index of who did what over each window of each
+    board that the last full run reported on: for each actor (anyone in a
+    task's "actorset"), their tasks with the title and state (in the JSON
+    form of daystate_to_json) of each, plus the names of the actors and
+    columns.  That's all get_actor_tasks needs, so that one user's report
+    (see render_indexed_user) comes straight out of it, without touching
+    anybody else's tasks.  Windows are in epoch seconds, and each records
+    the time its data was complete as of ("built"), so that one a full run
+    now would see differently isn't used.  Safe to share between threads.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS windows (
+                teamphid TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                built REAL NOT NULL,
+                PRIMARY KEY (teamphid, start, end)
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                teamphid TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                actor TEXT NOT NULL,
+                tasknum INTEGER NOT NULL,
+                title TEXT,
+                state TEXT NOT NULL,
+                PRIMARY KEY (teamphid, start, end, actor, tasknum)
+            );
+            CREATE TABLE IF NOT EXISTS names (
+                phid TEXT PRIMARY KEY,
+                name TEXT NOT NULL
+            );
+        """)
+
+    def has(self, teamphid, start, end, current=None):
+        """Whether the window is stored, and as good as one built from data
+        complete as of current (epoch seconds) would be: its data covered
+        the whole window, or is at least that current.
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT built FROM windows '
+                'WHERE teamphid = ? AND start = ? AND end = ?',
+                (teamphid, start, end)).fetchone()
+        return row is not None and (current is None or
+                                    row[0] >= min(end, current))
+
+    def tasks(self, teamphid, start, end, actor):
+        """Return (tasknum, title, state) for each of the actor's tasks in
+        the window, in task number order.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT tasknum, title, state FROM entries '
+                'WHERE teamphid = ? AND start = ? AND end = ? AND actor = ? '
+                'ORDER BY tasknum',
+                (teamphid, start, end, actor)).fetchall()
+        return [(str(tasknum), title, json.loads(state))
+                for tasknum, title, state in rows]
+
+    def names(self, phids):
+        """Return the stored name of each of phids that has one."""
+        phids = list(phids)
+        with self.lock:
+            return dict(self.db.execute(
+                'SELECT phid, name FROM names WHERE phid IN ({})'.format(
+                    ', '.join('?' * len(phids))), phids).fetchall())
+
+    def save(self, teamphid, start, end, entries, names, built):
+        """Replace whatever is stored for the window with entries, a list of
+        (actor, tasknum, title, state), worked out from data complete as of
+        built (epoch seconds), and add names (a dict of PHID to name).
+        """
+        with self.lock, self.db:
+            for table in ('windows', 'entries'):
+                self.db.execute(
+                    'DELETE FROM {} '
+                    'WHERE teamphid = ? AND start = ? AND end = ?'.format(
+                        table), (teamphid, start, end))
+            self.db.executemany(
+                'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((teamphid, start, end, actor, int(tasknum), title,
+                  json.dumps(state, separators=(',', ':')))
+                 for actor, tasknum, title, state in entries))
+            self.db.executemany('INSERT OR REPLACE INTO names VALUES (?, ?)',
+                                names.iteritems())
+            self.db.execute('INSERT INTO windows VALUES (?, ?, ?, ?)',
+                            (teamphid, start, end, built))
+
+
+def get_userindex(config):
+    """Open the UserIndex named in the config ("userindex"), or return None
+    if there isn't one configured.
+    """
+    if not config.get('userindex'):
+        return None
+    return UserIndex(config['userindex'])
+
+
+class ResponseCache(object):
+    """On-disk cache of Conduit responses.  Entries are keyed by the Conduit
+    method plus a hash of its canonicalized parameters, so a query only hits
+    the cache if it asks for exactly the same thing (the order of id and PHID
+    lists doesn't matter).  Each entry is zlib-compressed JSON written
+    atomically, expires after a per-method TTL, and the least recently used
+    entries are evicted once the directory grows past maxbytes.
+    """
+
+    def __init__(self, cachedir, ttls=None, maxbytes=DEFAULT_CACHE_MAXBYTES):
+        self.cachedir = cachedir
+        self.ttls = dict(DEFAULT_CACHE_TTLS)
+        self.ttls.update(ttls or {})
+        self.maxbytes = maxbytes
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    @staticmethod
+    def signature(method, params):
+        def canonical(value):
+            if isinstance(value, dict):
+                return dict((k, canonical(v)) for k, v in value.iteritems())
+            if isinstance(value, (list, tuple, set, frozenset)):
+                return sorted(canonical(v) for v in value)
+            return value
+        blob = json.dumps([method, canonical(params)], sort_keys=True,
+                          separators=(',', ':'))
+        return hashlib.sha1(blob).hexdigest()
+
+    def path(self, method, params):
+        return os.path.join(self.cachedir, '{}-{}.json.z'.format(
+            method, self.signature(method, params)))
+
+    def get(self, method, params, default=None):
+        """Return the cached result, or default if missing or expired (a
+        result can itself be None).
+        """
+        path = self.path(method, params)
         try:
-            result = pickle.load(open(picklefile))
-        except IOError:
-            result = apicall()
-            pickle.dump(result, open(picklefile, "wb"))
+            with open(path, 'rb') as fh:
+                entry = json.loads(zlib.decompress(fh.read()))
+        except (IOError, OSError, ValueError, zlib.error):
+            return default
+        ttl = self.ttls.get(method)
+        if ttl is not None and time.time() - entry['created'] > ttl:
+            return default
+        # Bump the mtime so that eviction is least-recently-used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry['result']
+
+    def put(self, method, params, result):
+        blob = zlib.compress(json.dumps({'method': method,
+                                         'created': time.time(),
+                                         'result': result},
+                                        separators=(',', ':')))
+        write_atomically(self.path(method, params), blob)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cachedir):
+            if not name.endswith('.json.z'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cachedir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        entries.sort()
+        while total > self.maxbytes and entries:
+            mtime, size, name = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.cachedir, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def get_cache(config):
+    """Build the ResponseCache described by the config, or None if caching
+    is turned off.  Offline, nothing in the cache is too old to use.
+    """
+    if not config.get('cachedir'):
+        return None
+    ttls = config.get('cache_ttl')
+    if config.get('offline'):
+        ttls = dict.fromkeys(set(DEFAULT_CACHE_TTLS) | set(ttls or {}))
+    return ResponseCache(config['cachedir'], ttls,
+                         config.get('cache_maxbytes',
+                                    DEFAULT_CACHE_MAXBYTES))
+
+
+# What ResponseCache.get returns for a miss, as opposed to a cached None
+MISSING = object()
+
+
+def call_phab_via_cache(phab, cache, method, params, scheduler=None,
+                        fresh=False):
+    """Call the Conduit method named by "method" (e.g. "phid.query") with
+    "params", going through the ResponseCache if there is one (with fresh,
+    only to store the result).  Results are
+    returned as plain JSON-style dicts rather than phabricator.Result objects
+    so that cached and uncached calls look the same.  Calls that miss the
+    cache go through the ConduitScheduler if there is one.  Every call is
+    counted in METRICS.
+    """
+    began = time.time()
+    if cache and not fresh:
+        result = cache.get(method, params, MISSING)
+        if result is not MISSING:
+            METRICS.record_call(method, params, result, time.time() - began,
+                                cached=True)
+            return result
+    if scheduler:
+        result = scheduler.call(phab, method, params)
+    else:
+        result = call_conduit(phab, method, params)
+    METRICS.record_call(method, params, result, time.time() - began,
+                        cached=False if cache else None)
+    if cache:
+        cache.put(method, params, result)
     return result
 
 
+def call_conduit(phab, method, params):
+    """Call the Conduit method named by "method" on the client phab, and
+    return the result as plain JSON-style data.
+    """
+    apicall = phab
+    for part in method.split('.'):
+        apicall = getattr(apicall, part)
+    result = apicall(**params)
+    return getattr(result, 'response', result)
+
+
+class Metrics(object):
+    """Wall time and object counts for each stage of main(), plus counts,
+    ids, response sizes and cache hits/misses for each Conduit method.  Use
+    the module-wide METRICS instance.  Response sizes are only measured
+    (which means reserializing the response) once "enabled" is set.
+    Optionally, stages marked "hot" run under cProfile.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.profiler = None
+        self.stages = []
+        self.conduit = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, hot=False):
+        """Time the body of the with statement as stage "name".  The body
+        can put the number of objects it dealt with in the dict yielded.
+        """
+        counts = {'objects': None}
+        profiling = hot and self.profiler
+        if profiling:
+            self.profiler.enable()
+        began = time.time()
+        try:
+            yield counts
+        finally:
+            elapsed = time.time() - began
+            if profiling:
+                self.profiler.disable()
+            with self.lock:
+                self.stages.append({'stage': name, 'seconds': elapsed,
+                                    'objects': counts['objects']})
+
+    def record_call(self, method, params, result, elapsed, cached):
+        """Count one Conduit call.  cached is True for a cache hit, False
+        for a miss and None when there's no cache.
+        """
+        ids = sum(len(value) for value in params.itervalues()
+                  if isinstance(value, (list, tuple, set)))
+        size = len(json.dumps(result)) if self.enabled else None
+        with self.lock:
+            method = self.conduit.setdefault(method, {
+                'calls': 0, 'ids': 0, 'bytes': 0, 'seconds': 0.0,
+                'hits': 0, 'misses': 0})
+            method['calls'] += 1
+            method['ids'] += ids
+            method['seconds'] += elapsed
+            method['bytes'] += size or 0
+            if cached:
+                method['hits'] += 1
+            elif cached is False:
+                method['misses'] += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {'stages': list(self.stages),
+                    'conduit': dict(self.conduit)}
+
+    def summary(self):
+        """Return a plain text table of the metrics."""
+        lines = ['{:32} {:>9} {:>10}'.format('stage', 'seconds', 'objects')]
+        for stage in self.stages:
+            lines.append('{:32} {:9.3f} {:>10}'.format(
+                stage['stage'], stage['seconds'],
+                '' if stage['objects'] is None else stage['objects']))
+        lines.append('')
+        lines.append('{:32} {:>6} {:>8} {:>12} {:>9} {:>5} {:>6}'.format(
+            'conduit method', 'calls', 'ids', 'bytes', 'seconds', 'hits',
+            'misses'))
+        for method, info in sorted(self.conduit.iteritems()):
+            lines.append('{:32} {calls:6} {ids:8} {bytes:12} '
+                         '{seconds:9.3f} {hits:5} {misses:6}'.format(
+                             method, **info))
+        return '\n'.join(lines) + '\n'
+
+    def start(self, config):
+        """Turn on whatever collection the config asks for."""
+        self.enabled = bool(config.get('profile') or
+                            config.get('metrics_out'))
+        if config.get('cprofile_out'):
+            self.profiler = cProfile.Profile()
+
+    def report(self, config):
+        """Write out whatever the config asks for."""
+        if config.get('profile'):
+            sys.stderr.write(self.summary())
+        if config.get('metrics_out'):
+            with open(config['metrics_out'], 'w') as fh:
+                json.dump(self.as_dict(), fh, indent=4, sort_keys=True)
+        if self.profiler:
+            self.profiler.dump_stats(config['cprofile_out'])
+
+
+METRICS = Metrics()
+
+
+class ConduitClient(object):
+    """Drop-in replacement for phabricator.Phabricator that keeps a pool of
+    keep-alive HTTP connections, rather than opening a new connection (and
+    doing a new TLS handshake) for every call.  At most "connections" calls
+    are in flight at once; callers beyond that wait for a free connection.
+    Methods are called the same way, e.g. client.phid.query(phids=[...]),
+    and authenticate with a Conduit API token.
+    """
+
+    def __init__(self, host, token, connections=4, timeout=30):
+        url = urlparse.urlparse(host)
+        self.https = url.scheme == 'https'
+        self.netloc = url.netloc
+        self.path = url.path.rstrip('/')
+        if not self.path.endswith('/api'):
+            self.path += '/api'
+        self.token = token
+        self.timeout = timeout
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(connections)
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return ConduitMethod(self, attr)
+
+    def connect(self):
+        if self.https:
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def call(self, method, **params):
+        params['__conduit__'] = {'token': self.token}
+        body = urllib.urlencode({'params': json.dumps(params),
+                                 'output': 'json',
+                                 '__conduit__': 1})
+        headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                   'Connection': 'keep-alive'}
+        with self.slots:
+            try:
+                conn = self.idle.get_nowait()
+                reused = True
+            except Queue.Empty:
+                conn = self.connect()
+                reused = False
+            try:
+                try:
+                    data = self.request(conn, method, body, headers)
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    if not reused:
+                        raise
+                    # The server timed out our idle connection; try again
+                    # on a fresh one.
+                    conn = self.connect()
+                    data = self.request(conn, method, body, headers)
+            except Exception:
+                conn.close()
+                raise
+            self.idle.put(conn)
+        response = json.loads(data)
+        if response.get('error_code'):
+            raise phabricator.APIError(response['error_code'],
+                                       response['error_info'])
+        return response['result']
+
+    def request(self, conn, method, body, headers):
+        conn.request('POST', '{}/{}'.format(self.path, method), body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise httplib.HTTPException('{} {} from {}'.format(
+                response.status, response.reason, method))
+        return data
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+class ConduitMethod(object):
+    """A (possibly partial) Conduit method name hanging off a ConduitClient,
+    so that client.maniphest.query(...) works like it does with
+    phabricator.Phabricator.
+    """
+
+    def __init__(self, client, method):
+        self.client = client
+        self.method = method
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return ConduitMethod(self.client, self.method + '.' + attr)
+
+    def __call__(self, **params):
+        return self.client.call(self.method, **params)
+
+
+class ConduitRecorder(object):
+    """Wrapper around a Conduit client that appends every call made through
+    it (method, parameters and result) to a file of JSON lines, for
+    ConduitReplay to answer from later.
+    """
+
+    def __init__(self, phab, path):
+        self.phab = phab
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return ConduitMethod(self, attr)
+
+    def call(self, method, **params):
+        result = call_conduit(self.phab, method, params)
+        line = json.dumps({'method': method, 'params': params,
+                           'result': result}, sort_keys=True)
+        with self.lock, open(self.path, 'a') as fh:
+            fh.write(line + '\n')
+        return result
+
+    def close(self):
+        if isinstance(self.phab, ConduitClient):
+            self.phab.close()
+
+
+class ConduitReplay(object):
+    """Stand-in for the Conduit client that answers from a recording made by
+    ConduitRecorder, so that everything from the fetch path on can be run
+    (and load tested) without Phabricator.  A call gets the recorded result
+    of the same call if there is one.  Otherwise, calls with a list of ids
+    or PHIDs are answered entry by entry from whichever recorded calls had
+    them, so a recording made with one chunk size replays with another.
+
+    For load testing, each call can be made to take "latency" seconds, to
+    fail with an IOError at the rate "errors" (0 to 1), and to have every
+    list in its result (i.e. each task's transactions) repeated "scale"
+    times.  Each repeat of a transaction gets its own transactionID and is
+    that many seconds later, so the EventStore keeps them all.
+    """
+
+    def __init__(self, path, latency=0, errors=0, scale=1, seed=None):
+        self.latency = latency
+        self.errors = errors
+        self.scale = scale
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.entries = {}
+        with open(path) as fh:
+            for line in fh:
+                call = json.loads(line)
+                self.add(call['method'], call['params'], call['result'])
+
+    @staticmethod
+    def split(method, params):
+        """Return the key under which the entries of a call with a single
+        list parameter are kept, and that list (or None, None).
+        """
+        lists = [name for name, value in params.iteritems()
+                 if isinstance(value, (list, tuple))]
+        if len(lists) != 1:
+            return None, None
+        rest = dict((name, value) for name, value in params.iteritems()
+                    if name != lists[0])
+        return ((method, ResponseCache.signature(method, rest), lists[0]),
+                params[lists[0]])
+
+    def add(self, method, params, result):
+        self.calls[ResponseCache.signature(method, params)] = result
+        prefix, items = self.split(method, params)
+        if prefix is None or not isinstance(result, (dict, list)):
+            return
+        # Items missing from the result (e.g. unknown PHIDs) are
+        # remembered as missing
+        wanted = dict((unicode(item), None) for item in items)
+        # PHP serializes an empty dict as an empty list
+        for key, value in (result or {}).iteritems():
+            if key in wanted:
+                wanted[key] = (key, value)
+            elif isinstance(value, dict) and unicode(value.get('id')) in \
+                    wanted:
+                wanted[unicode(value['id'])] = (key, value)
+        for item, entry in wanted.iteritems():
+            self.entries[prefix + (item,)] = entry
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return ConduitMethod(self, attr)
+
+    def call(self, method, **params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            fail = self.random.random() < self.errors
+        if fail:
+            raise IOError('Injected error calling {}'.format(method))
+        result = self.lookup(method, params)
+        if self.scale != 1 and isinstance(result, dict):
+            result = dict((key, self.scaled(value)
+                           if isinstance(value, list) else value)
+                          for key, value in result.iteritems())
+        return result
+
+    def scaled(self, items):
+        """Return items repeated scale times, each repeat of a transaction
+        made distinct from the original.
+        """
+        retval = list(items)
+        for repeat in xrange(1, self.scale):
+            for item in items:
+                if isinstance(item, dict) and 'transactionID' in item:
+                    item = dict(item, transactionID='{}-{}'.format(
+                        item['transactionID'], repeat),
+                        dateCreated=str(int(item['dateCreated']) + repeat))
+                retval.append(item)
+        return retval
+
+    def lookup(self, method, params):
+        signature = ResponseCache.signature(method, params)
+        if signature in self.calls:
+            return self.calls[signature]
+        prefix, items = self.split(method, params)
+        if prefix is not None:
+            try:
+                entries = [self.entries[prefix + (unicode(item),)]
+                           for item in items]
+                return dict(entry for entry in entries if entry)
+            except KeyError:
+                pass
+        raise phabricator.APIError(
+            'ERR-REPLAY', 'No recording of {} {}'.format(
+                method, json.dumps(params, sort_keys=True)))
+
+
+def get_phab(config):
+    """Return the Conduit client to use: a pooled ConduitClient if the config
+    has a "conduit" block (with "host" and "token", and optionally
+    "connections", by default as many as the fetcher's "max_workers", and
+    "timeout"), otherwise phabricator.Phabricator, which
+    gets its credentials from ~/.arcrc.  With "replay_conduit" it's a
+    ConduitReplay of that recording instead (with "replay_latency",
+    "replay_errors" and "replay_scale"), and with "record_conduit" the
+    client gets wrapped in a ConduitRecorder writing to that file.
+    """
+    if config.get('replay_conduit'):
+        return ConduitReplay(config['replay_conduit'],
+                             config.get('replay_latency') or 0,
+                             config.get('replay_errors') or 0,
+                             config.get('replay_scale') or 1)
+    conduit = config.get('conduit')
+    if not conduit:
+        phab = phabricator.Phabricator()
+    else:
+        fetch = dict(DEFAULT_FETCH_OPTIONS)
+        fetch.update(config.get('fetch') or {})
+        phab = ConduitClient(conduit['host'], conduit['token'],
+                             conduit.get('connections',
+                                         fetch['max_workers']),
+                             conduit.get('timeout', 30))
+    if config.get('record_conduit'):
+        phab = ConduitRecorder(phab, config['record_conduit'])
+    return phab
+
+
+class OfflineError(Exception):
+    """Raised when something needs Phabricator with "offline" set."""
+
+
+class LazyClient(object):
+    """Conduit client that only gets built (by get_phab) when a call first
+    misses the cache, so that a run answered entirely from the cache never
+    imports phabricator or opens a connection.  With "offline" in the
+    config (and nothing to replay), it raises OfflineError instead.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.client = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.client is None:
+                if self.config.get('offline') and \
+                        not self.config.get('replay_conduit'):
+                    raise OfflineError('Offline, and not everything '
+                                       'needed is in the cache')
+                self.client = get_phab(self.config)
+            return self.client
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.get(), attr)
+
+    def close(self):
+        if isinstance(self.client, (ConduitClient, ConduitRecorder)):
+            self.client.close()
+
+
+def get_fetcher(config):
+    """Build the ConduitFetcher described by the config."""
+    return ConduitFetcher(LazyClient(config), get_cache(config),
+                          config.get('fetch'))
+
+
+class ConduitScheduler(object):
+    """Decides when each Conduit call that misses the cache goes out.
+    Waiting calls go in order of CALL_PRIORITIES (then first come, first
+    served), paced by a token bucket of rate calls a second with room for
+    bursts of up to burst, and with at most limit of them in flight.  The
+    limit starts at workers and adapts the way TCP's congestion window
+    does: it's halved whenever a call fails or takes more than slow
+    seconds, and otherwise grows by about one for every limit calls that
+    go fine, up to maxworkers.
+    """
+
+    def __init__(self, workers, maxworkers=None, rate=None, burst=None,
+                 slow=None):
+        self.maxworkers = max(workers, maxworkers)
+        self.window = float(workers)
+        self.rate = rate
+        self.burst = burst or workers
+        self.slow = slow
+        self.tokens = float(self.burst)
+        self.filled = time.time()
+        self.running = 0
+        self.waiting = []
+        self.counter = 0
+        self.cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return max(1, int(self.window))
+
+    def _take_token(self):
+        """Take a token from the bucket if there is one and return 0,
+        otherwise return how long until there will be.
+        """
+        if not self.rate:
+            return 0
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.filled) * self.rate)
+        self.filled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self, priority):
+        with self.cond:
+            ticket = (priority, self.counter)
+            self.counter += 1
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                if self.waiting[0] == ticket and self.running < self.limit:
+                    wait = self._take_token()
+                    if not wait:
+                        break
+                    self.cond.wait(wait)
+                else:
+                    self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.running += 1
+            # The next in line might be able to go too
+            self.cond.notify_all()
+
+    def release(self, seconds, failed=False):
+        with self.cond:
+            self.running -= 1
+            if failed or (self.slow and seconds > self.slow):
+                self.window = max(1.0, self.window / 2)
+            else:
+                self.window = min(self.maxworkers,
+                                  self.window + 1 / self.window)
+            self.cond.notify_all()
+
+    def call(self, phab, method, params):
+        """call_conduit, once it's method's turn."""
+        self.acquire(CALL_PRIORITIES.get(method, len(CALL_PRIORITIES)))
+        began = time.time()
+        failed = False
+        try:
+            return call_conduit(phab, method, params)
+        except (IOError, httplib.HTTPException):
+            failed = True
+            raise
+        finally:
+            self.release(time.time() - began, failed)
+
+
+class ConduitFetcher(object):
+    """Fetch layer sitting on top of call_phab_via_cache.  Big lists of ids or
+    PHIDs get split into chunks, which run on a thread pool and get retried
+    with exponential backoff if the network flakes out.  Whatever misses the
+    cache goes out through a ConduitScheduler, which is what limits how
+    many calls are made at once, and how often.  The per-chunk results are
+    merged back into the single dict that one big call would have returned.
+    Chunks are cut from the sorted list, so that an unchanged chunk maps
+    onto the same ResponseCache entry run after run.
+    """
+
+    def __init__(self, phab, cache, options=None):
+        self.phab = phab
+        self.cache = cache
+        self.options = dict(DEFAULT_FETCH_OPTIONS)
+        self.options.update(options or {})
+        self.chunksizes = dict(DEFAULT_CHUNKSIZES)
+        self.chunksizes.update(self.options.get('chunksize', {}))
+        self.scheduler = ConduitScheduler(
+            self.options['workers'], self.options['max_workers'],
+            self.options['rate'], self.options['burst'],
+            self.options['slow'])
+        # A lookup has at most workers + 1 chunks in flight (see
+        # iter_call), and up to three more can run alongside it (see
+        # background).  With a thread for each of those, the scheduler
+        # gets to choose between all of them rather than the pool
+        # handing them out first come, first served.
+        from multiprocessing.pool import ThreadPool
+        self.pool = ThreadPool(4 * (self.options['workers'] + 1))
+        # Separate pool for whole lookups running alongside each other, so
+        # they never tie up the threads their own chunks need.
+        self.jobs = ThreadPool(3)
+
+    def call(self, method, key, items, params=None, fresh=False):
+        """Call "method" with the list "items" passed as parameter "key"
+        (plus any other "params"), chunked and merged.  With fresh, the
+        calls skip the cache (see call_phab_via_cache).
+        """
+        retval = {}
+        for chunk, result in self.iter_call(method, key, items, params,
+                                            fresh):
+            retval.update(result)
+        return retval
+
+    def iter_call(self, method, key, items, params=None, fresh=False):
+        """Like call(), but yield (chunk, result) for each chunk in turn
+        instead of merging the results.  Only as many chunks as there are
+        workers get fetched ahead of the one being handed back, so however
+        many items there are, only that many results are held at once.
+        """
+        items = sorted(items)
+        if not items:
+            return
+        size = self.chunksizes.get(method, len(items))
+        chunks = [items[i:i + size] for i in xrange(0, len(items), size)]
+
+        def call_chunk(chunk):
+            chunkparams = dict(params or {})
+            chunkparams[key] = chunk
+            return self._call_with_retries(method, chunkparams, fresh)
+
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append((chunk, self.pool.apply_async(call_chunk,
+                                                         (chunk,))))
+            if len(pending) > self.options['workers']:
+                chunk, result = pending.popleft()
+                # PHP serializes an empty dict as an empty list
+                yield chunk, result.get() or {}
+        while pending:
+            chunk, result = pending.popleft()
+            yield chunk, result.get() or {}
+
+    def query(self, method, params, fresh=False):
+        """Make one (unchunked) call, with retries."""
+        return self._call_with_retries(method, params, fresh)
+
+    def current_as_of(self, method, now=None):
+        """Return the time (epoch seconds) that the results of (non-fresh)
+        calls to method are known to be current as of: now, less however
+        long the cache keeps them (0 if it keeps them for good).
+        """
+        now = time.time() if now is None else now
+        if not self.cache:
+            return now
+        ttl = self.cache.ttls.get(method)
+        return 0 if ttl is None else now - ttl
+
+    def _call_with_retries(self, method, params, fresh=False):
+        attempt = 0
+        while True:
+            try:
+                return call_phab_via_cache(self.phab, self.cache, method,
+                                           params, self.scheduler, fresh)
+            except (IOError, httplib.HTTPException, ValueError):
+                if attempt >= self.options['retries']:
+                    raise
+                time.sleep(self.options['backoff'] * 2 ** attempt)
+                attempt += 1
+
+    def background(self, func, *args):
+        """Run func(*args) alongside whatever else is going on.  Returns an
+        AsyncResult; its get() hands back the return value or raises.
+        """
+        return self.jobs.apply_async(func, args)
+
+    def close(self):
+        self.pool.close()
+        self.jobs.close()
+        # Let the threads finish, rather than be torn down mid-way at exit
+        self.pool.join()
+        self.jobs.join()
+        if isinstance(self.phab, (ConduitClient, ConduitRecorder,
+                                  LazyClient)):
+            self.phab.close()
+
+
+class TransactionLog(object):
+    """Compact, column-oriented record of one task's filtered transactions:
+    one array (or list) per field rather than a dict per transaction.
+    ttypes holds indexes into TRANSACTION_TYPES and timestamps are in epoch
+    seconds.  authors (-1 for none), and olds and news for reassign and
+    projectcolumn transactions, hold PHIDs interned by PhidStore.add.
+    Status and title values are plain strings.
+    """
+    __slots__ = ('ttypes', 'timestamps', 'authors', 'olds', 'news')
+
+    def __init__(self):
+        self.ttypes = array('b')
+        self.timestamps = array('l')
+        self.authors = array('l')
+        self.olds = []
+        self.news = []
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, ttype, timestamp, author, old, new):
+        self.ttypes.append(ttype)
+        self.timestamps.append(timestamp)
+        self.authors.append(-1 if author is None else author)
+        self.olds.append(old)
+        self.news.append(new)
+
+
 def get_filtered_transactions_for_task(taskfeed, phidstore, teamphid):
-    """Return an item if it's relevant to our current search, or {} if it
-    isn't. Also populate the PHIDs that will eventually need to be resolved.
-    There's a fair amount of logic here for making the return value a bit more
-    uniform than what is passed in.
+    """Return a TransactionLog of the transactions that are relevant to our
+    current search, interning the PHIDs that will eventually need to be
+    resolved in phidstore along the way.  There's a fair amount of logic here
+    for making the return value a bit more uniform than what is passed in.
     """
-    # TODO: pass in MWCORETEAM_PHID instead of relying on global constant.
-    transactions = []
+    transactions = TransactionLog()
+    # This runs for every transaction in the board's history, so look
+    # things up once rather than on each pass through the loop.
+    add = phidstore.add
+    add_ttype = transactions.ttypes.append
+    add_timestamp = transactions.timestamps.append
+    add_author = transactions.authors.append
+    add_old = transactions.olds.append
+    add_new = transactions.news.append
     for tact in taskfeed:
-        item = {}
-        item['transactionType'] = tact["transactionType"]
-        item['timestamp'] = int(tact['dateCreated'])
-        item['authorPHID'] = tact['authorPHID']
-        phidstore.add(item['authorPHID'])
-        if (tact["transactionType"] == "status" or
-                tact["transactionType"] == "title"):
-            item['oldValue'] = tact['oldValue']
-            item['newValue'] = tact['newValue']
-        elif (tact["transactionType"] == "reassign"):
-            item['oldValue'] = tact['oldValue']
+        ttype = tact["transactionType"]
+        old = new = None
+        if ttype == "status" or ttype == "title":
+            old = tact['oldValue']
+            new = tact['newValue']
+        elif ttype == "reassign":
             if tact['oldValue']:
-                phidstore.add(item['oldValue'])
-            item['newValue'] = tact['newValue']
+                old = add(tact['oldValue'])
             if tact['newValue']:
-                phidstore.add(item['newValue'])
-        elif (tact["transactionType"] == "projectcolumn" and
+                new = add(tact['newValue'])
+        elif (ttype == "projectcolumn" and
                 tact["oldValue"]["projectPHID"] == teamphid):
             oldvalphids = tact['oldValue']['columnPHIDs']
             if isinstance(oldvalphids, dict):
-                item['oldValue'] = oldvalphids.values()[0]
-                phidstore.add(item['oldValue'])
-            else:
-                item['oldValue'] = None
-            item['newValue'] = tact['newValue']['columnPHIDs'][0]
-            phidstore.add(item['newValue'])
+                old = add(oldvalphids.values()[0])
+            new = add(tact['newValue']['columnPHIDs'][0])
         else:
-            item = {}
-        if item:
-            transactions.append(item)
+            continue
+        add_ttype(TRANSACTION_CODES[ttype])
+        add_timestamp(int(tact['dateCreated']))
+        add_author(add(tact['authorPHID']) if tact['authorPHID'] else -1)
+        add_old(old)
+        add_new(new)
     return transactions
 
 
-def build_taskstate_from_transactions(transactions, start, end, config):
-    """Walk through the transactions and build up the state for a particular
-    task at each end of the interval defined by "start" and "end". Also keep
-    track of how long tasks have been in the "In Dev" and "Waiting for
-    Review/Feedback" columns.
+def filter_board_transactions(board, activity, phidstore):
+    """Filter the raw activity (task number -> feed) of the tasks on the
+    board with the board's teamphid, into board['transactions'].  Tasks
+    already there are replaced, and their TaskHistory dropped so that it
+    gets rebuilt.  Returns the number of transactions kept.
+    """
+    transactions = board.setdefault('transactions', {})
+    histories = board.setdefault('histories', {})
+    kept = 0
+    for tasknum, taskfeed in activity.iteritems():
+        if tasknum not in board['tasks']:
+            continue
+        tacts = get_filtered_transactions_for_task(
+            taskfeed, phidstore, board['teamphid'])
+        transactions[tasknum] = tacts
+        histories.pop(tasknum, None)
+        kept += len(tacts)
+    return kept
+
+
+# Map from transaction type to the part of the task state it changes
+TASKSTATE_FIELDS = {PROJECTCOLUMN: 'column',
+                    STATUS: 'status',
+                    REASSIGN: 'assignee',
+                    TITLE: 'title'}
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=dateutil.tz.tzutc())
+DAY = 24 * 60 * 60
+
+
+class TaskHistory(object):
+    """Index of one task's TransactionLog, built in a single pass, from which
+    the state of the task over any interval can be looked up by bisecting on
+    timestamps rather than walking the transactions again.  This is what
+    makes reporting on many intervals cost about the same as reporting on
+    one.
     """
-    taskstate = {'column': {},
-                 'status': {},
-                 'assignee': {},
-                 'title': {}}
+
+    def __init__(self, transactions, config, phidstore):
+        wbstate = phidstore.add_map(config['workboard_state_phids'])
+        self.changes = dict((field, (array('l'), [], []))
+                            for field in TASKSTATE_FIELDS.values())
+        self.entered = {'feedback': array('l'), 'indev': array('l')}
+        ttypes = transactions.ttypes
+        timestamps = transactions.timestamps
+        olds = transactions.olds
+        news = transactions.news
+        order = range(len(transactions))
+        if any(timestamps[i] > timestamps[i + 1] for i in order[:-1]):
+            order.sort(key=timestamps.__getitem__)
+            self.timestamps = array('l', (timestamps[i] for i in order))
+            self.authors = array('l', (transactions.authors[i]
+                                       for i in order))
+        else:
+            self.timestamps = timestamps
+            self.authors = transactions.authors
+        changes = [self.changes[TASKSTATE_FIELDS[code]]
+                   for code in xrange(len(TRANSACTION_TYPES))]
+        entered = [(wbstate[column], self.entered[column])
+                   for column in self.entered]
+        for i in order:
+            ttype = ttypes[i]
+            times, fieldolds, fieldnews = changes[ttype]
+            times.append(timestamps[i])
+            fieldolds.append(olds[i])
+            fieldnews.append(news[i])
+            if ttype == PROJECTCOLUMN:
+                for column, columntimes in entered:
+                    if olds[i] != column and news[i] == column:
+                        columntimes.append(timestamps[i])
+
+    def state(self, start, end, with_assignee=True):
+        """Return the task state for the interval from start to end, in the
+        form build_taskstate_from_transactions documents.  Without
+        with_assignee, the "actorset" only has the authors of transactions
+        in the interval, not the assignee at the end of it.
+        """
+        start = (start - EPOCH).total_seconds()
+        end = (end - EPOCH).total_seconds()
+        taskstate = {}
+        for field, (times, olds, news) in self.changes.iteritems():
+            taskstate[field] = {}
+            # Transactions strictly before start, and those up to end
+            before = bisect.bisect_left(times, start)
+            upto = bisect.bisect_right(times, end)
+            if upto:
+                if before:
+                    taskstate[field]['start'] = news[before - 1]
+                else:
+                    taskstate[field]['start'] = olds[0]
+                taskstate[field]['end'] = news[upto - 1]
+        first = bisect.bisect_right(self.timestamps, start)
+        upto = bisect.bisect_right(self.timestamps, end)
+        taskstate['actorset'] = set(
+            author for author in self.authors[first:upto] if author >= 0)
+        for column, key in (('feedback', 'waitingsince'),
+                            ('indev', 'workingsince')):
+            entered = self.entered[column]
+            upto = bisect.bisect_right(entered, end)
+            if upto:
+                taskstate[key] = entered[upto - 1]
+        if (with_assignee and
+                taskstate['assignee'].get('end') is not None):
+            taskstate['actorset'].add(taskstate['assignee']['end'])
+        return taskstate
+
+    def summary(self, phidstore):
+        """Return the state of the task after its last transaction, with
+        PHIDs rather than interned ids, for the EventStore to keep and
+        taskstate_from_summary to turn back into task state.
+        """
+        summary = {}
+        for field, (times, olds, news) in self.changes.iteritems():
+            if times:
+                value = news[-1]
+                if field in ('column', 'assignee') and value is not None:
+                    value = phidstore.lookup(value)
+                summary[field] = value
+        for column, key in (('feedback', 'waitingsince'),
+                            ('indev', 'workingsince')):
+            if self.entered[column]:
+                summary[key] = self.entered[column][-1]
+        return summary
+
+
+def taskstate_from_summary(summary, phidstore):
+    """Return the task state (see build_taskstate_from_transactions) for any
+    interval starting after the last transaction of the task summarized
+    (see TaskHistory.summary): nothing changes during it, and the assignee
+    is the only actor.
+    """
+    taskstate = {}
+    for field in TASKSTATE_FIELDS.values():
+        taskstate[field] = {}
+        if field in summary:
+            value = summary[field]
+            if field in ('column', 'assignee') and value is not None:
+                value = phidstore.add(value)
+            taskstate[field] = {'start': value, 'end': value}
+    for key in ('waitingsince', 'workingsince'):
+        if key in summary:
+            taskstate[key] = summary[key]
     taskstate['actorset'] = set()
-    wbstate = config['workboard_state_phids']
-    for tact in transactions:
-        ttime = datetime.datetime.fromtimestamp(
-            tact['timestamp'], dateutil.tz.tzutc()
-        )
-        if ttime > end:
-            break
-        # For each type, build the "old" and "new" state along the
-        # interval defined by the start and end variables
-        # For example:
-        # a->b
-        # b->c
-        # ---START
-        # c->d
-        # d->e
-        # ---END
-        # Old should be "c" and new should be "e"
-        # (see unit test for example)
-        tmap = {'projectcolumn': 'column',
-                'status': 'status',
-                'reassign': 'assignee',
-                'title': 'title'}
-        ttype = tact['transactionType']
-        if tact['transactionType'] in tmap:
-            if ttime >= start and not taskstate.get(tmap[ttype]):
-                taskstate[tmap[ttype]]['start'] = tact['oldValue']
-            elif ttime < start:
-                taskstate[tmap[ttype]]['start'] = tact['newValue']
-            taskstate[tmap[ttype]]['end'] = tact['newValue']
-        if ttime > start and tact['authorPHID']:
-            taskstate['actorset'].add(tact['authorPHID'])
-        if (tact['transactionType'] == 'projectcolumn' and
-            tact['oldValue'] != wbstate['feedback'] and
-                tact['newValue'] == wbstate['feedback']):
-            taskstate['waitingsince'] = ttime
-        if (tact['transactionType'] == 'projectcolumn' and
-            tact['oldValue'] != wbstate['indev'] and
-                tact['newValue'] == wbstate['indev']):
-            taskstate['workingsince'] = ttime
-    if taskstate.get('assignee') and taskstate['assignee']['end']:
+    if taskstate['assignee'].get('end') is not None:
         taskstate['actorset'].add(taskstate['assignee']['end'])
     return taskstate
 
 
-def render_actor(actor, phidstore, transactions, start, end, taskstate,
-                 config, taskstore):
-    """Return an HTML blob for a given user ("actor"), performing the many
-    contortions necessary to have something read more-or-less like plain
-    English.  The goal of this software is to present a simple view of things,
-    so precision is compromised in the name of clarity and highlighting what's
-    important.
-    """
-    # TODO: switch to bottle.SimpleTemplate or some other HTML template
-    # solution
-    wbstate = config['workboard_state_phids']
-    retval = "<li class='userentry'><span class='user'>" + escape(actor.name)
-    retval += "</span>\n"
-    retval += "<ul>\n"
+def load_unchanged_tasks(boards, taskstore, eventstore, since, phidstore):
+    """Find the tasks nobody has touched since before since (epoch seconds)
+    whose state on every board they're on is in the EventStore as of
+    their current dateModified.  Their transactions needn't be fetched or
+    walked; the state of each goes straight into the board's "unchanged"
+    dict instead.  Returns the set of those task numbers.
+    """
+    for board in boards:
+        board['unchanged'] = {}
+    if not eventstore:
+        return set()
+    modified = dict((tasknum, int(task['dateModified']))
+                    for tasknum, task in taskstore.bytasknum.iteritems())
+    candidates = set(tasknum for tasknum, when in modified.iteritems()
+                     if when < since)
+    stored = {}
+    for board in boards:
+        stored[board['teamphid']] = dict(
+            (tasknum, summary) for tasknum, (when, summary)
+            in eventstore.summaries(board['teamphid'],
+                                    board['tasks'] & candidates).iteritems()
+            if when == modified[tasknum])
+    unchanged = set(tasknum for tasknum in candidates
+                    if all(tasknum in stored[board['teamphid']]
+                           for board in boards
+                           if tasknum in board['tasks']))
+    for board in boards:
+        for tasknum in board['tasks'] & unchanged:
+            board['unchanged'][tasknum] = taskstate_from_summary(
+                stored[board['teamphid']][tasknum], phidstore)
+    return unchanged
+
+
+def save_task_summaries(boards, taskstore, eventstore, phidstore):
+    """Store the summary of every task with a TaskHistory, for
+    load_unchanged_tasks to find next time.  Only tasks whose transactions
+    the EventStore has up to their dateModified are summarized; a summary
+    of anything less would pass for the state as of that dateModified.
+    """
+    for board in boards:
+        eventstore.save_summaries(board['teamphid'], (
+            (tasknum, taskstore.bytasknum[tasknum]['dateModified'],
+             history.summary(phidstore))
+            for tasknum, history in board.get('histories', {}).iteritems()
+            if tasknum in taskstore.bytasknum and
+            (eventstore.highwater(int(tasknum)) or 0) >=
+            int(taskstore.bytasknum[tasknum]['dateModified'])))
+
+
+def get_daystates(history, first, upto):
+    """Return the states of the task (see TaskHistory.state, without the
+    assignee among the actors) for each day from first up to upto (epoch
+    seconds, midnight UTC) that isn't just the day before carried over:
+    the first day, and every day with a transaction in it, or on either
+    midnight.  As a dict of day (epoch seconds) to state.
+    """
+    days = set([first])
+    for timestamp in history.timestamps:
+        day = timestamp - timestamp % DAY
+        days.add(day)
+        if timestamp == day:
+            days.add(day - DAY)
+    return dict(
+        (day, history.state(EPOCH + datetime.timedelta(seconds=day),
+                            EPOCH + datetime.timedelta(seconds=day + DAY),
+                            with_assignee=False))
+        for day in days if first <= day < upto)
+
+
+def daystate_to_json(taskstate, phidstore):
+    """Return a day state with PHIDs rather than interned ids, and the
+    actors as a list, for the FragmentCache to keep.
+    """
+    data = dict(taskstate)
+    for field in ('column', 'assignee'):
+        data[field] = dict((key, phidstore.lookup(value)
+                            if value is not None else None)
+                           for key, value in taskstate[field].iteritems())
+    data['actorset'] = sorted(phidstore.lookup(actor)
+                              for actor in taskstate['actorset'])
+    return data
+
+
+def daystate_from_json(data, phidstore):
+    """Turn the JSON form of a day state back into a day state."""
+    taskstate = dict(data)
+    for field in ('column', 'assignee'):
+        taskstate[field] = dict((key, phidstore.add(value)
+                                 if value is not None else None)
+                                for key, value in data[field].iteritems())
+    taskstate['actorset'] = set(phidstore.add(actor)
+                                for actor in data['actorset'])
+    return taskstate
+
+
+class DayHistory(object):
+    """Stand-in for a TaskHistory for windows made of whole days (midnight
+    UTC to midnight UTC), putting the state of the task together from the
+    states of the days in the window (see get_daystates) rather than from
+    transactions.  "days" holds the days that aren't just the day before
+    carried over, from "first" up to "upto" (inf if nothing happens after
+    that).
+    """
+
+    def __init__(self, days, first, upto):
+        self.days = days
+        self.daylist = sorted(days)
+        self.first = first
+        self.upto = upto
+
+    def state(self, start, end):
+        start = (start - EPOCH).total_seconds()
+        end = (end - EPOCH).total_seconds()
+        first = bisect.bisect_right(self.daylist, start)
+        upto = bisect.bisect_left(self.daylist, end)
+        # The first day either is kept, or is the last day kept before it
+        # carried over
+        daystate = self.days[self.daylist[first - 1]]
+        if self.daylist[first - 1] != start:
+            daystate = dict(daystate, actorset=set())
+            for field in TASKSTATE_FIELDS.values():
+                if daystate[field]:
+                    daystate[field] = {'start': daystate[field]['end'],
+                                       'end': daystate[field]['end']}
+        daystates = [daystate] + [self.days[day]
+                                  for day in self.daylist[first:upto]]
+        # Each field starts as on the first day it has a value, and ends
+        # as on the last day
+        taskstate = {}
+        for field in TASKSTATE_FIELDS.values():
+            values = [day[field] for day in daystates if day[field]]
+            taskstate[field] = {}
+            if values:
+                taskstate[field] = {'start': values[0]['start'],
+                                    'end': values[-1]['end']}
+        for key in ('waitingsince', 'workingsince'):
+            if key in daystates[-1]:
+                taskstate[key] = daystates[-1][key]
+        taskstate['actorset'] = set().union(
+            *[day['actorset'] for day in daystates])
+        if taskstate['assignee'].get('end') is not None:
+            taskstate['actorset'].add(taskstate['assignee']['end'])
+        return taskstate
+
+
+def load_day_histories(boards, taskstore, intervals, phidstore,
+                       current=None):
+    """Find the tasks whose state over every one of the intervals can be
+    put together from the days in the boards' FragmentCaches: those whose
+    days were worked out as of their current dateModified and cover the
+    intervals.  A task not modified since its last day worked out stays
+    as it was up to current, the time (epoch seconds, now by default) the
+    taskstore's dateModifieds are known to be current as of.  Their
+    transactions needn't be fetched; a DayHistory for each goes into the
+    board's "dayhistories" dict instead.  Returns the set of those task
+    numbers.
+    """
+    if current is None:
+        current = time.time()
+    for board in boards:
+        board['dayhistories'] = {}
+    times = [(wbtime - EPOCH).total_seconds() for interval in intervals
+             for wbtime in interval]
+    if any(wbtime % DAY for wbtime in times):
+        return set()
+    start, end = min(times), max(times)
+    found = {}
+    for board in boards:
+        fragments = get_fragmentcache(board)
+        if not fragments:
+            continue
+        for tasknum in board['tasks'] - set(board.get('unchanged', ())):
+            task = taskstore.bytasknum.get(tasknum)
+            span = fragments.span(board['teamphid'], tasknum)
+            if not task or not span:
+                continue
+            modified, first, upto = span
+            if modified != int(task['dateModified']):
+                continue
+            if modified < upto:
+                # Nothing's happened since the last day worked out, as
+                # far as we know
+                upto = max(upto, current)
+            if first <= start and end <= upto:
+                found.setdefault(board['teamphid'], {})[tasknum] = \
+                    (fragments, first, upto)
+    reusable = set()
+    for tasknum in set().union(*[board['tasks'] for board in boards]):
+        if all(tasknum in found.get(board['teamphid'], {})
+               for board in boards if tasknum in board['tasks']):
+            reusable.add(tasknum)
+    for board in boards:
+        for tasknum in board['tasks'] & reusable:
+            fragments, first, upto = found[board['teamphid']][tasknum]
+            days = dict((day, daystate_from_json(data, phidstore))
+                        for day, data in fragments.days(
+                            board['teamphid'], tasknum, start,
+                            end).iteritems())
+            board['dayhistories'][tasknum] = DayHistory(days, first, upto)
+    return reusable
+
+
+def save_day_histories(boards, taskstore, phidstore, since, fetched):
+    """Work out the day states of every task with a TaskHistory, from the
+    start of the day of since (or further back, if the FragmentCache
+    already went further back) up to the start of the day of fetched, the
+    time the transactions were fetched, and store them for
+    load_day_histories to find next time.
+    """
+    upto = int(fetched - fetched % DAY)
+    for board in boards:
+        fragments = get_fragmentcache(board)
+        if not fragments:
+            continue
+        for tasknum, history in board.get('histories', {}).iteritems():
+            if tasknum not in taskstore.bytasknum:
+                continue
+            first = int(since - since % DAY)
+            span = fragments.span(board['teamphid'], tasknum)
+            if span:
+                first = min(first, span[1])
+            if first >= upto:
+                continue
+            fragments.save(
+                board['teamphid'], tasknum,
+                taskstore.bytasknum[tasknum]['dateModified'], first, upto,
+                dict((day, daystate_to_json(daystate, phidstore))
+                     for day, daystate in get_daystates(
+                         history, first, upto).iteritems()))
+
+
+def build_taskstate_from_transactions(transactions, start, end, config,
+                                      phidstore):
+    """Walk through the TransactionLog and build up the state for a
+    particular task at each end of the interval defined by "start" and "end".
+    Also keep track of how long tasks have been in the "In Dev" and "Waiting
+    for Review/Feedback" columns ("workingsince" and "waitingsince", in epoch
+    seconds).  Column and assignee values, and the "actorset", are interned
+    PHIDs.
+
+    For each type, the "old" and "new" state is built along the interval.
+    For example:
+    a->b
+    b->c
+    ---START
+    c->d
+    d->e
+    ---END
+    Old should be "c" and new should be "e" (see unit test for example).
+    Use TaskHistory directly when looking at several intervals.
+    """
+    return TaskHistory(transactions, config, phidstore).state(start, end)
+
+
+def get_actor_tasks(actor, phidstore, taskstate, wbstate, taskstore):
+    """Return what to say about each task of a given user ("actor") over a
+    window, performing the many contortions necessary to have something
+    read more-or-less like plain English.  The goal of this software is to
+    present a simple view of things, so precision is compromised in the
+    name of clarity and highlighting what's important.
+
+    The result is a list of (tasknum, title, lines), each line a (CSS
+    class, text) pair, leaving out the tasks with nothing interesting to
+    say.  "wbstate" is the config's workboard_state_phids, interned.
+    """
+    retval = []
     for task in actor.tasks:
         assignee = taskstate[task]['assignee']
         column = taskstate[task]['column']
@@ -313,12 +2648,13 @@ def render_actor(actor, phidstore, transactions, start, end, taskstate,
         # is empty at the end of all of this, then we forego printing
         # the task number and title.
         taskarray = []
-        if (assignee.get('start') == actor.phid and
-                assignee.get('end') != actor.phid):
-            taskarray.append("    <li>Unassigned</li>\n")
-        if assignee.get('end') == actor.phid:
-            newitem = (assignee.get('start') != actor.phid and
-                       assignee.get('end') == actor.phid)
+        if (assignee.get('start') == actor.id and
+                assignee.get('end') != actor.id):
+            taskarray.append((None, "Unassigned"))
+        if assignee.get('end') == actor.id:
+            newitem = (assignee.get('start') != actor.id and
+                       assignee.get('end') == actor.id)
+            prefix = "Assigned and " if newitem else ""
             # the move from "done" to "archive" isn't very interesting
             # so ignore it.
             if (column.get('start') == wbstate['done'] and
@@ -327,131 +2663,78 @@ def render_actor(actor, phidstore, transactions, start, end, taskstate,
             # We have a change, so there's likely something interesting
             # to report
             elif (column.get('start') != column.get('end')):
-                taskval = "    <li class='taskstatus'>"
-                if newitem:
-                    taskval += "Assigned and "
                 if((column.get('start') == wbstate['todo'] or
                     not column.get('start')) and
                    column['end'] == wbstate['indev']):
-                    taskval += "Started</li>\n"
+                    taskval = "Started"
                 elif(column['end'] == wbstate['feedback']):
-                    taskval += "Asking for feedback</li>\n"
+                    taskval = "Asking for feedback"
                 elif(column['end'] == wbstate['done'] or
                      column['end'] == wbstate['archive']):
-                    taskval += "Completed</li>\n"
+                    taskval = "Completed"
                 # Catchall in case one of the cases above doesn't do it.
                 else:
+                    taskval = phidstore.name(column['end'])
                     if(column.get('start')):
-                        taskval += phidstore.name(column['start']) + " -> "
-                    taskval += phidstore.name(column['end']) + "\n"
-                taskarray.append(taskval)
+                        taskval = phidstore.name(column['start']) + \
+                            " -> " + taskval
+                taskarray.append(('taskstatus', prefix + taskval))
             elif (status['start'] != status['end']):
-                taskval = "    <li class='taskstatus'>"
-                if newitem:
-                    taskval += "Assigned and "
+                taskval = status['end']
                 if(status['start']):
-                    taskval += status['start'] + " -> "
-                taskval += status['end'] + "</li>\n"
-                taskarray.append(taskval)
+                    taskval = status['start'] + " -> " + taskval
+                taskarray.append(('taskstatus', prefix + taskval))
             elif newitem:
-                taskarray.append("    <li class='taskstatus'>Assigned</li>\n")
+                taskarray.append(('taskstatus', "Assigned"))
         if (column.get('start') == wbstate['indev'] == column['end'] and
-                assignee.get('end') == actor.phid):
-            taskval = "    <li class='taskstatus'>Still working on it (since "
-            taskval += taskstate[task]['workingsince'].strftime("%a, %b %d")
-            taskval += ")</li>\n"
-            taskarray.append(taskval)
+                assignee.get('end') == actor.id):
+            taskarray.append(('taskstatus', "Still working on it (since " +
+                              format_epoch(taskstate[task]['workingsince']) +
+                              ")"))
         if (column.get('start') == wbstate['feedback'] == column.get('end') and
-                assignee.get('end') == actor.phid):
-            taskval = "    <li class='taskstatus'>Waiting for feedback since "
-            taskval += taskstate[task]['waitingsince'].strftime("%a, %b %d")
-            taskval += "</li>\n"
-            taskarray.append(taskval)
-        # Now print out all of the activity for the task, or skip if
-        # there hasn't been anything interesting to report.
+                assignee.get('end') == actor.id):
+            taskarray.append(('taskstatus', "Waiting for feedback since " +
+                              format_epoch(taskstate[task]['waitingsince'])))
+        # Skip the task if there hasn't been anything interesting to
+        # report.
         if taskarray:
-            retval += "  <li>"
-            retval += "<a href='https://phabricator.wikimedia.org/T" + \
-                task + "'>"
-            retval += "<span class='tasknum'>"
-            retval += "T" + task
-            retval += "</span>:  "
-            retval += "<span class='tasktitle'>"
-            retval += escape(title) + "</span></a>\n"
-            retval += "  <ul>\n"
-            for line in taskarray:
-                retval += line
-            retval += "  </ul>\n"
-            retval += "  </li>\n"
-    retval += "</ul></li>\n"
+            retval.append((task, title, taskarray))
     return retval
 
 
-def main():
-    # Parse arguments and read config file plus various and sundry
-    # other bits.
-    config = get_config()
-    start = config['start']
-    end = config['end']
+def render_actor(actor, phidstore, taskstate, config, taskstore):
+    """Return an HTML blob for a given user ("actor"); see
+    get_actor_tasks for what goes in it.
+    """
+    wbstate = phidstore.add_map(config['workboard_state_phids'])
+    return HtmlReportWriter(None).user(
+        actor, get_actor_tasks(actor, phidstore, taskstate, wbstate,
+                               taskstore))
 
-    # Scrape workboards from HTML (yes, "ewwww....").  At first, I
-    # thought this was the only viable strategy, since most Phabricator
-    # APIs don't return workboard state at all.  I discovered that I
-    # could reconstruct all of the state I needed walking through the
-    # transactions in a task (also, "ew", but not "ewwww.....").
-    # It might be possible to eliminate scraping altogether, but one
-    # would still need to keep track of which tasks got moved out of
-    # the team project, which I haven't gotten to.  The advantage this
-    # approach still presents is it provides a fairly narrowly scoped
-    # list of issues (only those that are/were just visible on the
-    # workboard; skipping long-since archived issues).
-    old_workboard = parse_workboard_html(start, config['htmlcachedir'])
-    new_workboard = parse_workboard_html(end, config['htmlcachedir'])
-    allkeys = list(set(old_workboard.keys()).union(new_workboard.keys()))
-    alltasknums = [int(string.lstrip(x, "T")) for x in allkeys]
-
-    # Use the Phabricator API to fetch all of the activity for the list
-    # of issues passed via "alltasknums".
-    phab = phabricator.Phabricator()
-    activity = get_activity_for_tasks(phab, config['cachedir'],
-                                      alltasknums)
-
-    # Build a sane view of the transactions, filtering out a lot of
-    # noise and making the result a little more uniform and sane.
-    # Also, start populating a list of PHIDs (Phabricator IDs used for
-    # everything) in "phidstore".  In addition to storing the list of
-    # PHIDs to lookup, the phidstore acts as a class factory and
-    # registry for objects that can be referenced by PHID.
-    transactions = {}
-    phidstore = PhidStore()
-    for tasknum, taskfeed in activity.iteritems():
-        tacts = get_filtered_transactions_for_task(taskfeed, phidstore,
-                                                   config['teamphid'])
-        transactions[tasknum] = tacts
 
-    # Walk through the transactions and build up the state for each
-    # task at each end of the interval defined by "start" and "end".
-    # Also keep track of how long tasks have been in the "In Dev" and
-    # "Waiting for Review/Feedback" columns.  Start building a bunch of
-    # User objects, and populating them lists of associated tasks.
-    taskstate = {}
-    for task in transactions.keys():
-        taskstate[task] = build_taskstate_from_transactions(
-            transactions[task], start, end, config)
-        for actorphid in taskstate[task]['actorset']:
-            assert actorphid
-            phidstore.get_user(actorphid).tasks.append(task)
+def format_epoch(timestamp, fmt="%a, %b %d"):
+    """Format an epoch timestamp (in UTC) for the report."""
+    return datetime.datetime.fromtimestamp(
+        timestamp, dateutil.tz.tzutc()).strftime(fmt)
 
-    # Look up what all of the PHIDs are, and squirrel away the resulting
-    # metadata.
-    phidstore.load_from_phabricator(phab, config['cachedir'])
 
-    # The TaskStore is a wrapper around the Phabricator manifest.query
-    # API call, indexing the result by task number.
-    taskstore = TaskStore(alltasknums)
-    taskstore.load_from_phabricator(phab, config['cachedir'])
+def get_histories(board, phidstore):
+    """Return the board's TaskHistory for each task with transactions.
+    Each task's transactions are indexed once, so the state for any window
+    is just a couple of bisections away; the indexes are kept on the board
+    ("histories"), for whoever needs them next.
+    """
+    histories = board.setdefault('histories', {})
+    for task in board['transactions'].keys():
+        if task not in histories:
+            histories[task] = TaskHistory(board['transactions'][task],
+                                          board, phidstore)
+    return histories
+
+
+TASK_URL = 'https://phabricator.wikimedia.org/T{}'
 
-    print """
+HTML_HEAD = """
 <html>
 <head>
  <style type="text/css">
@@ -491,20 +2774,925 @@ def main():
  </style>
 </head>
 <body>
-<ul>
 """
-    # Spit out a text blob for each of the users.
-    for phid in config['team'].keys():
+
+# Everything in the HTML report that's more than a constant, as format
+# strings.  Values get escaped by HtmlReportWriter, not here.
+HTML_TEMPLATES = {
+    'board': u"<h1 class='board'>{name}</h1>\n",
+    'interval': u"<h2 class='interval'>{start:%a, %b %d %H:%M} - "
+                u"{end:%a, %b %d %H:%M}</h2>\n",
+    'user': u"<li class='userentry'><span class='user'>{name}</span>\n"
+            u"<ul>\n{tasks}</ul></li>\n",
+    'task': u"  <li><a href='{url}'><span class='tasknum'>T{task}</span>:  "
+            u"<span class='tasktitle'>{title}</span></a>\n"
+            u"  <ul>\n{lines}  </ul>\n  </li>\n",
+    'line': u"    <li class='{cls}'>{text}</li>\n",
+    'plainline': u"    <li>{text}</li>\n",
+}
+
+
+class HtmlReportWriter(object):
+    """Write the report to the stream "out" as an HTML page, piece by piece
+    as render_report gets to them.  user() only returns the fragment for
+    one user, without touching the stream, so that users can be rendered
+    concurrently; add_user() writes it out.
+    """
+    content_type = 'text/html; charset=utf-8'
+
+    def __init__(self, out):
+        self.out = out
+
+    def begin_report(self):
+        self.out.write(HTML_HEAD)
+
+    def begin_board(self, board, heading):
+        if heading:
+            self.out.write(HTML_TEMPLATES['board'].format(
+                name=escape(board.get('name', board['teamphid']))))
+
+    def begin_interval(self, start, end, heading):
+        if heading:
+            self.out.write(HTML_TEMPLATES['interval'].format(
+                start=start, end=end))
+        self.out.write("<ul>\n\n")
+
+    def user(self, actor, tasks):
+        task_html = HTML_TEMPLATES['task'].format
+        line_html = HTML_TEMPLATES['line'].format
+        plainline_html = HTML_TEMPLATES['plainline'].format
+        return HTML_TEMPLATES['user'].format(
+            name=escape(actor.name), tasks=u''.join(
+                task_html(url=TASK_URL.format(task), task=task,
+                          title=escape(title), lines=u''.join(
+                              line_html(cls=cls, text=escape(text)) if cls
+                              else plainline_html(text=escape(text))
+                              for cls, text in lines))
+                for task, title, lines in tasks))
+
+    def add_user(self, fragment):
+        self.out.write(fragment)
+
+    def end_interval(self):
+        self.out.write("\n</ul>\n")
+
+    def end_board(self):
+        pass
+
+    def end_report(self):
+        self.out.write("</body></html>\n\n")
+
+
+class JsonReportWriter(object):
+    """Write the report to the stream "out" as JSON, for other tools to
+    consume: {"boards": [{"name", "teamphid", "intervals": [{"start",
+    "end", "users": [{"phid", "name", "tasks": [{"task", "title", "url",
+    "status": [...]}]}]}]}]}, with times in ISO 8601.  Streamed the same
+    way as HtmlReportWriter.
+    """
+    content_type = 'application/json'
+
+    def __init__(self, out):
+        self.out = out
+        # How many items each open list has had so far
+        self.counts = []
+
+    def open(self, prefix, fields, listname):
+        if self.counts:
+            if self.counts[-1]:
+                self.out.write(', ')
+            self.counts[-1] += 1
+        self.out.write(prefix + '{')
+        for name in sorted(fields):
+            self.out.write('{}: {}, '.format(json.dumps(name),
+                                             json.dumps(fields[name])))
+        self.out.write('{}: ['.format(json.dumps(listname)))
+        self.counts.append(0)
+
+    def close(self):
+        self.counts.pop()
+        self.out.write(']}')
+
+    def begin_report(self):
+        self.open('', {}, 'boards')
+
+    def begin_board(self, board, heading):
+        self.open('\n', {'name': board.get('name'),
+                         'teamphid': board['teamphid']}, 'intervals')
+
+    def begin_interval(self, start, end, heading):
+        self.open('\n', {'start': start.isoformat(),
+                         'end': end.isoformat()}, 'users')
+
+    def user(self, actor, tasks):
+        return json.dumps({
+            'phid': actor.phid, 'name': actor.name,
+            'tasks': [{'task': task, 'title': title,
+                       'url': TASK_URL.format(task),
+                       'status': [text for cls, text in lines]}
+                      for task, title, lines in tasks]}, sort_keys=True)
+
+    def add_user(self, fragment):
+        if self.counts[-1]:
+            self.out.write(',')
+        self.counts[-1] += 1
+        self.out.write('\n' + fragment)
+
+    def end_interval(self):
+        self.close()
+
+    def end_board(self):
+        self.close()
+
+    def end_report(self):
+        self.close()
+        self.out.write('\n')
+
+
+REPORT_WRITERS = {
+    'html': HtmlReportWriter,
+    'json': JsonReportWriter,
+}
+
+
+def index_window(board, histories, start, end):
+    """Build up the state for each task that was on the board at either end
+    of the window from start to end, from its TaskHistory (or DayHistory)
+    in histories or else from the board's "unchanged" states, and index it
+    by actor.  Returns the task states, and the tasks (in task number
+    order) of each actor in their "actorset"s, by interned PHID.
+    """
+    unchanged = board.get('unchanged', {})
+    taskstate = {}
+    byactor = collections.defaultdict(list)
+    wbtasks = board['workboards'][start] | board['workboards'][end]
+    for task in sorted(set(histories) | set(unchanged), key=int):
+        if task not in wbtasks:
+            continue
+        if task in histories:
+            taskstate[task] = histories[task].state(start, end)
+        else:
+            taskstate[task] = unchanged[task]
+        for actorid in taskstate[task]['actorset']:
+            byactor[actorid].append(task)
+    return taskstate, byactor
+
+
+def render_board(board, intervals, phidstore, taskstore, writer,
+                 users=None, userindex=None, built=None):
+    """Write the report for one board (the config for one team's workboard,
+    as returned by get_boards) covering each of the intervals, with the
+    report writer "writer", for the whole team or just those of its
+    members whose PHIDs are in users.  Users are rendered "render_workers"
+    (DEFAULT_RENDER_WORKERS unless the board's config says otherwise) at a
+    time, but still written out in team order.  If the board has an
+    "indexes" dict, the result of index_window for each interval is kept
+    there, and taken from there if it's already in it.  With a userindex,
+    each window worked out goes into it as well (see save_user_window).
+    Returns the number of user entries written.
+    """
+    rendered = 0
+    histories = None
+    indexes = board.get('indexes')
+    team = [phid for phid in board['team'] if users is None or phid in users]
+    wbstate = phidstore.add_map(board['workboard_state_phids'])
+    workers = board.get('render_workers', DEFAULT_RENDER_WORKERS)
+    if workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+    else:
+        pool = None
+
+    for start, end in intervals:
+        writer.begin_interval(start, end, len(intervals) > 1)
+
+        # Build up the state for each task that was on the board at
+        # either end of the window.  Also keep track of how long tasks
+        # have been in the "In Dev" and "Waiting for Review/Feedback"
+        # columns.  Start building a bunch of User objects (fresh ones
+        # for each window), and populating them lists of associated tasks.
+        if indexes is not None and (start, end) in indexes:
+            taskstate, byactor = indexes[start, end]
+        else:
+            if histories is None:
+                histories = dict(board.get('dayhistories', {}))
+                histories.update(get_histories(board, phidstore))
+            taskstate, byactor = index_window(board, histories, start, end)
+            if indexes is not None:
+                indexes[start, end] = taskstate, byactor
+            if userindex:
+                save_user_window(board, start, end, taskstate, byactor,
+                                 phidstore, taskstore, userindex, built)
+        phidstore.users = {}
+        for phid in team:
+            actorid = phidstore.phids.get(phid)
+            if actorid in byactor:
+                phidstore.get_user(phid).tasks = byactor[actorid]
+
+        # Spit out a blob for each of the users (skipping those we can't
+        # render).
+        def render(phid):
+            try:
+                actor = phidstore.users[phid]
+                return writer.user(actor, get_actor_tasks(
+                    actor, phidstore, taskstate, wbstate, taskstore))
+            except KeyError:
+                return None
+        for fragment in (pool.imap(render, team) if pool
+                         else (render(phid) for phid in team)):
+            if fragment is not None:
+                writer.add_user(fragment)
+                rendered += 1
+        writer.end_interval()
+    if pool:
+        pool.close()
+    return rendered
+
+
+def render_report(boards, intervals, phidstore, taskstore, out=None,
+                  fmt='html', users=None, userindex=None, built=None):
+    """Write the whole report, with the report for each of the boards, to
+    out (default: stdout) in the format fmt (one of REPORT_WRITERS), for
+    everyone or just the users (PHIDs) in users, saving the windows in
+    userindex if given (see render_board).  Returns the number of user
+    entries written.
+    """
+    writer = REPORT_WRITERS[fmt](out or sys.stdout)
+    writer.begin_report()
+    rendered = 0
+    for board in boards:
+        writer.begin_board(board, len(boards) > 1)
+        rendered += render_board(board, intervals, phidstore, taskstore,
+                                 writer, users, userindex, built)
+        writer.end_board()
+    writer.end_report()
+    return rendered
+
+
+def find_user(boards, user):
+    """Return the PHID of the team member that user names (by PHID or by
+    userName) on any of the boards.  Raises ValueError if there's none.
+    """
+    for board in boards:
+        for phid, member in board['team'].iteritems():
+            if user in (phid, member.get('userName')):
+                return phid
+    raise ValueError('Unknown user: {}'.format(user))
+
+
+def save_user_window(board, start, end, taskstate, byactor, phidstore,
+                     taskstore, userindex, built):
+    """Store one window of the board, as index_window worked it out from
+    data complete as of built (epoch seconds), in the UserIndex, replacing
+    what was there for it.
+    """
+    entries = []
+    names = {}
+    for actorid, tasks in byactor.iteritems():
+        actor = phidstore.lookup(actorid)
+        names[actor] = phidstore.name(actor)
+        for task in tasks:
+            state = daystate_to_json(taskstate[task], phidstore)
+            names.update((phid, phidstore.name(phid))
+                         for phid in state['column'].itervalues() if phid)
+            entries.append((actor, task, taskstore.bytasknum.get(
+                task, {}).get('title'), state))
+    userindex.save(board['teamphid'], int((start - EPOCH).total_seconds()),
+                   int((end - EPOCH).total_seconds()), entries,
+                   dict((phid, name) for phid, name in names.iteritems()
+                        if name is not None), built)
+
+
+def render_indexed_user(boards, intervals, userindex, user, out=None,
+                        fmt='html', current=None):
+    """Write the report for just the user with PHID user, the same as
+    render_report would, but from the UserIndex: only that user's tasks
+    get looked at.  Returns the number of user entries written, or None
+    (having written nothing) if the index doesn't have every one of the
+    intervals for every board, as of current (see UserIndex.has).
+    """
+    windows = [(start, end, int((start - EPOCH).total_seconds()),
+                int((end - EPOCH).total_seconds()))
+               for start, end in intervals]
+    if not all(userindex.has(board['teamphid'], first, last, current)
+               for board in boards for start, end, first, last in windows):
+        return None
+    phidstore = PhidStore()
+    taskstore = TaskStore()
+    actorid = phidstore.add(user)
+    phids = set([user])
+    for board in boards:
+        board['indexes'] = {}
+        for start, end, first, last in windows:
+            taskstate = {}
+            rows = []
+            if user in board['team']:
+                rows = userindex.tasks(board['teamphid'], first, last, user)
+            for task, title, state in rows:
+                taskstate[task] = daystate_from_json(state, phidstore)
+                phids.update(phid for phid in state['column'].itervalues()
+                             if phid)
+                if title is not None:
+                    taskstore.bytasknum[task] = {'title': title}
+            board['indexes'][start, end] = taskstate, {
+                actorid: sorted(taskstate, key=int)} if taskstate else {}
+    for phid, name in userindex.names(phids).iteritems():
+        phidstore.query[phid] = {'name': name}
+    return render_report(boards, intervals, phidstore, taskstore, out, fmt,
+                         [user])
+
+
+def get_flow_samples(board, start, end, phidstore):
+    """Walk each task's history on the board once, collecting durations
+    (in seconds) for the flow metrics over start to end (epoch seconds):
+
+    "cycle time"      from first entering "indev" to being finished
+    "lead time"       from the task's first transaction to being finished
+    "time in column"  for each stay in a column that ended in the period
+
+    A task is finished when it moves into "done" or "archive", or gets a
+    closed status, from neither.  Finishing and cycle/lead times are
+    credited to the assignee at the time, and a stay in a column to the
+    assignee when it ended.  Only tasks with fetched transactions count,
+    so with snapshot-based boards tasks that came and went between the
+    two ends of the period are missed.
+
+    Returns {(scope, name): {metric: array of durations}}, for scope
+    "board", "column" and "user", plus the number of tasks finished for
+    each in "completed".
+    """
+    wbstate = phidstore.add_map(board['workboard_state_phids'])
+    finishedcolumns = (wbstate['done'], wbstate['archive'])
+    team = set(phidstore.add(phid) for phid in board['team'])
+    samples = collections.defaultdict(
+        lambda: collections.defaultdict(lambda: array('d')))
+    COLUMN, STATUS, ASSIGNEE = range(3)
+    for history in get_histories(board, phidstore).itervalues():
+        if not history.timestamps:
+            continue
+        created = history.timestamps[0]
+        changes = []
+        for kind, field in ((COLUMN, 'column'), (STATUS, 'status'),
+                            (ASSIGNEE, 'assignee')):
+            times, olds, news = history.changes[field]
+            changes.append([(times[i], kind, news[i])
+                            for i in xrange(len(times))])
+        column_times, column_olds = history.changes['column'][:2]
+        column = column_olds[0] if column_olds else None
+        assignee_olds = history.changes['assignee'][1]
+        assignee = assignee_olds[0] if assignee_olds else None
+        entered = created
+        isclosed = False
+        finished = column in finishedcolumns
+        started = None
+        for timestamp, kind, value in heapq.merge(*changes):
+            if kind == COLUMN:
+                if column is not None and start <= timestamp <= end:
+                    stay = timestamp - entered
+                    scopes = [('board', None), ('column', column)]
+                    if assignee in team:
+                        scopes.append(('user', assignee))
+                    for scope in scopes:
+                        samples[scope]['time in column'].append(stay)
+                column = value
+                entered = timestamp
+                if column == wbstate['indev'] and started is None:
+                    started = timestamp
+            elif kind == STATUS:
+                isclosed = value in CLOSED_STATUSES
+            else:
+                assignee = value
+            nowfinished = isclosed or column in finishedcolumns
+            if nowfinished and not finished and start <= timestamp <= end:
+                scopes = [('board', None)]
+                if assignee in team:
+                    scopes.append(('user', assignee))
+                for scope in scopes:
+                    samples[scope]['completed'].append(timestamp)
+                    samples[scope]['lead time'].append(timestamp - created)
+                    if started is not None:
+                        samples[scope]['cycle time'].append(
+                            timestamp - started)
+            finished = nowfinished
+    return samples
+
+
+def summarize_durations(durations):
+    """Return the mean, median and 85th percentile of durations (in
+    seconds), in days.
+    """
+    ordered = sorted(durations)
+    count = len(ordered)
+    day = 24 * 60 * 60.0
+    return (sum(ordered) / count / day,
+            ordered[(count - 1) // 2] / day,
+            ordered[min(count - 1, int(count * 0.85))] / day)
+
+
+def write_flow_metrics(boards, start, end, phidstore, path):
+    """Write a CSV table of the flow metrics (see get_flow_samples) over
+    start to end for each board: count, mean, median and 85th percentile
+    of each duration, in days, and the number of tasks finished, per
+    board, column and user.  Returns the number of rows written.
+    """
+    start = (start - EPOCH).total_seconds()
+    end = (end - EPOCH).total_seconds()
+    weeks = (end - start) / (7 * 24 * 60 * 60.0)
+    rows = 0
+    with open(path, 'wb') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['board', 'scope', 'name', 'metric', 'count',
+                         'mean days', 'median days', '85th percentile days',
+                         'per week'])
+        for board in boards:
+            boardname = board.get('name', board['teamphid'])
+            samples = get_flow_samples(board, start, end, phidstore)
+            # By name, rather than by whatever order the PHIDs got
+            # interned in
+            samples = sorted(
+                ((scope, phidstore.name(name) if name is not None else None),
+                 metrics) for (scope, name), metrics in samples.iteritems())
+            for (scope, name), metrics in samples:
+                row = [boardname.encode('utf-8'), scope,
+                       (name or '').encode('utf-8')]
+                for metric, durations in sorted(metrics.iteritems()):
+                    rows += 1
+                    if metric == 'completed':
+                        writer.writerow(row + [
+                            metric, len(durations), '', '', '',
+                            '{:.2f}'.format(len(durations) / weeks)
+                            if weeks else ''])
+                    else:
+                        writer.writerow(row + [metric, len(durations)] + [
+                            '{:.2f}'.format(value) for value in
+                            summarize_durations(durations)] + [''])
+    return rows
+
+
+class ReportState(object):
+    """Everything serve() keeps in memory between requests: the parsed
+    workboards, the filtered transactions (and TaskHistory indexes) for
+    each board, the PhidStore and the TaskStore, plus the most recently
+    rendered reports.  Snapshots, and the tasks on them, are loaded the
+    first time a report needs them; refresh() refetches every known task
+    and throws away the rendered reports only if something changed.
+    Boards without snapshots keep a BoardHistory fed with every task
+    discover_board_tasks finds ("discovered").  The task states of each
+    window rendered are kept too, indexed by actor ("indexes", see
+    render_board), so that one user's report for a window already seen
+    only looks at that user's tasks.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.boards = get_boards(config)
+        for board in self.boards:
+            board['workboards'] = {}
+            board['tasks'] = set()
+            board['transactions'] = {}
+            board['indexes'] = collections.OrderedDict()
+            if not (board.get('htmlcachedir') or
+                    board.get('snapshotstore')):
+                board['history'] = BoardHistory(board['teamphid'])
+                board['discovered'] = set()
+                board['history_since'] = float('inf')
+            if get_snapshotstore(board):
+                board['snapshotcounts'] = board['snapshots'].counts()
+        self.fetcher = get_fetcher(config)
+        self.eventstore = get_eventstore(config)
+        self.phidstore = PhidStore(config.get('phidregistry'),
+                                   get_phid_refresh_age(config))
+        for board in self.boards:
+            self.phidstore.seed(board['team'])
+        self.taskstore = TaskStore()
+        # sha1 of each task's raw feed, to tell whether a refetch changed
+        # anything without holding on to the feeds themselves
+        self.feedhashes = {}
+        self.reports = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def report(self, start, end, step=None, fmt='html', user=None):
+        """Return the report for start to end, split into windows of
+        length step if given, in the format fmt (one of REPORT_WRITERS),
+        for everyone or just user (a userName or PHID).  Raises IOError if
+        a workboard snapshot the report needs doesn't exist, and
+        ValueError if there's no such user.
+        """
+        key = (start, end, step, fmt, user)
+        with self.lock:
+            if key in self.reports:
+                return self.reports[key]
+            users = [find_user(self.boards, user)] if user else None
+            intervals = get_intervals(start, end, step)
+            self.load(intervals)
+            out = StringIO()
+            render_report(self.boards, intervals, self.phidstore,
+                          self.taskstore, out, fmt, users)
+            for board in self.boards:
+                while len(board['indexes']) > REPORT_CACHE_SIZE:
+                    board['indexes'].popitem(last=False)
+            html = out.getvalue()
+            if isinstance(html, unicode):
+                html = html.encode('utf-8')
+            while len(self.reports) >= REPORT_CACHE_SIZE:
+                self.reports.popitem(last=False)
+            self.reports[key] = html
+            return html
+
+    def load(self, intervals):
+        """Parse whichever workboards for the intervals we haven't seen yet,
+        and fetch whatever we don't know yet about the tasks on them.
+        """
+        since = min((start - EPOCH).total_seconds()
+                    for start, end in intervals)
+        for board in self.boards:
+            if since < board.get('history_since', since):
+                # Reaching further back than before may turn up closed
+                # tasks we skipped
+                board['history_since'] = since
+                found = discover_board_tasks(self.fetcher, board, since)
+                unknown = found - board['discovered']
+                board['discovered'] |= found
+                if unknown:
+                    self.apply(*self.fetch(unknown))
+        newtasks = set()
+        for board in self.boards:
+            times = set(wbtime for interval in intervals
+                        for wbtime in interval)
+            times.difference_update(board['workboards'])
+            if not times:
+                continue
+            workboards = get_workboards(board, [(t, t) for t in times])
+            board['workboards'].update(workboards)
+            tasks = set().union(*workboards.values())
+            newtasks |= tasks - board['tasks']
+            board['tasks'] |= tasks
+        if newtasks:
+            self.apply(*self.fetch(newtasks))
+
+    def refresh(self):
+        """Refetch every task we know about, skipping the cache (unless
+        offline) so that changes show up before the cached responses
+        expire.  The fetching happens without holding the lock, so reports
+        keep being served meanwhile.
+        """
+        fresh = not self.config.get('offline')
+        with self.lock:
+            tasknums = set(int(x) for board in self.boards
+                           for x in board['tasks'])
+            histories = [board for board in self.boards
+                         if 'history' in board]
+        for board in histories:
+            found = discover_board_tasks(self.fetcher, board,
+                                         board['history_since'], fresh)
+            with self.lock:
+                board['discovered'] |= found
+                tasknums |= board['discovered']
+        activity, titles = self.fetch(tasknums, skip_unmodified=True,
+                                      fresh=fresh)
+        with self.lock:
+            changed = self.apply(activity, titles)
+            for board in self.boards:
+                store = get_snapshotstore(board)
+                if store and store.counts() != board.get('snapshotcounts'):
+                    # New snapshots may be nearer to the times we've
+                    # looked up
+                    board['snapshotcounts'] = store.counts()
+                    board['workboards'] = {}
+                    board['indexes'].clear()
+                    changed = True
+            if changed:
+                self.reports.clear()
+
+    def fetch(self, tasknums, skip_unmodified=False, fresh=False):
+        """Fetch the activity and the maniphest.query result for tasknums.
+        With skip_unmodified, the activity of tasks we already have whose
+        dateModified hasn't moved isn't fetched again.  With fresh, the
+        maniphest.query result, and the activity of the tasks we have
+        whose dateModified has moved, skip the cache.
+        """
+        tasknums = [int(x) for x in tasknums]
+        taskstore = TaskStore(tasknums)
+        taskstore.load_from_phabricator(self.fetcher, fresh=fresh)
+        if skip_unmodified:
+            known = self.taskstore.bytasknum
+            tasknums = [
+                x for x in tasknums if str(x) not in self.feedhashes or
+                known.get(str(x), {}).get('dateModified') !=
+                taskstore.bytasknum.get(str(x), {}).get('dateModified')]
+        stale = [x for x in tasknums if fresh and str(x) in self.feedhashes]
+        activity = get_activity_for_tasks(self.fetcher, tasknums,
+                                          self.eventstore, stale=stale)
+        return activity, taskstore.bytasknum
+
+    def apply(self, activity, titles):
+        """Merge the result of fetch() into the state, filtering only the
+        feeds that changed (or that a board hasn't seen yet).  Returns True
+        if anything changed.
+        """
+        changed = set()
+        for tasknum, taskfeed in activity.iteritems():
+            feedhash = hashlib.sha1(json.dumps(taskfeed,
+                                               sort_keys=True)).hexdigest()
+            if self.feedhashes.get(tasknum) != feedhash:
+                self.feedhashes[tasknum] = feedhash
+                changed.add(tasknum)
+        for board in self.boards:
+            filter_board_transactions(
+                board, dict((tasknum, taskfeed)
+                            for tasknum, taskfeed in activity.iteritems()
+                            if tasknum in changed or
+                            tasknum not in board['transactions']),
+                self.phidstore)
+            if 'history' not in board:
+                continue
+            for tasknum, taskfeed in activity.iteritems():
+                if int(tasknum) not in board['discovered']:
+                    continue
+                if (tasknum in changed or
+                        int(tasknum) not in board['history'].feeds):
+                    board['history'].set_feed(int(tasknum), taskfeed)
+                    # Workboards get rebuilt from the history as needed
+                    board['workboards'] = {}
+        self.phidstore.load_from_phabricator(self.fetcher)
+        for tasknum, task in titles.iteritems():
+            if self.taskstore.bytasknum.get(tasknum) != task:
+                self.taskstore.bytasknum[tasknum] = task
+                changed.add(tasknum)
+        if changed:
+            for board in self.boards:
+                board['indexes'].clear()
+        return bool(changed)
+
+
+def get_report_server(address, state):
+    """Build the HTTP server for serve(), listening on address (a (host,
+    port) tuple).  It answers GET /?start=...&end=...&step=...&format=...
+    &user=... (all optional, with the same meaning and defaults as the
+    command line options) from the ReportState state, a thread per
+    request.  The HTTP server modules are imported here, as only --serve
+    needs them.
+    """
+    import BaseHTTPServer
+    import SocketServer
+
+    class ReportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse.urlparse(self.path)
+            if url.path != '/':
+                self.send_error(404)
+                return
+            query = dict(urlparse.parse_qsl(url.query))
+            fmt = query.get('format', 'html')
+            if fmt not in REPORT_WRITERS:
+                self.send_error(400, 'Unknown format')
+                return
+            try:
+                start, end = get_window(query.get('start'),
+                                        query.get('end'))
+                html = self.server.state.report(
+                    start, end, query.get('step'), fmt, query.get('user'))
+            except (ValueError, OverflowError) as e:
+                self.send_error(400, str(e))
+                return
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self.send_error(404, 'No workboard snapshot for that time')
+                return
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             REPORT_WRITERS[fmt].content_type)
+            self.send_header('Content-Length', str(len(html)))
+            self.end_headers()
+            self.wfile.write(html)
+
+    class ReportServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = ReportServer(address, ReportHandler)
+    server.state = state
+    return server
+
+
+def refresh_periodically(state, interval):
+    """Call state.refresh() every interval seconds, forever."""
+    while True:
+        time.sleep(interval)
         try:
-            actor = phidstore.users[phid]
-            print render_actor(actor, phidstore, transactions, start, end,
-                            taskstate, config, taskstore),
-        except KeyError:
-            pass
-    print """
-</ul>
-</body></html>
-"""
+            state.refresh()
+        except Exception as e:
+            sys.stderr.write('Refresh failed: {!r}\n'.format(e))
+
+
+def serve(config):
+    """Keep the report state in memory and serve reports over HTTP, with a
+    background thread refreshing the state every "refresh_interval"
+    seconds.  Refreshes go through the ResponseCache, so cache_ttl also
+    bounds how fresh the data gets.
+    """
+    state = ReportState(config)
+    server = get_report_server((config['bind'], config['serve']), state)
+    refresher = threading.Thread(
+        target=refresh_periodically,
+        args=(state, config.get('refresh_interval',
+                                DEFAULT_REFRESH_INTERVAL)))
+    refresher.daemon = True
+    refresher.start()
+    sys.stderr.write('Serving reports on http://{}:{}/\n'.format(
+        *server.server_address))
+    server.serve_forever()
+
+
+def main():
+    # Parse arguments and read config file plus various and sundry
+    # other bits.
+    try:
+        config = get_config()
+    except ValueError as e:
+        sys.exit('wbstatus: {}'.format(e))
+    if config['serve']:
+        serve(config)
+        return
+    if config['backfill']:
+        for board in get_boards(config):
+            if not board.get('htmlcachedir'):
+                continue
+            parsed = backfill_snapshots(board, config['jobs'],
+                                        config['prune_imported'])
+            sys.stderr.write('Parsed {} snapshots in {}\n'.format(
+                parsed, board['htmlcachedir']))
+        return
+    METRICS.start(config)
+    intervals = config['intervals']
+    boards = get_boards(config)
+    userindex = get_userindex(config)
+    fetcher = get_fetcher(config)
+    # How far the tasks' dateModifieds are known to be current (they're
+    # fetched fresh, below, unless offline), and the transactions we get
+    # complete: cached ones are as old as the cache lets them get, and
+    # tasks whose dateModified says they have no new transactions aren't
+    # fetched at all
+    now = time.time()
+    modifiedasof = now
+    if config['offline']:
+        modifiedasof = fetcher.current_as_of('maniphest.query', now)
+    fetched = min(modifiedasof, fetcher.current_as_of(
+        'maniphest.gettasktransactions', now))
+    users = None
+    if config['user']:
+        try:
+            users = [find_user(boards, config['user'])]
+        except ValueError as e:
+            sys.exit('wbstatus: {}'.format(e))
+        # One person's report, if the index the last full run left has
+        # the windows asked for, as current as the whole works would get
+        # them, only needs their tasks.  Otherwise it's the whole works
+        # (which brings the index up to date).
+        if userindex:
+            with METRICS.stage('render from user index') as stage:
+                stage['objects'] = render_indexed_user(
+                    boards, intervals, userindex, users[0],
+                    fmt=config['format'], current=fetched)
+            if stage['objects'] is not None:
+                fetcher.close()
+                METRICS.report(config)
+                return
+
+    # Scrape workboards from HTML (yes, "ewwww....").  At first, I
+    # thought this was the only viable strategy, since most Phabricator
+    # APIs don't return workboard state at all.  I discovered that I
+    # could reconstruct all of the state I needed walking through the
+    # transactions in a task (also, "ew", but not "ewwww.....").
+    # Boards without an "htmlcachedir" do exactly that: every task in
+    # the team project that might have been on the board gets fetched,
+    # and BoardHistory replays the column, project and status changes
+    # to work out what was on the board when.  The advantage scraping
+    # still presents is it provides a fairly narrowly scoped list of
+    # issues (only those that are/were just visible on the workboard;
+    # skipping long-since archived issues).  With --step there's a
+    # workboard for each window boundary, and with several boards each
+    # has its own; everything visible on any of them gets fetched in
+    # one go.
+    eventstore = get_eventstore(config)
+    since = (intervals[0][0] - EPOCH).total_seconds()
+    with METRICS.stage('parse workboards') as stage:
+        for board in boards:
+            if not (board.get('htmlcachedir') or
+                    board.get('snapshotstore')):
+                # Its workboards come once the transactions are in; until
+                # then, its tasks are all the ones that might have been on
+                # it
+                board['history'] = BoardHistory(board['teamphid'])
+                board['discovered'] = discover_board_tasks(fetcher, board,
+                                                           since)
+                board['tasks'] = set(str(x) for x in board['discovered'])
+                continue
+            board['workboards'] = get_workboards(board, intervals)
+            board['tasks'] = set().union(*board['workboards'].values())
+        alltasks = set().union(*[board['tasks'] for board in boards])
+        stage['objects'] = len(alltasks)
+    alltasknums = [int(x) for x in alltasks]
+
+    # Start populating a list of PHIDs (Phabricator IDs used for
+    # everything) in "phidstore", shared by all of the boards.  In
+    # addition to storing the list of PHIDs to lookup, the phidstore
+    # acts as a class factory and registry for objects that can be
+    # referenced by PHID.
+    phidstore = PhidStore(config.get('phidregistry'),
+                          get_phid_refresh_age(config))
+
+    # The TaskStore is a wrapper around the Phabricator manifest.query
+    # API call, indexing the result by task number.  Besides the titles,
+    # it has each task's dateModified: in a short window most tasks
+    # haven't been touched since before it started, and if the event
+    # store has their state as of that dateModified, that's all we need
+    # to know about them.  Likewise, for windows of whole days, a task
+    # whose days the fragment cache has as of its dateModified can be
+    # put together from those.  (Boards being rebuilt from transactions
+    # need them all regardless.)  Without either, the titles aren't
+    # needed until it comes to rendering, so they're fetched alongside
+    # the transactions, with the transactions going out first.
+    taskstore = TaskStore(alltasknums)
+    titles = None
+    with METRICS.stage('fetch task details') as stage:
+        if eventstore or any(get_fragmentcache(board) for board in boards):
+            # Whatever dateModified says goes, so it has to be current
+            # rather than as old as the cache lets it get (offline,
+            # everything's only as current as the cache anyway)
+            taskstore.load_from_phabricator(
+                fetcher, fresh=not config['offline'])
+        else:
+            titles = fetcher.background(taskstore.load_from_phabricator,
+                                        fetcher)
+        unchanged = load_unchanged_tasks(boards, taskstore, eventstore,
+                                         since, phidstore)
+        # The flow metrics need every transaction in the window
+        if not config['flow_metrics']:
+            unchanged |= load_day_histories(boards, taskstore, intervals,
+                                            phidstore, modifiedasof)
+        unchanged -= set().union(*[board['tasks'] for board in boards
+                                   if 'history' in board])
+        stage['objects'] = len(taskstore.bytasknum)
+
+    # Use the Phabricator API to fetch all of the activity for the rest
+    # of the issues in "alltasknums", a chunk at a time.  With an event
+    # store configured, new transactions get appended to the store and
+    # the full history for each task is read back from there.  Each
+    # chunk gets filtered into a sane view of the transactions (cutting
+    # out a lot of noise and making the result a little more uniform and
+    # sane, each board with its own teamphid) and indexed into
+    # TaskHistory objects before the next comes in, so the raw
+    # transactions for the whole board are never held at once.
+    with METRICS.stage('fetch and filter transactions', hot=True) as stage:
+        for board in boards:
+            phidstore.seed(board['team'])
+        stage['objects'] = stream_activity(
+            boards, fetcher, [x for x in alltasknums
+                              if str(x) not in unchanged],
+            eventstore, phidstore,
+            dict((tasknum, task['dateModified']) for tasknum, task
+                 in taskstore.bytasknum.iteritems()),
+            fresh=not config['offline'])
+        for board in boards:
+            if 'history' not in board:
+                continue
+            board['workboards'] = get_workboards(board, intervals)
+            board['tasks'] = set().union(*board['workboards'].values())
+            for tasknum in set(board['histories']) - board['tasks']:
+                del board['histories'][tasknum]
+
+    # Look up what all of the PHIDs we don't already know are, and
+    # squirrel away the resulting metadata.
+    with METRICS.stage('resolve phids') as stage:
+        phidstore.load_from_phabricator(fetcher)
+        stage['objects'] = len(phidstore.phids)
+    if titles:
+        with METRICS.stage('wait for task details') as stage:
+            titles.get()
+            stage['objects'] = len(taskstore.bytasknum)
+    fetcher.close()
+    # With a user index, each window goes into it, indexed by actor, as
+    # soon as it's been rendered
+    with METRICS.stage('render', hot=True) as stage:
+        stage['objects'] = render_report(boards, intervals, phidstore,
+                                         taskstore, fmt=config['format'],
+                                         users=users, userindex=userindex,
+                                         built=fetched)
+    if config['flow_metrics']:
+        with METRICS.stage('flow metrics', hot=True) as stage:
+            stage['objects'] = write_flow_metrics(
+                boards, config['start'], config['end'], phidstore,
+                config['flow_metrics'])
+    if eventstore:
+        save_task_summaries(boards, taskstore, eventstore, phidstore)
+    save_day_histories(boards, taskstore, phidstore, since, fetched)
+    METRICS.report(config)
+
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except OfflineError as e:
+        sys.exit('wbstatus: {}'.format(e))